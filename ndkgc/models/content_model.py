@@ -1,21 +1,32 @@
 import csv
+import os
 from intbitset import intbitset
 
 import tensorflow.contrib.layers as layers
 
 from ndkgc.ops import *
 from ndkgc.utils import *
+from ndkgc.utils.bundle import compile_targets, load_dataset_bundle
+from ndkgc.utils.evaluation import EvaluationIndex, TargetEmbeddingCache
 
 
 class ContentModel(object):
     PAD = '__PAD__'
     PAD_const = tf.constant(PAD, name='pad')
+    # __PAD__ is always the first word in the vocab file
+    PAD_ID = 0
 
     TRAIN_SUMMARY = 'train_summary'
     TRAIN_SUMMARY_SLOW = 'train_summary_slow'
 
     EVAL_SUMMARY = 'eval_summary'
 
+    # target index name to array name in the dataset bundle
+    BUNDLE_TARGETS = {'training_target_tails': 'train_tails',
+                      'training_target_heads': 'train_heads',
+                      'evaluation_target_tails': 'eval_tails',
+                      'evaluation_target_heads': 'eval_heads'}
+
     def __init__(self, **kwargs):
         # entity string name per line, no space or tab
         self.entity_file = kwargs['entity_file']
@@ -25,6 +36,7 @@ class ContentModel(object):
         self.n_relation = count_line(self.relation_file)
         # vocab word per line, no space or tab
         self.vocab_file = kwargs['vocab_file']
+        valid_vocab_file(self.vocab_file)
         self.n_vocab = count_line(self.vocab_file)
 
         # entity string name \t number of words \t space-separated content
@@ -56,11 +68,19 @@ class ContentModel(object):
 
         self.train_file = kwargs['train_file']
 
+        # Optional compiled dataset (tools/compile_dataset.py), if given the non trainable
+        # variables are loaded from this bundle instead of parsing the text files above
+        self.dataset_bundle = kwargs.get('dataset_bundle', None)
+
         self.NON_TRAINABLE = 'non_trainable'
 
         self.word_oov = kwargs['word_oov']
         self.word_embedding_size = kwargs['word_embedding_size']
 
+        # Entities are encoded in buckets of their content lengths so the padding only goes
+        # to the longest content in each bucket, set to None to pad to the longest content in the batch
+        self.content_bucket_boundaries = kwargs.get('content_bucket_boundaries', [20, 40, 60, 80, 120])
+
         if 'debug' in kwargs and kwargs['debug']:
             self.debug = True
         else:
@@ -77,6 +97,19 @@ class ContentModel(object):
         self.training_input_scope = None
         with tf.variable_scope('training_input') as scp:
             self.training_input_scope = scp
+        # Tensors read from the training input pipelines and their iterator initializers
+        self.training_inputs = list()
+        self.training_iterator_init_ops = list()
+        # Hard negative caches, see _create_hard_negative_cache
+        self.hard_negative_tails = None
+        self.hard_negative_heads = None
+        self.hard_negative_refresh_ops = None
+        # First key of the next refresh of each cache, the refreshes rotate over the keys
+        self.hard_negative_refresh_start = dict()
+        # Materialized entity embeddings of the evaluation, see _create_entity_embedding_cache
+        self.normalized_entity_embeddings = None
+        self.entity_embedding_norms = None
+        self.materialize_entity_op = None
 
         self.head_scope = None
         with tf.variable_scope('transform_head') as scp:
@@ -122,17 +155,19 @@ class ContentModel(object):
 
         :return:
         """
-
-        # Load training triples
-        _training_triples = load_triples(self.train_file)
-        self.training_triples.load(_training_triples, session)
-        del _training_triples
+        if self.dataset_bundle is not None:
+            return self._init_nontrainable_variables_from_bundle(session)
 
         # Load entity list
         # entity_str_name : numerical id (0-indexed)
         entity_dict = load_list(self.entity_file)
         relation_dict = load_list(self.relation_file)
 
+        # Load training triples
+        _training_triples = load_triple_array(self.train_file, entity_dict, relation_dict)
+        self.training_triples.load(_training_triples, session)
+        del _training_triples
+
         # Load mask entity list, these are entities used in open world predictions
         # so we need to make sure we do not use them during training
         # Load entities we want to avoid during
@@ -147,57 +182,171 @@ class ContentModel(object):
         tf.logging.info("closed_entities size %d" % len(_closed_entities))
         self.closed_entities.load(_closed_entities, session=session)
 
+        # Content are stored as word ids so there is no string processing during training
+        vocab = load_list(self.vocab_file)
+
         # Load entity description
-        _entity_desc, _entity_desc_len = load_content(self.content_file,
-                                                      entity_dict)
+        _entity_desc, _entity_desc_offsets = load_content_ids(self.content_file,
+                                                              entity_dict, vocab, self.word_oov)
         self.entity_content.load(_entity_desc, session)
-        self.entity_content_len.load(_entity_desc_len, session)
+        self.entity_content_offsets.load(_entity_desc_offsets, session)
         # Release memory before the function ends
-        del _entity_desc, _entity_desc_len
+        del _entity_desc, _entity_desc_offsets
 
         # Load entity title
-        _entity_title, _entity_title_len = load_content(self.entity_title_file,
-                                                        entity_dict)
+        _entity_title, _entity_title_offsets = load_content_ids(self.entity_title_file,
+                                                                entity_dict, vocab, self.word_oov)
         self.entity_title.load(_entity_title, session)
-        self.entity_title_len.load(_entity_title_len, session)
+        self.entity_title_offsets.load(_entity_title_offsets, session)
 
         # Load relationship title
-        _relation_title, _relation_title_len = load_content(self.relation_title_file,
-                                                            relation_dict)
+        _relation_title, _relation_title_offsets = load_content_ids(self.relation_title_file,
+                                                                    relation_dict, vocab, self.word_oov)
         self.relation_title.load(_relation_title, session)
-        self.relation_title_len.load(_relation_title_len, session)
-
-        # Note, this file has to have the same order as the key file otherwise this will not work
-        _training_tail_targets = load_target_file(self.training_target_tail_file)
-        self.training_target_tails.load(_training_tail_targets, session)
-        del _training_tail_targets
-
-        _training_head_targets = load_target_file(self.training_target_head_file)
-        self.training_target_heads.load(_training_head_targets, session)
-
-        _evaluation_open_tail_targets = load_target_file(self.evaluation_open_target_tail_file)
-        self.evaluation_open_target_tails.load(_evaluation_open_tail_targets)
-        del _evaluation_open_tail_targets
-        _evaluation_closed_tail_targets = load_target_file(self.evaluation_closed_target_tail_file)
-        self.evaluation_closed_target_tails.load(_evaluation_closed_tail_targets)
-        del _evaluation_closed_tail_targets
-
-        _evaluation_open_head_targets = load_target_file(self.evaluation_open_target_head_file)
-        self.evaluation_open_target_heads.load(_evaluation_open_head_targets)
-        del _evaluation_open_head_targets
-        _evaluation_closed_head_targets = load_target_file(self.evaluation_closed_target_head_file)
-        self.evaluation_closed_target_heads.load(_evaluation_closed_head_targets)
-        del _evaluation_closed_head_targets
+        self.relation_title_offsets.load(_relation_title_offsets, session)
+        del vocab
+
+        # Targets are loaded as entity ids, the value files are line aligned with the key files
+        for name, key_file, value_files in self._target_stores():
+            _keys, _targets = compile_targets(key_file, [f for _, f, _ in value_files], entity_dict, relation_dict)
+            self._load_target_store(name, _keys, _targets, [v for _, _, v in value_files], session)
+        del _keys, _targets
 
         # initialize the pre-trained word embedding
         self.vocab_dict = load_vocab_file(self.vocab_file)
-        self.word_embedding.load(load_vocab_embedding(self.word_embed_file, self.vocab_dict, self.word_oov),
+        self.word_embedding.load(load_vocab_embedding(self.word_embed_file, self.vocab_dict, self.word_oov,
+                                                      self.word_embedding_size),
                                  session=session)
 
         if self.debug:
             self._sanity_check(entity_dict, session=session)
             self._sanity_check(mask_entity_dict, session=session)
 
+    def _init_nontrainable_variables_from_bundle(self, session=None):
+        """ Same as _init_nontrainable_variables but read everything from a compiled dataset bundle
+
+        :param session:
+        :return:
+        """
+        bundle = load_dataset_bundle(self.dataset_bundle, os.path.dirname(self.train_file))
+
+        entities = np.asarray(bundle.strings('entities'), dtype=object)
+        relations = np.asarray(bundle.strings('relations'), dtype=object)
+
+        self.training_triples.load(bundle['train_triples'], session)
+
+        self.avoid_entities.load(bundle['avoid_entities'], session=session)
+        tf.logging.info("avoid_entities size %d" % bundle['avoid_entities'].shape[0])
+        self.closed_entities.load(bundle['closed_entities'], session=session)
+        tf.logging.info("closed_entities size %d" % bundle['closed_entities'].shape[0])
+
+        for content, content_offsets, name in [(self.entity_content, self.entity_content_offsets, 'entity_content'),
+                                               (self.entity_title, self.entity_title_offsets, 'entity_title'),
+                                               (self.relation_title, self.relation_title_offsets, 'relation_title')]:
+            _values, _offsets = bundle.content_ids(name, self.word_oov)
+            content.load(_values, session)
+            content_offsets.load(_offsets, session)
+
+        for name, _, value_files in self._target_stores():
+            bundle_name = self.BUNDLE_TARGETS[name]
+            self._load_target_store(name, bundle[bundle_name + '.keys'],
+                                    [bundle.csr(bundle_name + suffix) for suffix, _, _ in value_files],
+                                    [v for _, _, v in value_files], session)
+
+        # same index as load_vocab_file
+        self.vocab_dict = dict((w, i - 1) for i, w in enumerate(bundle.strings('vocab')))
+        self.word_embedding.load(load_vocab_embedding(self.word_embed_file, self.vocab_dict, self.word_oov,
+                                                      self.word_embedding_size),
+                                 session=session)
+
+        if self.debug:
+            entity_dict = dict((x, i) for i, x in enumerate(entities))
+            self._sanity_check(entity_dict, session=session)
+            self._sanity_check(dict((x, entity_dict[x]) for x in entities[bundle['avoid_entities']]),
+                               session=session)
+
+    def _target_stores(self):
+        """ Target stores of the model
+
+        :return: list of (target index name, key file, [(bundle array suffix, value file, (values, offsets))])
+        """
+        return [('training_target_tails', self.training_target_tail_key_file,
+                 [('', self.training_target_tail_file,
+                   (self.training_target_tails, self.training_target_tails_offsets))]),
+                ('training_target_heads', self.training_target_head_key_file,
+                 [('', self.training_target_head_file,
+                   (self.training_target_heads, self.training_target_heads_offsets))]),
+                ('evaluation_target_tails', self.evaluation_target_tail_key_file,
+                 [('_open', self.evaluation_open_target_tail_file,
+                   (self.evaluation_open_target_tails, self.evaluation_open_target_tails_offsets)),
+                  ('_closed', self.evaluation_closed_target_tail_file,
+                   (self.evaluation_closed_target_tails, self.evaluation_closed_target_tails_offsets))]),
+                ('evaluation_target_heads', self.evaluation_target_head_key_file,
+                 [('_open', self.evaluation_open_target_head_file,
+                   (self.evaluation_open_target_heads, self.evaluation_open_target_heads_offsets)),
+                  ('_closed', self.evaluation_closed_target_head_file,
+                   (self.evaluation_closed_target_heads, self.evaluation_closed_target_heads_offsets))])]
+
+    def _load_target_store(self, name, keys, targets, variables, session=None):
+        """ Load the int32 [K, 2] (entity, relation) keys and CSR targets of a target store
+
+        :param name: target index name
+        :param keys:
+        :param targets: list of (values, offsets)
+        :param variables: list of (values, offsets) variables
+        :param session:
+        :return:
+        """
+        self.target_index_keys[name].load(keys[:, 0].astype(np.int64) * (1 << 32) + keys[:, 1], session)
+        for (values, offsets), (values_var, offsets_var) in zip(targets, variables):
+            values_var.load(values, session)
+            offsets_var.load(offsets, session)
+        tf.logging.info("%s size %d" % (name, keys.shape[0]))
+
+    def _create_csr_variables(self, name, size):
+        """ Create a CSR int32 store of `size` rows, e.g. word ids of content or target entity ids
+
+        The total number of values is unknown before loading the data so the shape of the
+        value variable is not validated.
+
+        :param name:
+        :param size:
+        :return: values, offsets
+        """
+        values = tf.get_variable(name + "_ids",
+                                 dtype=tf.int32,
+                                 initializer=tf.placeholder_with_default(tf.zeros([0], dtype=tf.int32), [None]),
+                                 validate_shape=False,
+                                 trainable=False,
+                                 collections=[self.NON_TRAINABLE])
+        offsets = tf.get_variable(name + "_offsets",
+                                  [size + 1],
+                                  dtype=tf.int64,
+                                  initializer=tf.zeros_initializer(),
+                                  trainable=False,
+                                  collections=[self.NON_TRAINABLE])
+        tf.logging.debug("[%s] %s offsets shape: %s" % (sys._getframe().f_code.co_name, name, offsets.get_shape()))
+        return values, offsets
+
+    def _create_target_index(self, name, size):
+        """ Create the int64 (entity, relation) keys of a CSR target store with `size` rows and
+        the hash table from keys to rows. The table is filled in initialize() after the keys are loaded.
+
+        :param name:
+        :param size:
+        :return: target index table
+        """
+        keys = tf.get_variable(name + "_keys",
+                               [size],
+                               dtype=tf.int64,
+                               initializer=tf.zeros_initializer(),
+                               trainable=False,
+                               collections=[self.NON_TRAINABLE])
+        table, insert_op = get_target_index_table(keys, name=name + '_index')
+        self.target_index_keys[name] = keys
+        self.target_index_init_ops.append(insert_op)
+        return table
+
     def _create_nontrainable_variables(self):
         """ Non trainable variables/constants.
 
@@ -208,11 +357,12 @@ class ContentModel(object):
 
         with tf.device('/cpu:0'):
             with tf.variable_scope(self.non_trainable_scope):
-                # str names of triples
+                # (head, relation, tail) ids of triples
                 _n_training_triples = count_line(self.train_file)
                 self.training_triples = tf.get_variable("training_triples",
-                                                        initializer=[["", "", ""]] * _n_training_triples,
-                                                        dtype=tf.string,
+                                                        [_n_training_triples, 3],
+                                                        dtype=tf.int32,
+                                                        initializer=tf.zeros_initializer(),
                                                         trainable=False,
                                                         collections=[self.NON_TRAINABLE])
                 tf.logging.debug("[%s] training_triples shape: %s" % (
@@ -257,159 +407,59 @@ class ContentModel(object):
                                                        size=self.n_relation,
                                                        name='relation_lookup_table')
 
-                _str_initializer = [""] * self.n_entity
-                # content matrix of each entity
-                self.entity_content = tf.get_variable("entity_content_matrix",
-                                                      dtype=tf.string,
-                                                      initializer=_str_initializer,
-                                                      trainable=False,
-                                                      collections=[self.NON_TRAINABLE])
-                tf.logging.debug("[%s] entity_content shape: %s" % (
-                    sys._getframe().f_code.co_name,
-                    self.entity_content.get_shape()
-                ))
-                # content length of each entity
-                self.entity_content_len = tf.get_variable("entity_content_len",
-                                                          [self.n_entity],
-                                                          dtype=tf.int32,
-                                                          trainable=False,
-                                                          collections=[self.NON_TRAINABLE])
-                tf.logging.debug("[%s] entity_content_len shape: %s" % (
-                    sys._getframe().f_code.co_name,
-                    self.entity_content_len.get_shape()
-                ))
+                # content of all entities as word ids in CSR format, the content of entity i is
+                # entity_content[entity_content_offsets[i]:entity_content_offsets[i + 1]]
+                self.entity_content, self.entity_content_offsets = self._create_csr_variables(
+                    "entity_content", self.n_entity)
                 # entity title
-                self.entity_title = tf.get_variable("entity_title_matrix",
-                                                    dtype=tf.string,
-                                                    initializer=_str_initializer,
-                                                    trainable=False,
-                                                    collections=[self.NON_TRAINABLE])
-                tf.logging.debug("[%s] entity_title shape: %s" % (
-                    sys._getframe().f_code.co_name,
-                    self.entity_title.get_shape()
-                ))
-                self.entity_title_len = tf.get_variable("entity_title_len",
-                                                        [self.n_entity],
-                                                        dtype=tf.int32,
-                                                        trainable=False,
-                                                        collections=[self.NON_TRAINABLE])
-                tf.logging.debug("[%s] entity_title_len shape: %s" % (
-                    sys._getframe().f_code.co_name,
-                    self.entity_title_len.get_shape()
-                ))
+                self.entity_title, self.entity_title_offsets = self._create_csr_variables(
+                    "entity_title", self.n_entity)
                 # relation title
-                self.relation_title = tf.get_variable("relation_title_matrix",
-                                                      dtype=tf.string,
-                                                      initializer=[""] * self.n_relation,
-                                                      trainable=False,
-                                                      collections=[self.NON_TRAINABLE])
-                tf.logging.debug("[%s] relation_title shape: %s" % (
-                    sys._getframe().f_code.co_name,
-                    self.relation_title.get_shape()
-                ))
-                self.relation_title_len = tf.get_variable("relation_title_len",
-                                                          [self.n_relation],
-                                                          dtype=tf.int32,
-                                                          trainable=False,
-                                                          collections=[self.NON_TRAINABLE])
-                tf.logging.debug("[%s] relation_title_len shape: %s" % (
-                    sys._getframe().f_code.co_name,
-                    self.relation_title_len.get_shape()
-                ))
-                self.vocab_table = get_lookup_table(self.vocab_file,
-                                                    oov_buckets=self.word_oov,
-                                                    size=self.n_vocab,
-                                                    name='vocab_lookup_table')
+                self.relation_title, self.relation_title_offsets = self._create_csr_variables(
+                    "relation_title", self.n_relation)
+
+                # Targets are stored as entity ids in CSR format, one row per (entity, relation) key,
+                # and the target index tables map int64 (entity, relation) keys to rows
+                self.target_index_keys = dict()
+                self.target_index_init_ops = list()
 
                 # target tails, use this to get true targets
-                _n_training_target_tails = count_line(self.training_target_tail_file)
+                _n_training_target_tails = count_line(self.training_target_tail_key_file)
                 # Need to be initialized
-                self.training_target_tails = tf.get_variable("training_target_tails",
-                                                             dtype=tf.string,
-                                                             initializer=[""] * _n_training_target_tails,
-                                                             trainable=False,
-                                                             collections=[self.NON_TRAINABLE])
-                tf.logging.debug("[%s] training_target_tails shape: %s" % (
-                    sys._getframe().f_code.co_name,
-                    self.training_target_tails.get_shape()
-                ))
-                self.training_target_tails_table = get_lookup_table(self.training_target_tail_key_file,
-                                                                    oov_buckets=0,
-                                                                    name='training_target_tails_lookup_table')
+                self.training_target_tails, self.training_target_tails_offsets = self._create_csr_variables(
+                    "training_target_tails", _n_training_target_tails)
+                self.training_target_tails_table = self._create_target_index("training_target_tails",
+                                                                             _n_training_target_tails)
 
                 # target heads, use this to get true targets
-                _n_training_target_heads = count_line(self.training_target_head_file)
+                _n_training_target_heads = count_line(self.training_target_head_key_file)
                 # Need to be initialized
-                self.training_target_heads = tf.get_variable("training_target_heads",
-                                                             dtype=tf.string,
-                                                             initializer=[""] * _n_training_target_heads,
-                                                             trainable=False,
-                                                             collections=[self.NON_TRAINABLE])
-                tf.logging.debug("[%s] training_target_heads shape: %s" % (
-                    sys._getframe().f_code.co_name,
-                    self.training_target_heads.get_shape()
-                ))
-
-                self.training_target_heads_table = get_lookup_table(self.training_target_head_key_file,
-                                                                    oov_buckets=0,
-                                                                    name='training_target_heads_lookup_table')
+                self.training_target_heads, self.training_target_heads_offsets = self._create_csr_variables(
+                    "training_target_heads", _n_training_target_heads)
+                self.training_target_heads_table = self._create_target_index("training_target_heads",
+                                                                             _n_training_target_heads)
 
                 # The evaluation target files contains all the target information, so this is a superset of
                 #  the training target files which only contains the information in the training data
-                _n_evaluation_open_target_tails = count_line(self.evaluation_open_target_tail_file)
-                _n_evaluation_closed_target_tails = count_line(self.evaluation_closed_target_tail_file)
+                _n_evaluation_target_tails = count_line(self.evaluation_target_tail_key_file)
                 # all targets not seen during training
-                self.evaluation_open_target_tails = tf.get_variable("evaluation_open_target_tails",
-                                                                    dtype=tf.string,
-                                                                    initializer=[""] * _n_evaluation_open_target_tails,
-                                                                    trainable=False,
-                                                                    collections=[self.NON_TRAINABLE])
-                tf.logging.debug("[%s] evaluation_open_target_tails shape: %s" % (
-                    sys._getframe().f_code.co_name,
-                    self.evaluation_open_target_tails.get_shape()
-                ))
+                self.evaluation_open_target_tails, self.evaluation_open_target_tails_offsets = \
+                    self._create_csr_variables("evaluation_open_target_tails", _n_evaluation_target_tails)
                 # all targets seen during training
-                self.evaluation_closed_target_tails = tf.get_variable("evaluation_closed_target_tails",
-                                                                      dtype=tf.string,
-                                                                      initializer=[
-                                                                                      ""] * _n_evaluation_closed_target_tails,
-                                                                      trainable=False,
-                                                                      collections=[self.NON_TRAINABLE])
-                tf.logging.debug("[%s] evaluation_closed_target_tails shape: %s" % (
-                    sys._getframe().f_code.co_name,
-                    self.evaluation_closed_target_tails.get_shape()
-                ))
-                self.evaluation_target_tails_table = get_lookup_table(self.evaluation_target_tail_key_file,
-                                                                      oov_buckets=0,
-                                                                      name='evaluation_target_tails_lookup_table')
+                self.evaluation_closed_target_tails, self.evaluation_closed_target_tails_offsets = \
+                    self._create_csr_variables("evaluation_closed_target_tails", _n_evaluation_target_tails)
+                self.evaluation_target_tails_table = self._create_target_index("evaluation_target_tails",
+                                                                               _n_evaluation_target_tails)
 
-                _n_evaluation_open_target_heads = count_line(self.evaluation_open_target_head_file)
-                _n_evaluation_closed_target_heads = count_line(self.evaluation_closed_target_head_file)
+                _n_evaluation_target_heads = count_line(self.evaluation_target_head_key_file)
                 # all targets not seen during training
-                self.evaluation_open_target_heads = tf.get_variable("evaluation_open_target_heads",
-                                                                    dtype=tf.string,
-                                                                    initializer=[""] * _n_evaluation_open_target_heads,
-                                                                    trainable=False,
-                                                                    collections=[self.NON_TRAINABLE])
-                tf.logging.debug("[%s] evaluation_open_target_heads shape: %s" % (
-                    sys._getframe().f_code.co_name,
-                    self.evaluation_open_target_heads.get_shape()
-                ))
+                self.evaluation_open_target_heads, self.evaluation_open_target_heads_offsets = \
+                    self._create_csr_variables("evaluation_open_target_heads", _n_evaluation_target_heads)
                 # all targets seen during training
-                self.evaluation_closed_target_heads = tf.get_variable("evaluation_closed_target_heads",
-                                                                      dtype=tf.string,
-                                                                      initializer=[
-                                                                                      ""] * _n_evaluation_closed_target_heads,
-                                                                      trainable=False,
-                                                                      collections=[self.NON_TRAINABLE])
-                tf.logging.debug("[%s] evaluation_closed_target_heads shape: %s" % (
-                    sys._getframe().f_code.co_name,
-                    self.evaluation_closed_target_heads.get_shape()
-                ))
-                # all targets missing during training
-                self.evaluation_target_heads_table = get_lookup_table(self.evaluation_target_head_key_file,
-                                                                      oov_buckets=0,
-                                                                      name='evaluation_target_heads_lookup_table')
+                self.evaluation_closed_target_heads, self.evaluation_closed_target_heads_offsets = \
+                    self._create_csr_variables("evaluation_closed_target_heads", _n_evaluation_target_heads)
+                self.evaluation_target_heads_table = self._create_target_index("evaluation_target_heads",
+                                                                               _n_evaluation_target_heads)
 
                 self.global_step = tf.Variable(0, trainable=False,
                                                collections=[self.NON_TRAINABLE],
@@ -423,68 +473,116 @@ class ContentModel(object):
                                                       dtype=tf.float32,
                                                       initializer=layers.xavier_initializer())
 
-    def _create_training_input_pipeline(self, num_epoch=10, batch_size=200, sampled_true=1, sampled_false=10):
+    def _create_training_input_pipeline(self, num_epoch=10, batch_size=200, sampled_true=1, sampled_false=10,
+                                        num_parallel_calls=4, prefetch_batches=4,
+                                        shared_negatives=0, in_batch_negatives=False, num_hard_negatives=0,
+                                        group_by_relation=False):
         """
 
+        :param shared_negatives: if larger than 0 or in_batch_negatives is True, the batch shares
+            one pool of negatives instead of sampled_false negatives per triple,
+            see corrupt_batch_w_shared_negatives
+        :param num_hard_negatives: number of the sampled_false negatives taken from the hard negative caches,
+            see mix_hard_negatives
+        :param group_by_relation: if True, all triples in a batch have the same relation
         :return:
-            corrupt_head: [None] TF boolean
-            ent: [None] scalar
-            rel: [None] scalar
-            true_targets: [None, sampled_true]
-            false_targets: [None, sampled_false]
+            corrupt_head: [batch_size] TF boolean
+            ent: [batch_size] scalar
+            rel: [batch_size] scalar
+            true_targets: [batch_size, sampled_true]
+            false_targets: [batch_size, sampled_false]
+          or with shared negatives
+            corrupt_head, ent, rel, true_targets
+            negatives: [n_negatives]
+            negative_mask: [batch_size, n_negatives] TF boolean
         """
 
         with tf.device('/cpu:0'):
             # TODO: check if the variable scope is useless because there is no new variables here
             with tf.variable_scope(self.training_input_scope):
-                input_triples = tf.train.limit_epochs(self.training_triples,
-                                                      num_epochs=num_epoch,
-                                                      name='limited_training_triples')
-
-                # Extract a single h,r,t triple from the input_triples
-                single_triple = tf.train.shuffle_batch([input_triples],
-                                                       batch_size=1,
-                                                       capacity=batch_size * 40,
-                                                       min_after_dequeue=batch_size * 35,
-                                                       enqueue_many=True,
-                                                       num_threads=1,
-                                                       allow_smaller_final_batch=False,
-                                                       name='single_training_shuffle_batch')
-
-                # For a single triple, corrupt it and generate the corrupted training data
-                # Input <h, r, t>
-                # A .5 probability to corrupt on either h or t
-                # Based on the corruption target,
-                #   select num_true positive targets **with replacement**
-                #   and num_sampled negative targets without replacement
-                #       and avoid all positive targets and unseen masks (self.avoid_entities)
-
-                # After here the entities and relationships are numerical ids
-                corrupt_head, ent, rel, true_targets, false_targets = corrupt_single_entity_w_multiple_targets(
-                    single_triple,
-                    self.training_target_tails_table,
-                    self.training_target_heads_table,
-                    self.training_target_tails,
-                    self.training_target_heads,
-                    self.avoid_entities,
-                    self.entity_table,
-                    self.relation_table,
-                    self.n_entity - 1,
-                    sampled_true,
-                    sampled_false)
-
-                tf.logging.info("training pipeline shapes corrupt_head %s, "
-                                "ent %s, rel %s, true_targets %s, false_targets %s" %
-                                tuple([x.get_shape() for x in [corrupt_head, ent, rel, true_targets, false_targets]]))
-
-                q = tf.train.batch([corrupt_head, ent, rel, true_targets, false_targets],
-                                   batch_size=batch_size,
-                                   num_threads=1,
-                                   capacity=batch_size * 40,
-                                   enqueue_many=False,
-                                   allow_smaller_final_batch=False,
-                                   name='corrupted_training_queue')
-
+                # Batches of h,r,t triples, the training triples are fully shuffled in every epoch
+                if group_by_relation:
+                    # Every batch only has triples of one relation, so the relation is transformed once per batch.
+                    # Triples left in a window at the end of the training are dropped.
+                    batch_indices = shuffled_indices(self.training_triples.get_shape()[0].value,
+                                                     num_epoch, name='training_triple_indices')
+                    batch_indices = batch_indices.apply(tf.contrib.data.group_by_window(
+                        key_func=lambda i: tf.cast(self.training_triples[i, 1], tf.int64),
+                        reduce_func=lambda _, window: window.batch(batch_size),
+                        window_size=batch_size))
+                    batch_indices = batch_indices.filter(lambda x: tf.equal(tf.shape(x)[0], batch_size))
+                else:
+                    batch_indices = shuffled_indices(self.training_triples.get_shape()[0].value,
+                                                     num_epoch, batch_size=batch_size,
+                                                     name='training_triple_indices')
+
+                use_shared_negatives = shared_negatives > 0 or in_batch_negatives
+
+                def _corrupt_batch(indices):
+                    # Corrupt the whole batch and generate the corrupted training data
+                    # Input <h, r, t>
+                    # A .5 probability to corrupt on either h or t
+                    # Based on the corruption target,
+                    #   select num_true positive targets **with replacement**
+                    #   and num_sampled negative targets without replacement
+                    #       from the closed entities (self.closed_entities) and avoid all positive targets
+                    if use_shared_negatives:
+                        return corrupt_batch_w_shared_negatives(
+                            tf.gather(self.training_triples, indices),
+                            self.training_target_tails_table,
+                            self.training_target_heads_table,
+                            self.training_target_tails,
+                            self.training_target_tails_offsets,
+                            self.training_target_heads,
+                            self.training_target_heads_offsets,
+                            self.closed_entities,
+                            sampled_true,
+                            shared_negatives,
+                            in_batch=in_batch_negatives)
+                    corrupt_head, ent, rel, true_targets, false_targets = corrupt_batch_w_multiple_targets(
+                        tf.gather(self.training_triples, indices),
+                        self.training_target_tails_table,
+                        self.training_target_heads_table,
+                        self.training_target_tails,
+                        self.training_target_tails_offsets,
+                        self.training_target_heads,
+                        self.training_target_heads_offsets,
+                        self.closed_entities,
+                        sampled_true,
+                        sampled_false)
+                    if num_hard_negatives > 0:
+                        false_targets = mix_hard_negatives(corrupt_head, ent, rel, false_targets,
+                                                           self.training_target_tails_table,
+                                                           self.training_target_heads_table,
+                                                           self.hard_negative_tails,
+                                                           self.hard_negative_heads,
+                                                           num_hard_negatives)
+                    return corrupt_head, ent, rel, true_targets, false_targets
+
+                # Corruption runs on num_parallel_calls batches at once and
+                # prefetch_batches corrupted batches are kept ready for the model
+                dataset = batch_indices.map(_corrupt_batch, num_parallel_calls=num_parallel_calls)
+                dataset = dataset.prefetch(prefetch_batches)
+
+                # The iterator captures the non-trainable variables so it is initialized
+                # after they are loaded, see initialize()
+                iterator = dataset.make_initializable_iterator()
+                self.training_iterator_init_ops.append(iterator.initializer)
+
+                q = list(iterator.get_next())
+                if use_shared_negatives:
+                    n_negatives = shared_negatives + (batch_size * sampled_true if in_batch_negatives else 0)
+                    shapes = [[batch_size], [batch_size], [batch_size],
+                              [batch_size, sampled_true], [n_negatives], [batch_size, n_negatives]]
+                else:
+                    shapes = [[batch_size], [batch_size], [batch_size],
+                              [batch_size, sampled_true], [batch_size, sampled_false]]
+                for x, shape in zip(q, shapes):
+                    x.set_shape(shape)
+
+                tf.logging.info("training pipeline shapes %s" % [x.get_shape() for x in q])
+
+                self.training_inputs.extend(q)
                 return q
 
     @staticmethod
@@ -514,6 +612,16 @@ class ContentModel(object):
 
                 return transformed_ents
 
+    def _content_length_buckets(self, entities, transform, name=None):
+        """ Run `transform` on 1-D entities in buckets of their content lengths, see bucketed_transform """
+        if not self.content_bucket_boundaries:
+            return transform(entities)
+        with tf.name_scope(name, 'content_length_buckets', [entities, self.entity_content_offsets]):
+            rows = tf.cast(entities, tf.int64)
+            content_len = tf.gather(self.entity_content_offsets, rows + 1) - tf.gather(
+                self.entity_content_offsets, rows)
+            return bucketed_transform(entities, content_len, self.content_bucket_boundaries, transform)
+
     def _transform_head_entity(self, heads, reuse=True, device='/cpu:0', name=None):
         """
 
@@ -525,40 +633,41 @@ class ContentModel(object):
         """
         with tf.name_scope(name, 'transform_head_entity',
                            [heads, self.word_embedding,
-                            self.vocab_table,
-                            self.entity_content, self.entity_content_len,
-                            self.entity_title, self.entity_title_len]):
+                            self.entity_content, self.entity_content_offsets,
+                            self.entity_title, self.entity_title_offsets]):
             tf.logging.debug("[%s] heads shape %s" % (sys._getframe().f_code.co_name,
                                                       heads.get_shape()))
 
             with tf.variable_scope(self.head_scope, reuse=reuse):
-                flatten_heads = tf.reshape(heads, [-1], name='flatten_heads')
-                orig_head_shape = tf.shape(heads, name='orig_head_shape')
-                head_content_embedding, head_content_len = entity_content_embedding_lookup(entities=flatten_heads,
-                                                                                           content=self.entity_content,
-                                                                                           content_len=self.entity_content_len,
-                                                                                           vocab_table=self.vocab_table,
-                                                                                           word_embedding=self.word_embedding,
-                                                                                           str_pad=self.PAD,
-                                                                                           name='head_content_embedding_lookup')
-
-                head_title_embedding, head_title_len = entity_content_embedding_lookup(entities=flatten_heads,
-                                                                                       content=self.entity_title,
-                                                                                       content_len=self.entity_title_len,
-                                                                                       vocab_table=self.vocab_table,
-                                                                                       word_embedding=self.word_embedding,
-                                                                                       str_pad=self.PAD,
-                                                                                       name='head_title_embedding_lookup')
-
-                pad_word_embedding = self.word_embedding[tf.cast(self.vocab_table.lookup(self.PAD_const), tf.int32), :]
-                transformed_heads = self._entity_word_averaging(content_embedding=head_content_embedding,
-                                                                content_len=head_content_len,
-                                                                title_embedding=head_title_embedding,
-                                                                title_len=head_title_len,
-                                                                padding_word_embedding=pad_word_embedding,
-                                                                orig_shape=orig_head_shape,
-                                                                device=device)
-                return transformed_heads
+                # Each entity is only looked up and averaged once, in buckets of content lengths
+                def _transform_unique_heads(unique_heads):
+                    head_content_embedding, head_content_len = ragged_entity_content_embedding_lookup(entities=unique_heads,
+                                                                                                      content=self.entity_content,
+                                                                                                      content_offsets=self.entity_content_offsets,
+                                                                                                      word_embedding=self.word_embedding,
+                                                                                                      pad_id=self.PAD_ID,
+                                                                                                      name='head_content_embedding_lookup')
+
+                    head_title_embedding, head_title_len = ragged_entity_content_embedding_lookup(entities=unique_heads,
+                                                                                                  content=self.entity_title,
+                                                                                                  content_offsets=self.entity_title_offsets,
+                                                                                                  word_embedding=self.word_embedding,
+                                                                                                  pad_id=self.PAD_ID,
+                                                                                                  name='head_title_embedding_lookup')
+
+                    pad_word_embedding = self.word_embedding[self.PAD_ID, :]
+                    transformed_heads = self._entity_word_averaging(content_embedding=head_content_embedding,
+                                                                    content_len=head_content_len,
+                                                                    title_embedding=head_title_embedding,
+                                                                    title_len=head_title_len,
+                                                                    padding_word_embedding=pad_word_embedding,
+                                                                    orig_shape=tf.shape(unique_heads),
+                                                                    device=device)
+                    return transformed_heads
+
+                return transform_unique(heads,
+                                        lambda x: self._content_length_buckets(x, _transform_unique_heads),
+                                        name='unique_heads')
 
     def _transform_tail_entity(self, tails, reuse=True, device='/cpu:0', name=None):
         """
@@ -571,40 +680,41 @@ class ContentModel(object):
         """
         with tf.name_scope(name, 'transform_tail_entity',
                            [tails, self.word_embedding,
-                            self.vocab_table,
-                            self.entity_content, self.entity_content_len,
-                            self.entity_title, self.entity_title_len]):
+                            self.entity_content, self.entity_content_offsets,
+                            self.entity_title, self.entity_title_offsets]):
             tf.logging.debug("[%s] heads shape %s" % (sys._getframe().f_code.co_name,
                                                       tails.get_shape()))
 
             with tf.variable_scope(self.tail_scope, reuse=reuse):
-                flatten_tails = tf.reshape(tails, [-1], name='flatten_tails')
-                orig_tail_shape = tf.shape(tails, name='orig_tail_shape')
-                tail_content_embedding, tail_content_len = entity_content_embedding_lookup(entities=flatten_tails,
-                                                                                           content=self.entity_content,
-                                                                                           content_len=self.entity_content_len,
-                                                                                           vocab_table=self.vocab_table,
-                                                                                           word_embedding=self.word_embedding,
-                                                                                           str_pad=self.PAD,
-                                                                                           name='tail_content_embedding_lookup')
-
-                tail_title_embedding, tail_title_len = entity_content_embedding_lookup(entities=flatten_tails,
-                                                                                       content=self.entity_title,
-                                                                                       content_len=self.entity_title_len,
-                                                                                       vocab_table=self.vocab_table,
-                                                                                       word_embedding=self.word_embedding,
-                                                                                       str_pad=self.PAD,
-                                                                                       name='tail_title_embedding_lookup')
-                pad_word_embedding = self.word_embedding[tf.cast(self.vocab_table.lookup(self.PAD_const), tf.int32), :]
-                transformed_tails = self._entity_word_averaging(content_embedding=tail_content_embedding,
-                                                                content_len=tail_content_len,
-                                                                title_embedding=tail_title_embedding,
-                                                                title_len=tail_title_len,
-                                                                padding_word_embedding=pad_word_embedding,
-                                                                orig_shape=orig_tail_shape,
-                                                                device=device)
-
-                return transformed_tails
+                # Each entity is only looked up and averaged once, in buckets of content lengths
+                def _transform_unique_tails(unique_tails):
+                    tail_content_embedding, tail_content_len = ragged_entity_content_embedding_lookup(entities=unique_tails,
+                                                                                                      content=self.entity_content,
+                                                                                                      content_offsets=self.entity_content_offsets,
+                                                                                                      word_embedding=self.word_embedding,
+                                                                                                      pad_id=self.PAD_ID,
+                                                                                                      name='tail_content_embedding_lookup')
+
+                    tail_title_embedding, tail_title_len = ragged_entity_content_embedding_lookup(entities=unique_tails,
+                                                                                                  content=self.entity_title,
+                                                                                                  content_offsets=self.entity_title_offsets,
+                                                                                                  word_embedding=self.word_embedding,
+                                                                                                  pad_id=self.PAD_ID,
+                                                                                                  name='tail_title_embedding_lookup')
+                    pad_word_embedding = self.word_embedding[self.PAD_ID, :]
+                    transformed_tails = self._entity_word_averaging(content_embedding=tail_content_embedding,
+                                                                    content_len=tail_content_len,
+                                                                    title_embedding=tail_title_embedding,
+                                                                    title_len=tail_title_len,
+                                                                    padding_word_embedding=pad_word_embedding,
+                                                                    orig_shape=tf.shape(unique_tails),
+                                                                    device=device)
+
+                    return transformed_tails
+
+                return transform_unique(tails,
+                                        lambda x: self._content_length_buckets(x, _transform_unique_tails),
+                                        name='unique_tails')
 
     def _transform_relation(self, rels, reuse=True, device='/cpu:0', name=None):
         """
@@ -616,31 +726,30 @@ class ContentModel(object):
         :return:
         """
         with tf.name_scope(name, 'transform_relation',
-                           [rels, self.word_embedding, self.vocab_table,
-                            self.relation_title, self.relation_title_len]):
+                           [rels, self.word_embedding,
+                            self.relation_title, self.relation_title_offsets]):
             tf.logging.debug("[%s] rels shape %s" % (sys._getframe().f_code.co_name,
                                                      rels.get_shape()))
 
             # Here we assume that input relation is always [?, 1] or [?]
             rels = tf.reshape(rels, [-1], name='flatten_rels')
-            orig_rels_shape = tf.shape(rels, name='orig_rels_shape')
 
-            rel_embedding, rel_title_len = entity_content_embedding_lookup(entities=rels,
-                                                                           content=self.relation_title,
-                                                                           content_len=self.relation_title_len,
-                                                                           vocab_table=self.vocab_table,
-                                                                           word_embedding=self.word_embedding,
-                                                                           str_pad=self.PAD,
-                                                                           name='rel_embedding_lookup')
+            # A batch only has a few distinct relations, so each one is only looked up and averaged once
+            def _transform_unique_rels(unique_rels):
+                rel_embedding, rel_title_len = ragged_entity_content_embedding_lookup(entities=unique_rels,
+                                                                                      content=self.relation_title,
+                                                                                      content_offsets=self.relation_title_offsets,
+                                                                                      word_embedding=self.word_embedding,
+                                                                                      pad_id=self.PAD_ID,
+                                                                                      name='rel_embedding_lookup')
+
+                with tf.device(device):
+                    return avg_content(rel_embedding, rel_title_len,
+                                       self.word_embedding[0, :],
+                                       name='avg_rel_embedding')
 
             with tf.device(device):
-                avg_rel_embedding = avg_content(rel_embedding, rel_title_len,
-                                                self.word_embedding[0, :],
-                                                name='avg_rel_embedding')
-                orig_rel_embedding_shape = tf.concat([orig_rels_shape, tf.shape(avg_rel_embedding)[1:]], axis=0,
-                                                     name='orig_rel_embedding_shape')
-                transformed_rels = tf.reshape(avg_rel_embedding, orig_rel_embedding_shape,
-                                              name='transformed_tail_embedding')
+                transformed_rels = transform_unique(rels, _transform_unique_rels, name='unique_rels')
                 tf.logging.debug("[%s] transformed_rels shape %s" % (sys._getframe().f_code.co_name,
                                                                      transformed_rels.get_shape()))
                 return transformed_rels
@@ -663,7 +772,7 @@ class ContentModel(object):
                     # return transformed_heads + tf.expand_dims(transformed_rels, axis=1)
                     return transformed_heads + tf.expand_dims(transformed_rels, axis=1)
 
-    def _predict(self, combined_head_rel, tails, reuse=True, device='/cpu:0', name=None):
+    def _predict(self, combined_head_rel, tails, reuse=True, device='/cpu:0', name=None, normalized_tails=False):
         """
 
         :param combined_head_rel: [?, ?, word_dim]
@@ -671,14 +780,16 @@ class ContentModel(object):
         :param reuse:
         :param device:
         :param name:
+        :param normalized_tails: tails are already normalized, e.g. materialized entity embeddings
         :return:
         """
         with tf.name_scope(name, 'predict',
                            [combined_head_rel, tails]):
             with tf.variable_scope(self.pred_scope, reuse=reuse):
                 with tf.device(device):
-                    combined_head_rel, tails = [tf.check_numerics(normalized_embedding(x), '__predict') for x in
-                                                [combined_head_rel, tails]]
+                    combined_head_rel = tf.check_numerics(normalized_embedding(combined_head_rel), '__predict')
+                    if not normalized_tails:
+                        tails = tf.check_numerics(normalized_embedding(tails), '__predict')
                     return tf.reduce_sum(combined_head_rel * tails, axis=-1)
 
     def translate_triple(self, heads, tails, rels, device, reuse=True):
@@ -706,6 +817,107 @@ class ContentModel(object):
 
             return self._predict(combined_head_rel, transformed_tails, reuse=True, device=device)
 
+    def _predict_shared(self, combined_head_rel, tails, reuse=True, device='/cpu:0', name=None,
+                        normalized_tails=False):
+        """ Same as _predict but every combined head and relation is scored with all tails
+
+        :param combined_head_rel: [?, word_dim]
+        :param tails: [n_tails, word_dim]
+        :param reuse:
+        :param device:
+        :param name:
+        :param normalized_tails: tails are already normalized
+        :return: [?, n_tails]
+        """
+        with tf.name_scope(name, 'predict_shared',
+                           [combined_head_rel, tails]):
+            with tf.variable_scope(self.pred_scope, reuse=reuse):
+                with tf.device(device):
+                    combined_head_rel = tf.check_numerics(normalized_embedding(combined_head_rel), '__predict_shared')
+                    if not normalized_tails:
+                        tails = tf.check_numerics(normalized_embedding(tails), '__predict_shared')
+                    return tf.matmul(combined_head_rel, tails, transpose_b=True)
+
+    def _corrupted_scores(self, corrupt_head, ent, rel, targets, device):
+        """ Scores of each triple with its own targets as the corrupted entity
+
+        :param corrupt_head: [?] bool
+        :param ent: [?] the tail if corrupt_head otherwise the head
+        :param rel: [?]
+        :param targets: [?, n_targets]
+        :param device:
+        :return: [?, n_targets] the head corrupted triples come first, then the tail corrupted ones
+        """
+        # Convert [?] to [?, 1]
+        ent = tf.expand_dims(ent, axis=1)
+        rel = tf.expand_dims(rel, axis=1)
+
+        # Here we use corrupt_head to separate the input into two sets, head corrupted and tail corrupted
+        # and run the model accordingly
+
+        # This will change the internal order of each example in one mini batch
+        # TODO: Performance: Concatenate all inputs together and then split them, in that case
+        #   the boolean_mask will be applied only once
+
+        corrupt_tail = tf.logical_not(corrupt_head, name='corrupt_tail')
+
+        corrupt_head_pred_score = self.translate_triple(
+            *[tf.boolean_mask(x, corrupt_head) for x in [targets, ent, rel]],
+            device=device)
+
+        corrupt_tail_pred_score = self.translate_triple(
+            *[tf.boolean_mask(x, corrupt_tail) for x in [ent, targets, rel]],
+            device=device)
+
+        tf.logging.debug("[%s] corrupt_head_pred_score shape %s, "
+                         "corrupt_tail_pred_score %s" % (sys._getframe().f_code.co_name,
+                                                         corrupt_head_pred_score.get_shape(),
+                                                         corrupt_tail_pred_score.get_shape()))
+        # TODO: Monitor: Here we could add summaries on the scores of corrupt tails and corrupt heads individually
+        return tf.concat([corrupt_head_pred_score, corrupt_tail_pred_score], axis=0)
+
+    def _shared_negative_scores(self, corrupt_head, ent, rel, negatives, device):
+        """ Scores of each triple with every shared negative as the corrupted entity,
+        each negative is transformed once for the whole batch and used as a head and as a tail,
+        the head and tail transformations of ContentModel are the same.
+
+        :param corrupt_head: [?] bool
+        :param ent: [?] the tail if corrupt_head otherwise the head
+        :param rel: [?]
+        :param negatives: [n_negatives]
+        :param device:
+        :return: [?, n_negatives] in the same order as _corrupted_scores
+        """
+        with tf.name_scope('shared_negative_scores', values=[corrupt_head, ent, rel, negatives]):
+            return self._transformed_negative_scores(corrupt_head, ent, rel,
+                                                     self._transform_tail_entity(negatives, device=device),
+                                                     device=device)
+
+    def _transformed_negative_scores(self, corrupt_head, ent, rel, negative_embeddings, device):
+        """ Same as _shared_negative_scores but the negatives are already transformed
+
+        :param negative_embeddings: [n_negatives, word_dim] transformed negatives
+        """
+        corrupt_tail = tf.logical_not(corrupt_head, name='corrupt_tail')
+
+        # Head corrupted triples, ent is the tail
+        tails = self._transform_tail_entity(tf.expand_dims(tf.boolean_mask(ent, corrupt_head), axis=1),
+                                            device=device)
+        rels = self._transform_relation(tf.boolean_mask(rel, corrupt_head), device=device)
+        corrupt_head_pred_score = self._predict(self._combine_head_relation(tf.expand_dims(negative_embeddings, axis=0),
+                                                                            rels, device=device),
+                                                tails, device=device)
+
+        # Tail corrupted triples, ent is the head
+        heads = self._transform_head_entity(tf.expand_dims(tf.boolean_mask(ent, corrupt_tail), axis=1),
+                                            device=device)
+        rels = self._transform_relation(tf.boolean_mask(rel, corrupt_tail), device=device)
+        combined_head_rel = self._combine_head_relation(heads, rels, device=device)
+        corrupt_tail_pred_score = self._predict_shared(tf.squeeze(combined_head_rel, axis=1),
+                                                       negative_embeddings, device=device)
+
+        return tf.concat([corrupt_head_pred_score, corrupt_tail_pred_score], axis=0)
+
     def _train_helper(self, corrupt_head, ent, rel, true_targets, false_targets, device):
         with tf.name_scope('train', [corrupt_head, ent, rel, true_targets, false_targets]):
             # if corrupt_head, then ent is tail
@@ -715,38 +927,235 @@ class ContentModel(object):
             tf.logging.debug("[%s] targets shape %s" % (sys._getframe().f_code.co_name,
                                                         targets.get_shape()))
 
-            # Convert [?] to [?, 1]
-            rel = tf.expand_dims(rel, axis=1)
-
-            # Here we use corrupt_head to separate the input into two sets, head corrupted and tail corrupted
-            # and run the model accordingly
+            pred_score = self._corrupted_scores(corrupt_head, ent, rel, targets, device=device)
 
-            # This will change the internal order of each example in one mini batch
-            # TODO: Performance: Concatenate all inputs together and then split them, in that case
-            #   the boolean_mask will be applied only once
-
-            corrupt_tail = tf.logical_not(corrupt_head, name='corrupt_tail')
+            tf.logging.debug("[%s] pred_score shape %s" % (sys._getframe().f_code.co_name,
+                                                           pred_score.get_shape()))
 
-            corrupt_head_pred_score = self.translate_triple(
-                *[tf.boolean_mask(x, corrupt_head) for x in [targets, ent, rel]],
-                device=device)
+            return pred_score
 
-            corrupt_tail_pred_score = self.translate_triple(
-                *[tf.boolean_mask(x, corrupt_tail) for x in [ent, targets, rel]],
-                device=device)
+    def _train_helper_w_shared_negatives(self, corrupt_head, ent, rel, true_targets, negatives, negative_mask,
+                                         device):
+        """ Same as _train_helper but the negatives are shared by all triples in the batch,
+        negatives that are true targets of a triple are masked out of its scores
+        """
+        with tf.name_scope('train_w_shared_negatives',
+                           [corrupt_head, ent, rel, true_targets, negatives, negative_mask]):
+            true_pred_score = self._corrupted_scores(corrupt_head, ent, rel, true_targets, device=device)
+            negative_pred_score = self._shared_negative_scores(corrupt_head, ent, rel, negatives, device=device)
+
+            # Reorder the mask the same way as the scores
+            negative_mask = tf.concat([tf.boolean_mask(negative_mask, corrupt_head),
+                                       tf.boolean_mask(negative_mask, tf.logical_not(corrupt_head))], axis=0)
+            with tf.device(device):
+                negative_pred_score -= (1. - tf.cast(negative_mask, tf.float32)) * 1e10
 
-            tf.logging.debug("[%s] corrupt_head_pred_score shape %s, "
-                             "corrupt_tail_pred_score %s" % (sys._getframe().f_code.co_name,
-                                                             corrupt_head_pred_score.get_shape(),
-                                                             corrupt_tail_pred_score.get_shape()))
-            # TODO: Monitor: Here we could add summaries on the scores of corrupt tails and corrupt heads individually
-            pred_score = tf.concat([corrupt_head_pred_score, corrupt_tail_pred_score], axis=0)
+            pred_score = tf.concat([true_pred_score, negative_pred_score], axis=1)
 
             tf.logging.debug("[%s] pred_score shape %s" % (sys._getframe().f_code.co_name,
                                                            pred_score.get_shape()))
 
             return pred_score
 
+    def _create_hard_negative_cache(self, cache_size, device='/cpu:0'):
+        """ Hard negative caches of the training target keys and the ops to refresh them, see refresh_hard_negatives.
+
+        Row i of hard_negative_tails holds the cache_size closed entities with the highest scores as tails
+        of the i-th (head, relation) key of training_target_tails, the true tails are excluded. The same for
+        hard_negative_heads. The scores are calculated with the closed entity embeddings cached by
+        hard_negative_embed_op, one matrix serves as heads and as tails because ContentModel transforms
+        them the same way. The cache is as fresh as the last refresh.
+
+        :param cache_size:
+        :param device:
+        :return:
+        """
+        n_closed = self.closed_entities.get_shape()[0].value
+        with tf.device('/cpu:0'):
+            with tf.variable_scope(self.non_trainable_scope):
+                # Resource variables so the training input pipelines read the latest caches
+                self.hard_negative_tails, self.hard_negative_heads = [
+                    tf.get_variable(name,
+                                    [offsets.get_shape()[0].value - 1, cache_size],
+                                    dtype=tf.int32,
+                                    initializer=tf.constant_initializer(-1),
+                                    trainable=False,
+                                    collections=[self.NON_TRAINABLE],
+                                    use_resource=True)
+                    for name, offsets in [('hard_negative_tails', self.training_target_tails_offsets),
+                                          ('hard_negative_heads', self.training_target_heads_offsets)]]
+
+                # transformed closed entities
+                self.closed_entity_embeddings = tf.get_variable('closed_entity_embeddings',
+                                                                [n_closed, self.word_embedding_size],
+                                                                dtype=tf.float32,
+                                                                initializer=tf.zeros_initializer(),
+                                                                trainable=False,
+                                                                collections=[self.NON_TRAINABLE])
+
+        with tf.name_scope('hard_negatives'):
+            # positions in closed_entities to transform
+            self.ph_hard_negative_entities = tf.placeholder(tf.int32, [None], name='ph_hard_negative_entities')
+            ents = tf.gather(self.closed_entities, self.ph_hard_negative_entities)
+            self.hard_negative_embed_op = tf.scatter_update(self.closed_entity_embeddings,
+                                                            self.ph_hard_negative_entities,
+                                                            self._transform_tail_entity(ents, device=device),
+                                                            name='hard_negative_embed_op')
+
+            # entity id to its position in closed_entities, -1 for open entities
+            closed_positions = tf.scatter_nd(tf.expand_dims(self.closed_entities, axis=1),
+                                             tf.range(1, n_closed + 1), [self.n_entity]) - 1
+
+            # rows of the training target keys to refresh
+            self.ph_hard_negative_rows = tf.placeholder(tf.int32, [None], name='ph_hard_negative_rows')
+            rows = self.ph_hard_negative_rows
+            self.hard_negative_refresh_ops = dict()
+            for name, corrupt_head, cache, targets, target_offsets in [
+                ('training_target_tails', False, self.hard_negative_tails,
+                 self.training_target_tails, self.training_target_tails_offsets),
+                ('training_target_heads', True, self.hard_negative_heads,
+                 self.training_target_heads, self.training_target_heads_offsets)]:
+                keys = tf.gather(self.target_index_keys[name], rows)
+                scores = self._transformed_negative_scores(tf.fill(tf.shape(rows), corrupt_head),
+                                                           tf.cast(keys // (1 << 32), tf.int32),
+                                                           tf.cast(keys % (1 << 32), tf.int32),
+                                                           self.closed_entity_embeddings,
+                                                           device=device)
+
+                # True targets are never hard negatives
+                true_targets, true_lens = ragged_lookup(targets, target_offsets, rows)
+                true_positions = tf.gather(closed_positions, true_targets)
+                is_true = tf.logical_and(tf.sequence_mask(true_lens, tf.shape(true_targets)[1]),
+                                         tf.greater_equal(true_positions, 0))
+                true_idx = tf.boolean_mask(tf.stack([tf.tile(tf.expand_dims(tf.range(tf.shape(rows)[0]), axis=1),
+                                                             [1, tf.shape(true_targets)[1]]),
+                                                     true_positions], axis=2), is_true)
+                true_count = tf.scatter_nd(true_idx, tf.ones([tf.shape(true_idx)[0]]), tf.shape(scores))
+                with tf.device(device):
+                    _, top_positions = tf.nn.top_k(scores - true_count * 1e10, k=cache_size)
+
+                self.hard_negative_refresh_ops[name] = tf.scatter_update(cache, rows,
+                                                                         tf.gather(self.closed_entities, top_positions),
+                                                                         name=name + '_hard_negative_refresh')
+
+    def refresh_hard_negatives(self, session, entity_batch_size=1000, key_batch_size=64, key_fraction=0.05):
+        """ Transform the closed entities with the current model and refresh the hard negative caches
+        of the next key_fraction of the training target keys.
+
+        Each key is scored against all closed entities, so only a slice of the keys is refreshed per call
+        and the slices rotate over the keys, every key is refreshed once every 1 / key_fraction calls.
+
+        :param session:
+        :param entity_batch_size: number of closed entities transformed per run
+        :param key_batch_size: number of keys scored against all closed entities per run
+        :param key_fraction: fraction of the keys refreshed per call
+        :return:
+        """
+        n_closed = self.closed_entities.get_shape()[0].value
+        for start in range(0, n_closed, entity_batch_size):
+            session.run(self.hard_negative_embed_op,
+                        feed_dict={self.ph_hard_negative_entities: np.arange(start,
+                                                                             min(start + entity_batch_size, n_closed))})
+
+        for name, refresh_op in self.hard_negative_refresh_ops.items():
+            n_keys = self.target_index_keys[name].get_shape()[0].value
+            first = self.hard_negative_refresh_start.get(name, 0)
+            n_rows = min(int(np.ceil(n_keys * key_fraction)), n_keys)
+            rows = (np.arange(first, first + n_rows) % max(n_keys, 1)).astype(np.int32)
+            self.hard_negative_refresh_start[name] = (first + n_rows) % max(n_keys, 1)
+            for start in range(0, rows.shape[0], key_batch_size):
+                session.run(refresh_op, feed_dict={self.ph_hard_negative_rows: rows[start:start + key_batch_size]})
+            tf.logging.info("Refreshed hard negatives of %d %s keys" % (rows.shape[0], name))
+
+    def _create_entity_embedding_cache(self, device='/cpu:0'):
+        """ Create the [n_entity, word_dim] entity embeddings used by the evaluation instead of
+        transforming the entities again for every batch, fill them with materialize_entity_embeddings.
+
+        The head and the tail transformations are the same and do not depend on the relation, so
+        each entity is stored once as its normalized embedding, as _predict uses the tails, and
+        its norm, to get back the head embedding.
+
+        :param device:
+        :return:
+        """
+        if self.normalized_entity_embeddings is not None:
+            return
+
+        with tf.device(device):
+            with tf.variable_scope(self.non_trainable_scope):
+                self.normalized_entity_embeddings = tf.get_variable('normalized_entity_embeddings',
+                                                                    [self.n_entity, self.word_embedding_size],
+                                                                    dtype=tf.float32,
+                                                                    initializer=tf.zeros_initializer(),
+                                                                    trainable=False,
+                                                                    collections=[self.NON_TRAINABLE])
+                self.entity_embedding_norms = tf.get_variable('entity_embedding_norms',
+                                                              [self.n_entity],
+                                                              dtype=tf.float32,
+                                                              initializer=tf.ones_initializer(),
+                                                              trainable=False,
+                                                              collections=[self.NON_TRAINABLE])
+
+        with tf.name_scope('materialize_entity_embeddings'):
+            self.ph_materialize_entities = tf.placeholder(tf.int32, [None], name='ph_materialize_entities')
+            embeds = self._transform_tail_entity(self.ph_materialize_entities, device=device)
+            with tf.device(device):
+                # same as normalized_embedding
+                norms = tf.sqrt(tf.reduce_sum(tf.square(embeds), -1), name='norm') + 1e-10
+                self.materialize_entity_op = tf.group(
+                    tf.scatter_update(self.normalized_entity_embeddings, self.ph_materialize_entities,
+                                      embeds / tf.expand_dims(norms, axis=1)),
+                    tf.scatter_update(self.entity_embedding_norms, self.ph_materialize_entities, norms),
+                    name='materialize_entity_op')
+
+    def materialize_entity_embeddings(self, session, batch_size=1000):
+        """ Transform all entities with the current model and store them for the evaluation,
+        run this once after a checkpoint is restored and before the evaluation.
+
+        :param session:
+        :param batch_size: number of entities transformed per run
+        :return:
+        """
+        if self.materialize_entity_op is None:
+            tf.logging.warning("No evaluation ops use the materialized entity embeddings")
+            return
+        for start in range(0, self.n_entity, batch_size):
+            session.run(self.materialize_entity_op,
+                        feed_dict={self.ph_materialize_entities: np.arange(start, min(start + batch_size,
+                                                                                      self.n_entity))})
+        tf.logging.info("Materialized the embeddings of %d entities" % self.n_entity)
+
+    def _materialized_entities(self, ents, normalized=False, device='/cpu:0', name=None):
+        """ Gather the materialized embeddings of the given entities
+
+        :param ents: Any shape
+        :param normalized: return the normalized (tail) embeddings instead of the head embeddings
+        :param device:
+        :param name:
+        :return: [ents.shape, word_dim]
+        """
+        self._create_entity_embedding_cache(device)
+        with tf.name_scope(name, 'materialized_entities', [ents, self.normalized_entity_embeddings]):
+            embeds = tf.gather(self.normalized_entity_embeddings, ents)
+            if normalized:
+                return embeds
+            return embeds * tf.expand_dims(tf.gather(self.entity_embedding_norms, ents), axis=-1)
+
+    def _eval_translate_triple(self, heads, tails, rels, device):
+        """ Same as translate_triple with the materialized entity embeddings """
+        with tf.name_scope('eval_translate_triple'):
+            transformed_heads = self._materialized_entities(heads, device=device)
+            transformed_tails = self._materialized_entities(tails, normalized=True, device=device)
+            transformed_rels = self._transform_relation(rels, reuse=True, device=device)
+
+            combined_head_rel = self._combine_head_relation(transformed_heads=transformed_heads,
+                                                            transformed_rels=transformed_rels,
+                                                            reuse=True,
+                                                            device=device)
+
+            return self._predict(combined_head_rel, transformed_tails, reuse=True, device=device,
+                                 normalized_tails=True)
+
     def create(self, device='/cpu:0'):
         self._create_nontrainable_variables()
         self._create_embeddings(device)
@@ -765,9 +1174,38 @@ class ContentModel(object):
 
     def initialize(self, session):
         self._init_nontrainable_variables(session)
+        # The target index tables can only be filled after the keys are loaded
+        session.run(self.target_index_init_ops)
+        # and the training input pipelines read both
+        session.run(self.training_iterator_init_ops)
 
     def train_ops(self, lr=0.01, num_epoch=10, batch_size=200,
-                  sampled_true=1, sampled_false=1, devices=list(['/cpu:0'])):
+                  sampled_true=1, sampled_false=1, devices=list(['/cpu:0']),
+                  num_parallel_calls=4, prefetch_batches=4,
+                  shared_negatives=0, in_batch_negatives=False,
+                  hard_negative_ratio=0., hard_negative_cache_size=50, group_by_relation=False):
+        """
+
+        :param shared_negatives: size of the negative pool shared by each batch, if this is larger than 0
+            or in_batch_negatives is True then sampled_false is ignored
+        :param in_batch_negatives: also use the true targets of other triples in the batch as negatives
+        :param hard_negative_ratio: fraction of the sampled_false negatives taken from the hard negative caches,
+            call refresh_hard_negatives periodically to update the caches. Not used with shared negatives.
+        :param hard_negative_cache_size: number of cached hard negatives of each (entity, relation)
+        :param group_by_relation: batch the triples of each relation together, so the relation transformations
+            and, in FCNModel, the relation masked entity transformations are shared by the whole batch
+        """
+
+        use_shared_negatives = shared_negatives > 0 or in_batch_negatives
+        if use_shared_negatives:
+            n_negatives = shared_negatives + (batch_size * sampled_true if in_batch_negatives else 0)
+        else:
+            n_negatives = sampled_false
+
+        num_hard_negatives = 0 if use_shared_negatives else min(int(round(hard_negative_ratio * sampled_false)),
+                                                                 hard_negative_cache_size)
+        if num_hard_negatives > 0:
+            self._create_hard_negative_cache(hard_negative_cache_size, device=devices[0])
 
         # If only running on one device then calculate the grads on that device
         if len(devices) == 1:
@@ -790,18 +1228,27 @@ class ContentModel(object):
                 q = self._create_training_input_pipeline(num_epoch=num_epoch,
                                                          batch_size=batch_size,
                                                          sampled_true=sampled_true,
-                                                         sampled_false=sampled_false)
+                                                         sampled_false=sampled_false,
+                                                         num_parallel_calls=num_parallel_calls,
+                                                         prefetch_batches=prefetch_batches,
+                                                         shared_negatives=shared_negatives,
+                                                         in_batch_negatives=in_batch_negatives,
+                                                         num_hard_negatives=num_hard_negatives,
+                                                         group_by_relation=group_by_relation)
 
             with tf.device(device):
-                pred_score = self._train_helper(*q, device=device)
+                if use_shared_negatives:
+                    pred_score = self._train_helper_w_shared_negatives(*q, device=device)
+                else:
+                    pred_score = self._train_helper(*q, device=device)
                 # tiling the labels so it has the same shape as pred_score
-                _labels = [([1.0 / sampled_true] * sampled_true) + ([0.0] * sampled_false)] * batch_size
+                _labels = [([1.0 / sampled_true] * sampled_true) + ([0.0] * n_negatives)] * batch_size
                 labels = tf.constant(_labels, dtype=tf.float32, name='labels')
 
                 tf.logging.debug("[%s] pred_score %s labels %s" % (sys._getframe().f_code.co_name,
                                                                    pred_score.get_shape(),
                                                                    labels.get_shape()))
-                pos_pred, neg_pred = tf.split(pred_score, [sampled_true, sampled_false], axis=1)
+                pos_pred, neg_pred = tf.split(pred_score, [sampled_true, n_negatives], axis=1)
                 avg_positive_scores.append(tf.reduce_mean(pos_pred))
                 avg_negative_scores.append(tf.reduce_mean(neg_pred))
                 # minimum gap between the smallest positive value and the largest negative value
@@ -870,14 +1317,14 @@ class ContentModel(object):
 
         with tf.name_scope(name, "eval_targets", [heads, rels, tails, targets]):
             # targets = tf.expand_dims(targets, [-1])
-            pred_tails = self.translate_triple(heads=heads,
-                                               rels=rels,
-                                               tails=targets,
-                                               device=device)
-            pred_heads = self.translate_triple(heads=targets,
-                                               rels=rels,
-                                               tails=tails,
-                                               device=device)
+            pred_tails = self._eval_translate_triple(heads=heads,
+                                                     rels=rels,
+                                                     tails=targets,
+                                                     device=device)
+            pred_heads = self._eval_translate_triple(heads=targets,
+                                                     rels=rels,
+                                                     tails=tails,
+                                                     device=device)
 
             tf.logging.info("[%s] %s pred_heads %s "
                             "pred_tails %s" % (sys._getframe().f_code.co_name,
@@ -888,14 +1335,14 @@ class ContentModel(object):
             return pred_heads, pred_tails
 
     @staticmethod
-    def _true_target_helper(entity, relation, targets_lookup_table, entity_table, targets, name=None):
+    def _true_target_helper(entity, relation, targets_lookup_table, targets, target_offsets, name=None):
         with tf.name_scope(name, 'true_targets_lookup',
-                           [entity, relation, targets_lookup_table, entity_table, targets]):
+                           [entity, relation, targets, target_offsets]):
             t = get_target_entities(entity=entity,
                                     relation=relation,
                                     targets_lookup_table=targets_lookup_table,
-                                    entity_table=entity_table,
-                                    targets=targets)
+                                    targets=targets,
+                                    target_offsets=target_offsets)
             t_mask = tf.SparseTensor(t.indices,
                                      tf.cast(tf.clip_by_value(t.values, -1, 0), tf.float32) * 1e10,
                                      t.dense_shape)
@@ -914,10 +1361,10 @@ class ContentModel(object):
                                           tails.get_shape(),
                                           masks.get_shape()))
 
-            pred_score = self.translate_triple(heads=heads,
-                                               rels=rels,
-                                               tails=tails,
-                                               device=device)
+            pred_score = self._eval_translate_triple(heads=heads,
+                                                     rels=rels,
+                                                     tails=tails,
+                                                     device=device)
             masked_pred_score = tf.sparse_add(pred_score, masks)
             return masked_pred_score
 
@@ -963,12 +1410,13 @@ class ContentModel(object):
                                                       str_rels.get_shape(),
                                                       str_tails.get_shape()))
 
+                    id_heads, id_rels, id_tails = triple_id_lookup(str_heads,
+                                                                   str_rels,
+                                                                   str_tails,
+                                                                   self.entity_table,
+                                                                   self.relation_table)
                     # Reshape them so they are [b_size, 1]
-                    heads, rels, tails = [tf.expand_dims(x, axis=1) for x in triple_id_lookup(str_heads,
-                                                                                              str_rels,
-                                                                                              str_tails,
-                                                                                              self.entity_table,
-                                                                                              self.relation_table)]
+                    heads, rels, tails = [tf.expand_dims(x, axis=1) for x in [id_heads, id_rels, id_tails]]
 
                     tf.logging.info("[%s] heads %s "
                                     "rels %s "
@@ -978,7 +1426,7 @@ class ContentModel(object):
                                                   tails.get_shape()))
 
                 # Predict score of given triples
-                pred_scores = self.translate_triple(heads, tails, rels, device=device)
+                pred_scores = self._eval_translate_triple(heads, tails, rels, device=device)
                 tf.logging.info("[%s] pred_scores shape %s " % (sys._getframe().f_code.co_name,
                                                                 pred_scores.get_shape()))
 
@@ -1000,25 +1448,25 @@ class ContentModel(object):
                                                                           name='pred_cloesd_targets')
 
                 # Predict score of modifiers
-                closed_tails, closed_tails_mask = get_true_targets(entity=str_heads, relation=str_rels,
+                closed_tails, closed_tails_mask = get_true_targets(entity=id_heads, relation=id_rels,
                                                                    targets_lookup_table=self.evaluation_target_tails_table,
-                                                                   entity_table=self.entity_table,
-                                                                   targets=self.evaluation_closed_target_tails)
+                                                                   targets=self.evaluation_closed_target_tails,
+                                                                   target_offsets=self.evaluation_closed_target_tails_offsets)
 
-                closed_heads, closed_heads_mask = get_true_targets(entity=str_tails, relation=str_rels,
+                closed_heads, closed_heads_mask = get_true_targets(entity=id_tails, relation=id_rels,
                                                                    targets_lookup_table=self.evaluation_target_heads_table,
-                                                                   entity_table=self.entity_table,
-                                                                   targets=self.evaluation_closed_target_heads)
+                                                                   targets=self.evaluation_closed_target_heads,
+                                                                   target_offsets=self.evaluation_closed_target_heads_offsets)
 
-                open_tails, open_tails_mask = get_true_targets(entity=str_heads, relation=str_rels,
+                open_tails, open_tails_mask = get_true_targets(entity=id_heads, relation=id_rels,
                                                                targets_lookup_table=self.evaluation_target_tails_table,
-                                                               entity_table=self.entity_table,
-                                                               targets=self.evaluation_open_target_tails)
+                                                               targets=self.evaluation_open_target_tails,
+                                                               target_offsets=self.evaluation_open_target_tails_offsets)
 
-                open_heads, open_heads_mask = get_true_targets(entity=str_tails, relation=str_rels,
+                open_heads, open_heads_mask = get_true_targets(entity=id_tails, relation=id_rels,
                                                                targets_lookup_table=self.evaluation_target_heads_table,
-                                                               entity_table=self.entity_table,
-                                                               targets=self.evaluation_open_target_heads)
+                                                               targets=self.evaluation_open_target_heads,
+                                                               target_offsets=self.evaluation_open_target_heads_offsets)
 
                 pred_true_open_heads = self._eval_padded_targets(heads=open_heads,
                                                                  rels=rels,
@@ -1124,20 +1572,46 @@ class ContentModel(object):
                                                   name='ent_set_indicator')
             return indicator
 
-    def manual_eval_ops_v2(self, device='/cpu:0'):
+    def _create_target_cache(self, name, width, cache_size_mb, device='/cpu:0'):
+        """ Create a [n_rows, width] variable for the pre-computed targets of the evaluation
+
+        The targets of several relationships stay in the variable at the same time, the returned
+        TargetEmbeddingCache decides which rows each relationship uses.
+
+        :param name:
+        :param width: size of each cached target embedding
+        :param cache_size_mb: memory budget of the variable
+        :param device:
+        :return: the cache variable, TargetEmbeddingCache
+        """
+        # No relationship has more targets than entities
+        n_rows = min(int(cache_size_mb * (1 << 20)) // (4 * width), self.n_entity * self.n_relation)
+        tf.logging.info("%s: cache the targets in %d rows" % (name, n_rows))
+        with tf.device(device):
+            with tf.variable_scope(self.non_trainable_scope):
+                cache = tf.get_variable(name,
+                                        [n_rows, width],
+                                        dtype=tf.float32,
+                                        initializer=tf.zeros_initializer(),
+                                        trainable=False,
+                                        collections=[self.NON_TRAINABLE])
+        return cache, TargetEmbeddingCache(n_rows)
+
+    def manual_eval_ops_v2(self, device='/cpu:0', cache_size_mb=1024):
         """ Manually evaluate one single partial triple with a given set of targets
 
         This function will reduce the computation by reusing the targets of the same
         relationships.
 
-        To use this method, first calculate the transformed tails of all the targets
-        and put them into a pipeline, then for each head, rel pair we fetch these precomputed
-        target representations and do the calculation to get the similarity score.
-
-        After we evaluated one type of relationship, one needs to manually clean up
-        the queue so it can be reused by next relationship.
+        To use this method, first look up the relationship in the returned TargetEmbeddingCache.
+        If its targets are not cached, calculate the transformed tails of all the targets
+        with pre_compute_tails, which writes them to rows starting at ph_cache_start. Then for
+        each head, rel pair we read these precomputed target representations from
+        rows [ph_cache_start, ph_cache_start + ph_target_size) and do the calculation to get the
+        similarity score.
 
         :param device:
+        :param cache_size_mb: memory budget of the pre-computed targets
         :return:
         """
 
@@ -1152,30 +1626,29 @@ class ContentModel(object):
                 # indices of true targets in the evaluation set
                 ph_test_target_idx = tf.placeholder(tf.int32, [None], name='ph_test_target_idx')
 
+                # first cache row of the targets (or of ph_eval_targets when pre-computing them)
+                ph_cache_start = tf.placeholder(tf.int32, (), name='ph_cache_start')
                 ph_target_size = tf.placeholder(tf.int32, (), name='ph_target_size')
 
-                # A temporary queue for precomputed tails
-                pre_computed_tail_queue = tf.FIFOQueue(1000000, dtypes=tf.float32,
-                                                       shapes=[[self.word_embedding_size]],
-                                                       # This may needs to be change later
-                                                       name='tail_queue')
+            target_cache, cache_index = self._create_target_cache('eval_v2_target_cache', self.word_embedding_size,
+                                                                  cache_size_mb, device=device)
 
+            with tf.device(device):
                 # Convert string targets to numerical ids
                 eval_tails = self.entity_table.lookup(ph_eval_targets)
-                # computed tails [1, ?, word_dim]
-                computed_tails = tf.squeeze(self._transform_tail_entity(eval_tails, reuse=True, device=device), axis=0)
+                # normalized tails from the materialized entity embeddings [?, word_dim]
+                computed_tails = tf.squeeze(self._materialized_entities(eval_tails, normalized=True, device=device),
+                                            axis=0)
 
-                # put pre-computed tails into target queue
                 # Call this to pre-compute tails for a certain relationship
-                pre_compute_tails = pre_computed_tail_queue.enqueue_many(computed_tails)
+                pre_compute_tails = tf.scatter_update(target_cache,
+                                                      ph_cache_start + tf.range(tf.shape(computed_tails)[0]),
+                                                      computed_tails)
 
-                # get pre-computed tails from target queue
-                dequeue_op = pre_computed_tail_queue.dequeue_many(ph_target_size)
-                tail_embeds = tf.expand_dims(dequeue_op, axis=0)
+                # a slice along the first dimension does not copy the cached tails
+                tail_embeds = tf.expand_dims(tf.slice(target_cache, [ph_cache_start, 0], [ph_target_size, -1]),
+                                             axis=0)
                 tf.logging.info("tail_embeds shape %s" % tail_embeds.get_shape())
-                # Put tails back into the queue (this will run after tails are dequeued)
-                with tf.control_dependencies([dequeue_op]):
-                    re_enqueue = pre_computed_tail_queue.enqueue_many(dequeue_op)
 
                 # First, convert string to indices
                 str_heads, str_rels = tf.unstack(ph_head_rel, axis=1)
@@ -1183,7 +1656,7 @@ class ContentModel(object):
                 rels = self.relation_table.lookup(str_rels)
 
                 # Calculate heads and tails
-                computed_heads = self._transform_head_entity(heads, reuse=True, device=device)
+                computed_heads = self._materialized_entities(heads, device=device)
                 computed_rels = self._transform_relation(rels, reuse=True, device=device)
                 combined_head_rel = self._combine_head_relation(transformed_heads=computed_heads,
                                                                 transformed_rels=computed_rels,
@@ -1194,49 +1667,146 @@ class ContentModel(object):
                 pred_scores = tf.reshape(self._predict(combined_head_rel,
                                                        tail_embeds,
                                                        reuse=True,
-                                                       device=device), [-1, 1])
+                                                       device=device,
+                                                       normalized_tails=True), [-1, 1])
 
                 tf.logging.info("eval pred_scores %s" % pred_scores.get_shape())
 
-                ranks, rr = self.eval_helper(pred_scores, ph_test_target_idx, ph_true_target_idx)
+                ranks, rr, metrics = self.eval_helper(pred_scores, ph_test_target_idx, ph_true_target_idx)
 
-                rand_ranks, rand_rr = self.eval_helper(
+                rand_ranks, rand_rr, _ = self.eval_helper(
                     tf.random_uniform(tf.shape(pred_scores), minval=-1, maxval=1, dtype=tf.float32),
                     ph_test_target_idx, ph_true_target_idx)
 
-                return ph_head_rel, ph_eval_targets, ph_target_size, pre_computed_tail_queue.size(), \
+                return ph_head_rel, ph_eval_targets, ph_cache_start, ph_target_size, cache_index, \
                        ph_true_target_idx, ph_test_target_idx, \
-                       pre_compute_tails, re_enqueue, dequeue_op, ranks, rr, rand_ranks, rand_rr, pred_scores
+                       pre_compute_tails, ranks, rr, rand_ranks, rand_rr, pred_scores, metrics
 
     @staticmethod
-    def eval_helper(scores, test_target_idx, true_target_idx):
-        # [?, 1] scores of each true target in evaluation set
-        eval_target_scores = tf.nn.embedding_lookup(scores, test_target_idx)
+    def eval_helper(scores, test_target_idx, true_target_idx, hits_at=(1, 3, 10)):
+        """ Filtered ranks of the test targets of a single partial triple, see filtered_ranks
+
+        :param scores: [n_targets, 1]
+        :param test_target_idx:
+        :param true_target_idx:
+        :param hits_at:
+        :return: ranks, rr and the rank_metrics of the ranks
+        """
+        # a single row of test and true targets
+        ranks = filtered_ranks(tf.reshape(scores, [1, -1]),
+                               test_target_idx, tf.stack([0, tf.size(test_target_idx, out_type=tf.int64)]),
+                               true_target_idx, tf.stack([0, tf.size(true_target_idx, out_type=tf.int64)]))
+        rr = 1.0 / tf.cast(tf.reduce_min(ranks), tf.float32)
 
-        tf.logging.info("eval_target_scores %s" % eval_target_scores)
+        return ranks, rr, rank_metrics(ranks, hits_at)
 
-        # [?, 2] idx are [idx, 0]
-        true_target_mask_idx = tf.transpose(tf.stack([tf.cast(true_target_idx, tf.int64),
-                                                      tf.zeros_like(true_target_idx, dtype=tf.int64)],
-                                                     axis=0))
+    def batched_eval_ops(self, device='/cpu:0', cache_size_mb=1024):
+        """ Same as manual_eval_ops_v2 but evaluate a batch of heads of the same relationship at once
 
-        # [?, 1]
-        true_target_mask = tf.SparseTensor(indices=true_target_mask_idx,
-                                           values=tf.ones_like(true_target_idx, dtype=tf.float32) * (
-                                               -1e10),
-                                           dense_shape=tf.shape(scores, out_type=tf.int64))
+        Every head is scored against all the pre-computed tails in a single matmul. Test and true
+        target indices of the heads are fed in CSR format, row i is ph_test_target_idx[ph_test_target_offsets[i]:ph_test_target_offsets[i + 1]].
 
-        tf.logging.info("true_target_mask %s" % true_target_mask)
+        The returned ranks are ragged: ranks[ph_test_target_offsets[i]:ph_test_target_offsets[i + 1]]
+        are the ranks of the test targets of the i-th head, rr is [n_heads] and is 0 for heads
+        without any test targets. metrics are the MR, MRR and Hits@k of all the ranks in the batch.
 
-        # apply true_target_mask on to pred_scores, [None, 1]
-        masked_scores = scores + tf.sparse_tensor_to_dense(true_target_mask)
+        :param device:
+        :param cache_size_mb: memory budget of the pre-computed targets
+        :return:
+        """
 
-        # extracted ranks for each evaluation target [1, None] > [None, 1] => [None, None] => [None]
-        ranks = tf.reduce_sum(
-            tf.cast(tf.greater(tf.transpose(masked_scores), eval_target_scores), tf.int32), axis=-1) + 1
-        rr = 1.0 / tf.cast(tf.reduce_min(ranks), tf.float32)
+        with tf.name_scope("batched_evaluation"):
+            with tf.device(device):
+                # heads to evaluate and their relationship
+                ph_heads = tf.placeholder(tf.string, [None], name='ph_heads')
+                ph_rel = tf.placeholder(tf.string, (), name='ph_rel')
+                # tail targets to evaluate, this can be just part of the total targets
+                ph_eval_targets = tf.placeholder(tf.string, [1, None], name='ph_eval_targets')
+                # indices of true tail targets of each head in the overall target list
+                ph_true_target_idx = tf.placeholder(tf.int32, [None], name='ph_true_target_idx')
+                ph_true_target_offsets = tf.placeholder(tf.int64, [None], name='ph_true_target_offsets')
+                # indices of true targets of each head in the evaluation set
+                ph_test_target_idx = tf.placeholder(tf.int32, [None], name='ph_test_target_idx')
+                ph_test_target_offsets = tf.placeholder(tf.int64, [None], name='ph_test_target_offsets')
+
+                # first cache row of the targets (or of ph_eval_targets when pre-computing them)
+                ph_cache_start = tf.placeholder(tf.int32, (), name='ph_cache_start')
+                ph_target_size = tf.placeholder(tf.int32, (), name='ph_target_size')
+
+            target_cache, cache_index = self._create_target_cache('batched_eval_target_cache',
+                                                                  self.word_embedding_size,
+                                                                  cache_size_mb, device=device)
+
+            with tf.device(device):
+                # normalized tails from the materialized entity embeddings [?, word_dim]
+                eval_tails = self.entity_table.lookup(ph_eval_targets)
+                computed_tails = tf.squeeze(self._materialized_entities(eval_tails, normalized=True, device=device),
+                                            axis=0)
+                pre_compute_tails = tf.scatter_update(target_cache,
+                                                      ph_cache_start + tf.range(tf.shape(computed_tails)[0]),
+                                                      computed_tails)
+
+                # a slice along the first dimension does not copy the cached tails
+                tail_embeds = tf.slice(target_cache, [ph_cache_start, 0], [ph_target_size, -1])
+
+                # [n_heads, 1]
+                heads = tf.expand_dims(self.entity_table.lookup(ph_heads), axis=1)
+                rels = self.relation_table.lookup(tf.expand_dims(ph_rel, axis=0))
+
+                computed_heads = self._materialized_entities(heads, device=device)
+                computed_rels = self._transform_relation(rels, reuse=True, device=device)
+                # [n_heads, 1, word_dim]
+                combined_head_rel = self._combine_head_relation(transformed_heads=computed_heads,
+                                                                transformed_rels=computed_rels,
+                                                                reuse=True,
+                                                                device=device)
 
-        return ranks, rr
+                # [n_heads, n_targets]
+                pred_scores = self._predict_shared(tf.reshape(combined_head_rel, [-1, self.word_embedding_size]),
+                                                   tail_embeds,
+                                                   reuse=True,
+                                                   device=device,
+                                                   normalized_tails=True)
+
+                tf.logging.info("batched eval pred_scores %s" % pred_scores.get_shape())
+
+                ranks, rr, metrics = self.batched_eval_helper(pred_scores,
+                                                     ph_test_target_idx, ph_test_target_offsets,
+                                                     ph_true_target_idx, ph_true_target_offsets)
+
+                rand_ranks, rand_rr, _ = self.batched_eval_helper(
+                    tf.random_uniform(tf.shape(pred_scores), minval=-1, maxval=1, dtype=tf.float32),
+                    ph_test_target_idx, ph_test_target_offsets,
+                    ph_true_target_idx, ph_true_target_offsets)
+
+                return ph_heads, ph_rel, ph_eval_targets, ph_cache_start, ph_target_size, cache_index, \
+                       ph_true_target_idx, ph_true_target_offsets, ph_test_target_idx, ph_test_target_offsets, \
+                       pre_compute_tails, ranks, rr, rand_ranks, rand_rr, pred_scores, metrics
+
+    @staticmethod
+    def batched_eval_helper(scores, test_target_idx, test_target_offsets, true_target_idx, true_target_offsets,
+                            hits_at=(1, 3, 10)):
+        """ Same as eval_helper for a batch of heads
+
+        :param scores: [n_heads, n_targets]
+        :param test_target_idx: CSR test targets of each head
+        :param test_target_offsets: [n_heads + 1]
+        :param true_target_idx: CSR true targets of each head, these are filtered out
+        :param true_target_offsets: [n_heads + 1]
+        :param hits_at:
+        :return: ranks of the test targets in the same CSR layout as test_target_idx, [n_heads] rr,
+                 rank_metrics of all the ranks
+        """
+        n_heads = tf.shape(scores)[0]
+        ranks = filtered_ranks(scores, test_target_idx, test_target_offsets, true_target_idx, true_target_offsets)
+
+        # best rank of each head, the segment min of an empty head is the largest int32
+        test_rows = tf.cast(ragged_row_ids(test_target_offsets), tf.int32)
+        has_targets = tf.greater(test_target_offsets[1:] - test_target_offsets[:-1], 0)
+        best_ranks = tf.unsorted_segment_min(ranks, test_rows, n_heads)
+        rr = tf.where(has_targets, 1.0 / tf.cast(best_ranks, tf.float32), tf.zeros([n_heads], dtype=tf.float32))
+
+        return ranks, rr, rank_metrics(ranks, hits_at)
 
     def manual_eval_ops(self, device='/cpu:0'):
         """ Manually evaluate one single partial triple with a given set of targets
@@ -1274,10 +1844,10 @@ class ContentModel(object):
 
                 # Get predicted score of the given partial triple and targets
                 # [None, 1]
-                pred_scores = tf.reshape(self.translate_triple(heads=heads,
-                                                               rels=rels,
-                                                               tails=eval_tails,
-                                                               device=device), [-1, 1])
+                pred_scores = tf.reshape(self._eval_translate_triple(heads=heads,
+                                                                     rels=rels,
+                                                                     tails=eval_tails,
+                                                                     device=device), [-1, 1])
 
                 pred_scores_queue = tf.FIFOQueue(1000000, dtypes=tf.float32, shapes=[[1]], name='pred_scores_queue')
 
@@ -1287,39 +1857,12 @@ class ContentModel(object):
 
                 tf.logging.info("pred_scores %s" % dequeue_op.get_shape())
 
-                def eval_helper(scores):
-                    # [?, 1] scores of each true target in evaluation set
-                    eval_target_scores = tf.nn.embedding_lookup(scores, ph_test_target_idx)
-
-                    tf.logging.info("eval_target_scores %s" % eval_target_scores)
-
-                    # [?, 2] idx are [idx, 0]
-                    true_target_mask_idx = tf.transpose(tf.stack([tf.cast(ph_true_target_idx, tf.int64),
-                                                                  tf.zeros_like(ph_true_target_idx, dtype=tf.int64)],
-                                                                 axis=0))
-
-                    # [?, 1]
-                    true_target_mask = tf.SparseTensor(indices=true_target_mask_idx,
-                                                       values=tf.ones_like(ph_true_target_idx, dtype=tf.float32) * (
-                                                           -1e10),
-                                                       dense_shape=tf.shape(scores, out_type=tf.int64))
+                ranks, rr, _ = self.eval_helper(dequeue_op, ph_test_target_idx, ph_true_target_idx)
 
-                    tf.logging.info("true_target_mask %s" % true_target_mask)
-
-                    # apply true_target_mask on to pred_scores, [None, 1]
-                    masked_scores = scores + tf.sparse_tensor_to_dense(true_target_mask)
-
-                    # extracted ranks for each evaluation target [1, None] > [None, 1] => [None, None] => [None]
-                    ranks = tf.reduce_sum(
-                        tf.cast(tf.greater(tf.transpose(masked_scores), eval_target_scores), tf.int32), axis=-1) + 1
-                    rr = 1.0 / tf.cast(tf.reduce_min(ranks), tf.float32)
-
-                    return ranks, rr
-
-                ranks, rr = eval_helper(dequeue_op)
-
-                rand_ranks, rand_rr = eval_helper(tf.random_uniform(tf.stack([pred_scores_queue.size(), 1], axis=0),
-                                                                    minval=-1, maxval=1, dtype=tf.float32))
+                rand_ranks, rand_rr, _ = self.eval_helper(
+                    tf.random_uniform(tf.stack([pred_scores_queue.size(), 1], axis=0),
+                                      minval=-1, maxval=1, dtype=tf.float32),
+                    ph_test_target_idx, ph_true_target_idx)
 
                 return ph_head_rel, ph_eval_targets, ph_true_target_idx, \
                        ph_test_target_idx, enqueue_op, ranks, rr, rand_ranks, rand_rr, dequeue_op
@@ -1331,6 +1874,8 @@ def main(_):
     tf.logging.set_verbosity(tf.logging.INFO)
     CHECKPOINT_DIR = sys.argv[1]
     dataset_dir = sys.argv[2]
+    # compiled by tools/compile_dataset.py
+    bundle_dir = os.path.join(dataset_dir, 'dataset.bundle')
 
     is_train = not (len(sys.argv) == 4 and sys.argv[3] == 'eval')
 
@@ -1358,6 +1903,8 @@ def main(_):
 
                          train_file=os.path.join(dataset_dir, 'train.txt'),
 
+                         dataset_bundle=bundle_dir if os.path.exists(bundle_dir) else None,
+
                          word_oov=100,
                          word_embedding_size=200,
                          debug=True)
@@ -1370,14 +1917,18 @@ def main(_):
     else:
         tf.logging.info("Evaluate mode")
 
-        ph_head_rel, ph_eval_targets, ph_target_size, q_size, ph_true_target_idx, \
-        ph_test_target_idx, pre_compute_tails, re_enqueue, dequeue_op, ranks, rr, rand_ranks, rand_rr, _ = model.manual_eval_ops_v2(
-            '/gpu:3')
+        ph_heads, ph_rel, ph_eval_targets, ph_cache_start, ph_target_size, target_cache, \
+        ph_true_target_idx, ph_true_target_offsets, ph_test_target_idx, ph_test_target_offsets, \
+        pre_compute_tails, ranks, rr, rand_ranks, rand_rr, _, _ = model.batched_eval_ops('/gpu:3')
 
     # metric_reset_op = tf.variables_initializer([i for i in tf.local_variables() if 'streaming_metrics' in i.name])
     # metric_merge_op = tf.summary.merge_all(model.EVAL_SUMMARY)
 
     EVAL_BATCH = 500
+    # Number of heads of the same relationship scored in one run
+    EVAL_HEAD_BATCH = 256
+    # Refresh the hard negative caches if train_ops is called with hard_negative_ratio > 0
+    HARD_NEGATIVE_REFRESH_STEPS = 5000
 
     config = tf.ConfigProto()
     # config.graph_options.optimizer_options.global_jit_level = tf.OptimizerOptions.ON_1
@@ -1429,11 +1980,15 @@ def main(_):
             try:
                 global_step = sess.run(model.global_step)
                 while not coord.should_stop():
+                    if model.hard_negative_refresh_ops and global_step % HARD_NEGATIVE_REFRESH_STEPS == 0:
+                        model.refresh_hard_negatives(sess)
 
                     if global_step % 10 == 0:
                         if global_step % 500 == 0:
-                            _, loss, global_step, merged, merged_slow = sess.run(
-                                [train_op, loss_op, model.global_step, merge_ops[0], merge_ops[1]])
+                            # Also check if the model is waiting for the input pipeline
+                            (_, loss, global_step, merged, merged_slow), _, _ = timed_input_step(
+                                sess, [train_op, loss_op, model.global_step, merge_ops[0], merge_ops[1]],
+                                model.training_inputs)
                             train_writer.add_summary(merged, global_step)
                             train_writer.add_summary(merged_slow, global_step)
                         else:
@@ -1460,19 +2015,17 @@ def main(_):
             saver.save(sess, os.path.join(CHECKPOINT_DIR, "model.ckpt"), global_step=model.global_step)
             tf.logging.info("Model saved with %d global steps." % sess.run(model.global_step))
         else:
-            # First load evaluation data
-            # {rel : {head : [tails]}}
-            evaluation_data = load_manual_evaluation_file_by_rel(os.path.join(dataset_dir, 'test.txt'),
-                                                                 os.path.join(dataset_dir, 'avoid_entities.txt'))
-            tf.logging.info("Number of relationships in the evaluation file %d" % len(evaluation_data))
-            relation_specific_targets = load_relation_specific_targets(
-                os.path.join(dataset_dir, 'train.heads.idx'),
-                os.path.join(dataset_dir, 'relations.txt'))
-            filtered_targets = load_filtered_targets(os.path.join(dataset_dir, 'eval.tails.idx'),
-                                                     os.path.join(dataset_dir, 'eval.tails.values.closed'))
+            # Transform every entity once with the restored model
+            model.materialize_entity_embeddings(sess)
 
+            # First load evaluation data, candidate targets of each relation and
+            # the positions of test/true targets of each (head, rel) in the candidates
+            evaluation_index = EvaluationIndex(dataset_dir)
+            tf.logging.info("Number of relationships in the evaluation file %d" % len(evaluation_index))
+
+            hits_at = [1, 3, 10]
             fieldnames = ['relationship', 'mean_rank', 'mrr', 'mrr_per_triple', 'rand_mean_rank', 'rand_mrr',
-                          'rand_mrr_per_triple', 'miss', 'triples', 'targets']
+                          'rand_mrr_per_triple', 'miss', 'triples', 'targets'] + ['hits@%d' % k for k in hits_at]
             csvfile = open(os.path.join(CHECKPOINT_DIR, 'eval.%d.csv' % sess.run(model.global_step)), 'w', newline='')
             csv_writer = csv.DictWriter(csvfile, fieldnames)
             csv_writer.writeheader()
@@ -1490,23 +2043,20 @@ def main(_):
             # New evaluation method - evaluate by relationship
             missed = 0
             trips = 0
-            for c, rel_str in enumerate(evaluation_data.keys()):
-
-                if rel_str not in relation_specific_targets:
-                    tf.logging.warning("Relation %s does not have any valid targets!" % rel_str)
-                    continue
+            for c in range(len(evaluation_index)):
+                rel_str = evaluation_index.relation_names[evaluation_index.relations[c]]
                 # First pre-compute the target embeddings
-                eval_targets_set = relation_specific_targets[rel_str]
-                eval_targets = list(eval_targets_set)
+                eval_targets = evaluation_index.entity_names[evaluation_index.candidate_targets(c)]
 
                 tf.logging.debug("\nRelation %s : %d" % (rel_str, len(eval_targets)))
-                start = 0
-                while start < len(eval_targets):
-                    end = min(start + EVAL_BATCH, len(eval_targets))
-                    sess.run(pre_compute_tails, feed_dict={ph_eval_targets: [eval_targets[start:end]]})
-                    start = end
-
-                assert sess.run(q_size) == len(eval_targets)
+                cache_start, cached = target_cache.lookup(rel_str, len(eval_targets))
+                if not cached:
+                    start = 0
+                    while start < len(eval_targets):
+                        end = min(start + EVAL_BATCH, len(eval_targets))
+                        sess.run(pre_compute_tails, feed_dict={ph_cache_start: cache_start + start,
+                                                               ph_eval_targets: [eval_targets[start:end].tolist()]})
+                        start = end
 
                 # Performance of a single relationship
                 rel_ranks = list()
@@ -1517,62 +2067,60 @@ def main(_):
                 rel_random_multi_rr = list()
                 rel_miss = 0
                 rel_trips = 0
-                for head_str, eval_true_targets_set in evaluation_data[rel_str].items():
-                    head_rel = [[head_str, rel_str]]
-                    head_rel_str = "\t".join([head_str, rel_str])
-
-                    # Find true targets (in train/valid/test) of the given head relation
-                    # in the evaluation set and skip all others
-                    true_targets = set(filtered_targets[head_rel_str]).intersection(eval_targets_set)
-
-                    # find true evaluation targets in the test set that are in this set
-                    eval_true_targets = set.intersection(eval_targets_set, eval_true_targets_set)
-
+                # test_target_idx: true evaluation targets in the test set that are in the candidates
+                # true_target_idx: true targets (in train/valid/test) of the given head relation in the candidates
+                for heads, test_target_idx, test_target_offsets, true_target_idx, true_target_offsets, misses in \
+                        evaluation_index.query_batches(c, EVAL_HEAD_BATCH):
                     # how many true targets we missed/filtered out
-                    rel_miss += len(eval_true_targets_set) - len(eval_true_targets)
-                    missed += len(eval_true_targets_set) - len(eval_true_targets)
-
-                    test_target_idx = sorted([eval_targets.index(x) for x in eval_true_targets])
-                    true_target_idx = sorted([eval_targets.index(x) for x in true_targets])
-
-                    assert len(true_target_idx) >= len(test_target_idx)
-
-                    _ranks, _rr, _rand_ranks, _rand_rr, _ = sess.run([ranks, rr, rand_ranks, rand_rr, re_enqueue],
-                                                                     feed_dict={ph_head_rel: head_rel,
-                                                                                ph_target_size: len(eval_targets_set),
-                                                                                ph_true_target_idx: true_target_idx,
-                                                                                ph_test_target_idx: test_target_idx})
-
-                    assert sess.run(q_size) == len(eval_targets)
-
-                    if len(_ranks):
-                        rel_ranks.extend([float(x) for x in _ranks])
-                        all_ranks.extend([float(x) for x in _ranks])
-                        all_rr.append(_rr)
-                        rel_rr.append(_rr)
-                        all_multi_rr.extend([np.max([1.0 / float(x) for x in _ranks])] * len(_ranks))
-                        rel_multi_rr.extend([np.max([1.0 / float(x) for x in _ranks])] * len(_ranks))
-
-                        random_ranks.extend([float(x) for x in _rand_ranks])
-                        rel_random_ranks.extend([float(x) for x in _rand_ranks])
-                        random_rr.append(_rand_rr)
-                        rel_random_rr.append(_rand_rr)
-                        random_multi_rr.extend([np.max([1.0 / float(x) for x in _rand_ranks])] * len(_rand_ranks))
-                        rel_random_multi_rr.extend([np.max([1.0 / float(x) for x in _rand_ranks])] * len(_rand_ranks))
-                        rel_trips += len(_ranks)
-                        trips += len(_ranks)
+                    rel_miss += int(np.sum(misses))
+                    missed += int(np.sum(misses))
+                    if not len(eval_targets):
+                        # the relation has no candidates, every test target is missed
+                        continue
+
+                    assert np.all(np.diff(true_target_offsets) >= np.diff(test_target_offsets))
+
+                    _ranks, _rr, _rand_ranks, _rand_rr = sess.run([ranks, rr, rand_ranks, rand_rr],
+                                                                  feed_dict={ph_heads: evaluation_index.entity_names[heads].tolist(),
+                                                                             ph_rel: rel_str,
+                                                                             ph_cache_start: cache_start,
+                                                                             ph_target_size: len(eval_targets),
+                                                                             ph_true_target_idx: true_target_idx,
+                                                                             ph_true_target_offsets: true_target_offsets,
+                                                                             ph_test_target_idx: test_target_idx,
+                                                                             ph_test_target_offsets: test_target_offsets})
+
+                    # ranks of the i-th head are _ranks[test_target_offsets[i]:test_target_offsets[i + 1]]
+                    for i in range(len(heads)):
+                        head_ranks = _ranks[test_target_offsets[i]:test_target_offsets[i + 1]]
+                        head_rand_ranks = _rand_ranks[test_target_offsets[i]:test_target_offsets[i + 1]]
+                        if not len(head_ranks):
+                            continue
+                        rel_ranks.extend([float(x) for x in head_ranks])
+                        all_ranks.extend([float(x) for x in head_ranks])
+                        all_rr.append(_rr[i])
+                        rel_rr.append(_rr[i])
+                        all_multi_rr.extend([np.max([1.0 / float(x) for x in head_ranks])] * len(head_ranks))
+                        rel_multi_rr.extend([np.max([1.0 / float(x) for x in head_ranks])] * len(head_ranks))
+
+                        random_ranks.extend([float(x) for x in head_rand_ranks])
+                        rel_random_ranks.extend([float(x) for x in head_rand_ranks])
+                        random_rr.append(_rand_rr[i])
+                        rel_random_rr.append(_rand_rr[i])
+                        random_multi_rr.extend([np.max([1.0 / float(x) for x in head_rand_ranks])] * len(head_rand_ranks))
+                        rel_random_multi_rr.extend(
+                            [np.max([1.0 / float(x) for x in head_rand_ranks])] * len(head_rand_ranks))
+                        rel_trips += len(head_ranks)
+                        trips += len(head_ranks)
                     print("%d/%d %d "
                           "MR %.4f (%.4f) "
                           "MRR(per head,rel) %.4f (%.4f) "
                           "MRR(per tail) %.4f (%.4f) missed %d" % (
-                              c + 1, len(evaluation_data), len(all_ranks),
+                              c + 1, len(evaluation_index), len(all_ranks),
                               np.mean(all_ranks), np.mean(random_ranks),
                               np.mean(all_rr), np.mean(random_rr),
                               np.mean(all_multi_rr), np.mean(random_multi_rr),
                               missed), end='\r')
-                    # clean up precomputed targets
-                sess.run(dequeue_op, feed_dict={ph_target_size: len(eval_targets_set)})
-                assert sess.run(q_size) == 0
 
                 csv_writer.writerow({'relationship': rel_str,
                                      'mean_rank': np.mean(rel_ranks),
@@ -1583,7 +2131,8 @@ def main(_):
                                      'rand_mrr_per_triple': np.mean(rel_random_multi_rr),
                                      'miss': rel_miss,
                                      'triples': rel_trips,
-                                     'targets': len(eval_targets_set)})
+                                     'targets': len(eval_targets),
+                                     **{'hits@%d' % k: np.mean(np.asarray(rel_ranks) <= k) for k in hits_at}})
 
             print("\n%d "
                   "MR %.4f (%.4f) "
@@ -1604,7 +2153,8 @@ def main(_):
                                  'rand_mrr_per_triple': np.mean(random_multi_rr),
                                  'miss': missed,
                                  'triples': trips,
-                                 'targets': -1})
+                                 'targets': -1,
+                                 **{'hits@%d' % k: np.mean(np.asarray(all_ranks) <= k) for k in hits_at}})
 
             csvfile.close()
             exit(0)
@@ -9,10 +9,11 @@ import tensorflow.contrib.training as training
 
 os.environ['TF_CPP_MIN_LOG_LEVEL'] = '3'
 
-from ndkgc.ops import get_lookup_table, corrupt_single_relationship, corrupt_single_entity, content_lookup, \
-    multiple_content_lookup, normalized_lookup, avg_grads
-from ndkgc.utils import count_line, valid_vocab_file, load_list, \
-    load_triples, load_pretrained_embedding, load_content
+from ndkgc.ops import get_lookup_table, get_target_index_table, corrupt_single_relationship, corrupt_single_entity, \
+    ragged_content_lookup, multiple_ragged_content_lookup, normalized_lookup, avg_grads, shuffled_indices, \
+    timed_input_step
+from ndkgc.utils import count_line, valid_vocab_file, load_list, index_triples, \
+    load_triple_array, load_pretrained_embedding, load_content_ids
 
 
 class DKRL(object):
@@ -70,7 +71,6 @@ class DKRL(object):
 
         self.entity_table = None
         self.relation_table = None
-        self.vocab_table = None
 
         self.train_matrix = None
         self.test_matrix = None
@@ -78,6 +78,20 @@ class DKRL(object):
         self.triple_matrix = None
         self.triple_matrix = None
         self.content_matrix = None
+        self.content_offsets = None
+
+        # Sorted triple indexes for corruption, (target index table, values, offsets)
+        # true heads of (relation, tail) and true tails of (relation, head) in the training triples
+        self.train_head_index = None
+        self.train_tail_index = None
+        # true relations of (head, tail) in all triples
+        self.relation_index = None
+        # index name to (keys, values, offsets, insert op)
+        self.__triple_index_variables = dict()
+
+        # Input tensors of the training step and the initializer of the training input pipeline
+        self.train_inputs = None
+        self.train_iterator_initializer = None
 
         self.entity_embedding = None
         self.relation_embedding = None
@@ -161,34 +175,37 @@ class DKRL(object):
         entity_dict = load_list(self.entity_file)
         relation_dict = load_list(self.relation_file)
 
-        train_triples = load_triples(self.train_file,
-                                     entity_dict,
-                                     relation_dict)
+        train_triples = load_triple_array(self.train_file,
+                                          entity_dict,
+                                          relation_dict)
         if not self.__initialized:
             self.__initialize_model()
 
-        self.train_matrix.load(np.asarray(train_triples), sess)
+        self.train_matrix.load(train_triples, sess)
+        self.__load_triple_index('train_heads', train_triples, (1, 2), 0, sess)
+        self.__load_triple_index('train_tails', train_triples, (1, 0), 2, sess)
         del train_triples
 
         if self.valid_matrix is not None:
-            valid_triples = load_triples(self.valid_file,
-                                         entity_dict,
-                                         relation_dict)
-            self.valid_matrix.load(np.asarray(valid_triples), sess)
+            valid_triples = load_triple_array(self.valid_file,
+                                              entity_dict,
+                                              relation_dict)
+            self.valid_matrix.load(valid_triples, sess)
             del valid_triples
 
         if self.test_matrix is not None:
-            test_triples = load_triples(self.test_file,
-                                        entity_dict,
-                                        relation_dict)
-            self.test_matrix.load(np.asarray(test_triples), sess)
+            test_triples = load_triple_array(self.test_file,
+                                             entity_dict,
+                                             relation_dict)
+            self.test_matrix.load(test_triples, sess)
             del test_triples
 
-        all_triples = load_triples(self.all_triples_file,
-                                   entity_dict,
-                                   relation_dict)
+        all_triples = load_triple_array(self.all_triples_file,
+                                        entity_dict,
+                                        relation_dict)
 
-        self.triple_matrix.load(np.asarray(all_triples), sess)
+        self.triple_matrix.load(all_triples, sess)
+        self.__load_triple_index('all_relations', all_triples, (0, 2), 1, sess)
         del all_triples
 
         vocab = load_list(self.vocab_file)
@@ -197,9 +214,40 @@ class DKRL(object):
                                                            vocab,
                                                            self.word_embedding_size,
                                                            self.oov_buckets), sess)
-        del vocab
 
-        self.content_matrix.load(load_content(self.content_file, entity_dict), sess)
+        content, content_offsets = load_content_ids(self.content_file, entity_dict, vocab, self.oov_buckets)
+        self.content_matrix.load(content, sess)
+        self.content_offsets.load(content_offsets, sess)
+        del vocab, content, content_offsets
+
+    def __create_triple_index(self, name):
+        """ Create the variables of a sorted triple index, see index_triples
+
+        :param name:
+        :return: (target index table, values, offsets)
+        """
+        variables = list()
+        for suffix, dtype in [('_keys', tf.int64), ('_values', tf.int32), ('_offsets', tf.int64)]:
+            variables.append(tf.get_variable(name + suffix,
+                                             dtype=dtype,
+                                             initializer=tf.placeholder_with_default(
+                                                 tf.zeros([0], dtype=dtype), [None]),
+                                             validate_shape=False,
+                                             trainable=False,
+                                             collections=['static_variables']))
+        keys, values, offsets = variables
+        table, insert_op = get_target_index_table(keys, name=name + '_index')
+        self.__triple_index_variables[name] = (keys, values, offsets, insert_op)
+        return table, values, offsets
+
+    def __load_triple_index(self, name, triples, key_cols, value_col, sess):
+        keys, values, offsets, insert_op = self.__triple_index_variables[name]
+        _keys, _values, _offsets = index_triples(triples, key_cols, value_col)
+        keys.load(_keys, sess)
+        values.load(_values, sess)
+        offsets.load(_offsets, sess)
+        # The table can only be filled after the keys are loaded
+        sess.run(insert_op)
 
     def dist(self, h, r, t):
         return tf.reduce_sum(tf.abs(h + r - t), axis=-1)
@@ -283,16 +331,21 @@ class DKRL(object):
                                                        size=self.n_relation,
                                                        name='relation_lookup_table')
 
-                self.vocab_table = get_lookup_table(self.vocab_file,
-                                                    oov_buckets=self.oov_buckets,
-                                                    size=self.n_vocab,
-                                                    name='vocab_lookup_table')
-
+                # Word ids of all entity descriptions, the content of entity i is
+                # content_matrix[content_offsets[i]:content_offsets[i + 1]]
                 self.content_matrix = tf.get_variable("content_matrix",
-                                                      dtype=tf.string,
-                                                      initializer=[""] * self.n_entity,
+                                                      dtype=tf.int32,
+                                                      initializer=tf.placeholder_with_default(
+                                                          tf.zeros([0], dtype=tf.int32), [None]),
+                                                      validate_shape=False,
                                                       trainable=False,
                                                       collections=['static_variables'])
+                self.content_offsets = tf.get_variable("content_offsets",
+                                                       [self.n_entity + 1],
+                                                       dtype=tf.int64,
+                                                       initializer=tf.zeros_initializer(),
+                                                       trainable=False,
+                                                       collections=['static_variables'])
 
                 self.train_matrix = tf.get_variable("train_triple",
                                                     [count_line(self.train_file), 3],
@@ -318,6 +371,10 @@ class DKRL(object):
                                                      trainable=False,
                                                      collections=['static_variables'])
 
+                self.train_head_index = self.__create_triple_index('train_heads')
+                self.train_tail_index = self.__create_triple_index('train_tails')
+                self.relation_index = self.__create_triple_index('all_relations')
+
             # Embeddings
             with tf.variable_scope(self.__embedding_scope):
                 self.entity_embedding = tf.get_variable("entity_embedding",
@@ -342,10 +399,6 @@ class DKRL(object):
                 self.global_step = tf.Variable(1, dtype=tf.int32, trainable=False, name='global_step')
                 self.lr = tf.Variable(self.learning_rate, dtype=tf.float32, trainable=False, name='lr')
 
-                # Debug variables
-                self.head_corrupted = tf.Variable(0, dtype=tf.int32, trainable=False, name='head_corrupted')
-                self.tail_corrupted = tf.Variable(0, dtype=tf.int32, trainable=False, name='tail_corrupted')
-
                 # metrics
                 self.head_mean_rank = tf.Variable(0, dtype=tf.float64, trainable=False, name='head_mean_rank')
                 self.tail_mean_rank = tf.Variable(0, dtype=tf.float64, trainable=False, name='tail_mean_rank')
@@ -371,110 +424,92 @@ class DKRL(object):
                                tail_content_len=ph_content_len,
                                variable_scope=self.__model_scope, reuse=False)
 
-    def train_op(self, num_epochs=10, batch_size=200):
+    def train_op(self, num_epochs=10, batch_size=200, num_parallel_calls=4, prefetch_batches=2,
+                 bucket_boundaries=(20, 40, 60, 80, 120)):
 
         if not self.__initialized:
             self.__initialize_model()
         # Build input pipeline
         with tf.name_scope('input_pipeline', [self.train_matrix,
                                               self.triple_matrix,
-                                              self.content_matrix, self.vocab_table]):
+                                              self.content_matrix, self.content_offsets]):
             with tf.device('/cpu:0'):
-                input_triples = tf.train.limit_epochs(
-                    tf.random_shuffle(self.train_matrix, name='shuffled_input_triples'),
-                    num_epochs=num_epochs,
-                    name='train_triples_limited')
-                single_triple = tf.train.shuffle_batch([input_triples],
-                                                       batch_size=1,
-                                                       capacity=min(batch_size * 40, self.train_matrix.get_shape()[0]),
-                                                       min_after_dequeue=min(batch_size * 15,
-                                                                             self.train_matrix.get_shape()[0]),
-                                                       enqueue_many=True,
-                                                       allow_smaller_final_batch=True,
-                                                       name='train_shuffle_batch')
-                # make sure it is a 1-d vector
-                single_triple = tf.reshape(single_triple, [3])
-
-                relation_corrupted_triple = corrupt_single_relationship(single_triple,
-                                                                        self.triple_matrix,
-                                                                        self.n_relation - 1)
-
-                entity_corrupted_triple = corrupt_single_entity(single_triple,
-                                                                self.train_matrix,
-                                                                self.n_entity - 1,
-                                                                debug_head_corrupted=self.head_corrupted,
-                                                                debug_tail_corrupted=self.tail_corrupted)
-
-                head_content_ids = content_lookup(self.content_matrix,
-                                                  self.vocab_table,
-                                                  single_triple[0],
-                                                  name='h_content_lookup')
-                head_content_len = tf.cast(tf.shape(head_content_ids)[0], tf.int32)
-
-                tail_content_ids = content_lookup(self.content_matrix,
-                                                  self.vocab_table,
-                                                  single_triple[2],
-                                                  name='t_content_lookup')
-                tail_content_len = tf.cast(tf.shape(tail_content_ids)[0], tf.int32)
-
-                corrupted_head_content_id = content_lookup(self.content_matrix,
-                                                           self.vocab_table,
-                                                           entity_corrupted_triple[0],
-                                                           name='corrupted_h_content_lookup')
-                corrupted_head_content_len = tf.cast(tf.shape(corrupted_head_content_id)[0], tf.int32)
-
-                corrupted_tail_content_id = content_lookup(self.content_matrix,
-                                                           self.vocab_table,
-                                                           entity_corrupted_triple[2],
-                                                           name='corrupted_t_content_lookup')
-                corrupted_tail_content_len = tf.cast(tf.shape(corrupted_tail_content_id)[0], tf.int32)
-
-                # Get content information for
-                single_instance_max_len = tf.maximum(head_content_len,
-                                                     tf.maximum(tail_content_len,
-                                                                tf.maximum(corrupted_head_content_len,
-                                                                           corrupted_tail_content_len)))
-
-                batch_input_tensors = [single_triple,
-                                       entity_corrupted_triple,
-                                       relation_corrupted_triple,
-                                       head_content_ids, head_content_len,
-                                       tail_content_ids, tail_content_len,
-                                       corrupted_head_content_id, corrupted_head_content_len,
-                                       corrupted_tail_content_id, corrupted_tail_content_len]
-
-                # TODO: Change to tf.contrib.training.bucket_by_sequence_length
-                # We need to put all *_content_ids into a matrix otherwise it will throw an error
-                # because it want to pack all elements together.
-                # _, input_queue = training.bucket_by_sequence_length(single_instance_max_len,
-                #                                                     [batch_input_tensors],
-                #                                                     batch_size=batch_size * 4,
-                #                                                     bucket_boundaries=[20, 40, 60, 80, 120],
-                #                                                     capacity=batch_size * 4 * 10,
-                #                                                     # shapes=[[3], [3], [3],
-                #                                                     #         [None], (),
-                #                                                     #         [None], (),
-                #                                                     #         [None], (),
-                #                                                     #         [None], ()],
-                #                                                     dynamic_pad=True,
-                #                                                     allow_smaller_final_batch=True,
-                #                                                     name="input_bucketed_queue")
-                #
-                # print("INPUT_QUEUE", input_queue)
-
-                input_queue = tf.train.batch(batch_input_tensors,
-                                             batch_size=batch_size * 4,
-                                             num_threads=4,
-                                             capacity=min(batch_size * 40, self.train_matrix.get_shape()[0]),
-                                             enqueue_many=False,
-                                             shapes=[[3], [3], [3],
-                                                     [None], (),
-                                                     [None], (),
-                                                     [None], (),
-                                                     [None], ()],
-                                             dynamic_pad=True,
-                                             allow_smaller_final_batch=True,
-                                             name='input_queue')
+                # The training triples are fully shuffled in every epoch
+                triple_indices = shuffled_indices(self.train_matrix.get_shape()[0].value, num_epochs,
+                                                  name='train_triple_indices')
+
+                def _corrupt_triple(index):
+                    single_triple = tf.gather(self.train_matrix, index)
+
+                    relation_corrupted_triple = corrupt_single_relationship(single_triple,
+                                                                            self.relation_index,
+                                                                            self.n_relation - 1)
+
+                    entity_corrupted_triple = corrupt_single_entity(single_triple,
+                                                                    self.train_head_index,
+                                                                    self.train_tail_index,
+                                                                    self.n_entity - 1)
+
+                    head_content_ids = ragged_content_lookup(self.content_matrix,
+                                                             self.content_offsets,
+                                                             single_triple[0],
+                                                             name='h_content_lookup')
+                    head_content_len = tf.cast(tf.shape(head_content_ids)[0], tf.int32)
+
+                    tail_content_ids = ragged_content_lookup(self.content_matrix,
+                                                             self.content_offsets,
+                                                             single_triple[2],
+                                                             name='t_content_lookup')
+                    tail_content_len = tf.cast(tf.shape(tail_content_ids)[0], tf.int32)
+
+                    corrupted_head_content_id = ragged_content_lookup(self.content_matrix,
+                                                                      self.content_offsets,
+                                                                      entity_corrupted_triple[0],
+                                                                      name='corrupted_h_content_lookup')
+                    corrupted_head_content_len = tf.cast(tf.shape(corrupted_head_content_id)[0], tf.int32)
+
+                    corrupted_tail_content_id = ragged_content_lookup(self.content_matrix,
+                                                                      self.content_offsets,
+                                                                      entity_corrupted_triple[2],
+                                                                      name='corrupted_t_content_lookup')
+                    corrupted_tail_content_len = tf.cast(tf.shape(corrupted_tail_content_id)[0], tf.int32)
+
+                    return (single_triple,
+                            entity_corrupted_triple,
+                            relation_corrupted_triple,
+                            head_content_ids, head_content_len,
+                            tail_content_ids, tail_content_len,
+                            corrupted_head_content_id, corrupted_head_content_len,
+                            corrupted_tail_content_id, corrupted_tail_content_len)
+
+                # Corruption and content lookup run on num_parallel_calls triples at once
+                dataset = triple_indices.map(_corrupt_triple, num_parallel_calls=num_parallel_calls)
+
+                # Batch the triples in buckets of their longest content, so the contents are only
+                # padded to the longest one in the bucket
+                def _max_content_len(*example):
+                    return tf.reduce_max(tf.stack(example[4::2]))
+
+                padded_shapes = ([3], [3], [3],
+                                 [None], [],
+                                 [None], [],
+                                 [None], [],
+                                 [None], [])
+                if bucket_boundaries:
+                    dataset = dataset.apply(tf.contrib.data.bucket_by_sequence_length(
+                        _max_content_len,
+                        list(bucket_boundaries),
+                        [batch_size * 4] * (len(bucket_boundaries) + 1),
+                        padded_shapes=padded_shapes))
+                else:
+                    dataset = dataset.padded_batch(batch_size * 4, padded_shapes=padded_shapes)
+                dataset = dataset.prefetch(prefetch_batches)
+
+                # Initialize after load_static_variables because the iterator captures the static variables
+                iterator = dataset.make_initializable_iterator()
+                self.train_iterator_initializer = iterator.initializer
+                input_queue = list(iterator.get_next())
+                self.train_inputs = input_queue
 
         with tf.name_scope('train', values=input_queue):
             # Inputs of the actual models
@@ -535,25 +570,25 @@ class DKRL(object):
             return train_op, loss_op
 
     def head_conv_helper(self, x):
-        content_ids, content_len = multiple_content_lookup(self.content_matrix,
-                                                           self.vocab_table,
-                                                           x)
+        content_ids, content_len = multiple_ragged_content_lookup(self.content_matrix,
+                                                                  self.content_offsets,
+                                                                  x)
         content_embedding = normalized_lookup(self.word_embedding, content_ids)
         return content_ids, content_len, content_embedding, self.__conv_layers(content_embedding, content_len,
                                                                                self.__head_scope)
 
     def tail_conv_helper(self, x):
-        content_ids, content_len = multiple_content_lookup(self.content_matrix,
-                                                           self.vocab_table,
-                                                           x)
+        content_ids, content_len = multiple_ragged_content_lookup(self.content_matrix,
+                                                                  self.content_offsets,
+                                                                  x)
         content_embedding = normalized_lookup(self.word_embedding, content_ids)
         return content_ids, content_len, content_embedding, self.__conv_layers(content_embedding, content_len,
                                                                                self.__tail_scope)
 
     def _conv_helper(self, x, scope):
-        content_ids, content_len = multiple_content_lookup(self.content_matrix,
-                                                           self.vocab_table,
-                                                           x)
+        content_ids, content_len = multiple_ragged_content_lookup(self.content_matrix,
+                                                                  self.content_offsets,
+                                                                  x)
         content_embedding = normalized_lookup(self.word_embedding, content_ids)
         return self.__conv_layers(content_embedding, content_len, scope)
 
@@ -605,7 +640,7 @@ class DKRL(object):
 
         with tf.name_scope('eval_input_pipeline', values=[eval_matrix,
                                                           self.triple_matrix,
-                                                          self.content_matrix, self.vocab_table]):
+                                                          self.content_matrix, self.content_offsets]):
             input_triple_matrix = tf.train.limit_epochs(eval_matrix, num_epochs=1,
                                                         name='eval_triples_limited')
 
@@ -890,6 +925,8 @@ def main(_):
                       tf.global_variables_initializer(),
                       tf.local_variables_initializer()])
 
+            sess.run(model.train_iterator_initializer)
+
             print("All variables initialized.")
 
             coord = tf.train.Coordinator()
@@ -907,7 +944,12 @@ def main(_):
                 cnt = 0
                 while not coord.should_stop():
                     cnt += 1
-                    if cnt % 10 == 0:
+                    if cnt % 500 == 0:
+                        # Also check if the model is waiting for the input pipeline
+                        (_, loss, global_step), _, _ = timed_input_step(sess, [train_op, loss_op, model.global_step],
+                                                                        model.train_inputs)
+                        print("GSTEP:_%d_LOSS:_%.4f" % (global_step, loss), end='\r')
+                    elif cnt % 10 == 0:
                         _, loss, global_step = sess.run([train_op, loss_op, model.global_step])
                         print("GSTEP:_%d_LOSS:_%.4f" % (global_step, loss), end='\r')
                     else:
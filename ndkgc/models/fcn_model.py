@@ -4,6 +4,7 @@ from intbitset import intbitset
 from ndkgc.models.content_model import ContentModel
 from ndkgc.ops import *
 from ndkgc.utils import *
+from ndkgc.utils.evaluation import EntityEmbeddingCache, EvaluationIndex
 
 
 class FCNModel(ContentModel):
@@ -14,6 +15,12 @@ class FCNModel(ContentModel):
         with tf.variable_scope('fcn') as scp:
             self.fcn_scope = scp
 
+        # Transformed tails of batched_eval_ops and the op writing tails cached on the host
+        # (see EntityEmbeddingCache) into the target cache
+        self.eval_computed_tails = None
+        self.ph_eval_tail_embeds = None
+        self.eval_write_tails = None
+
     def _create_nontrainable_variables(self):
         super(FCNModel, self)._create_nontrainable_variables()
 
@@ -26,10 +33,10 @@ class FCNModel(ContentModel):
         tf.summary.histogram(self.predict_weight.name, self.predict_weight, collections=[self.TRAIN_SUMMARY_SLOW])
 
     def lookup_entity_description_and_title(self, ents, name=None):
-        return description_and_title_lookup(ents, self.entity_content, self.entity_content_len,
-                                            self.entity_title, self.entity_title_len,
-                                            self.vocab_table, self.word_embedding, self.PAD_const,
-                                            name)
+        return ragged_description_and_title_lookup(ents, self.entity_content, self.entity_content_offsets,
+                                                   self.entity_title, self.entity_title_offsets,
+                                                   self.word_embedding, self.PAD_ID,
+                                                   name)
 
     def translate_triple(self, heads, tails, rels, device, reuse=True):
         with tf.name_scope("fcn_translate_triple"):
@@ -53,11 +60,13 @@ class FCNModel(ContentModel):
             transformed_head_content, transformed_head_title = self._transform_head_entity(heads,
                                                                                            transformed_rels,
                                                                                            reuse=reuse,
-                                                                                           device=device)
+                                                                                           device=device,
+                                                                                           rels=rels)
             transformed_tail_content, transformed_tail_title = self._transform_tail_entity(tails,
                                                                                            transformed_rels,
                                                                                            reuse=True,
-                                                                                           device=device)
+                                                                                           device=device,
+                                                                                           rels=rels)
 
             tf.logging.info("[%s] transformed_heads: %s "
                             "transformed_tails %s "
@@ -111,6 +120,47 @@ class FCNModel(ContentModel):
 
                     return pred_score
 
+    def _shared_negative_scores(self, corrupt_head, ent, rel, negatives, device):
+        """ The entity transformation depends on the relation so the shared negatives
+        can not be transformed once for the whole batch, score them as targets of every triple.
+        """
+        with tf.name_scope('shared_negative_scores', values=[corrupt_head, ent, rel, negatives]):
+            tiled_negatives = tf.tile(tf.expand_dims(negatives, axis=0), [tf.shape(ent)[0], 1])
+            return self._corrupted_scores(corrupt_head, ent, rel, tiled_negatives, device=device)
+
+    def train_ops(self, lr=0.01, num_epoch=10, batch_size=200,
+                  sampled_true=1, sampled_false=1, devices=list(['/cpu:0']),
+                  num_parallel_calls=4, prefetch_batches=4,
+                  shared_negatives=0, in_batch_negatives=False,
+                  hard_negative_ratio=0., hard_negative_cache_size=50, group_by_relation=False):
+        """ Same as ContentModel.train_ops without hard negatives, they are scored with cached entity
+        embeddings but FCNModel transforms the entities differently for each relation.
+        """
+        if hard_negative_ratio > 0:
+            raise ValueError("FCNModel does not support hard negatives, hard_negative_ratio must be 0 but is %s"
+                             % hard_negative_ratio)
+        return super(FCNModel, self).train_ops(lr=lr, num_epoch=num_epoch, batch_size=batch_size,
+                                               sampled_true=sampled_true, sampled_false=sampled_false,
+                                               devices=devices,
+                                               num_parallel_calls=num_parallel_calls,
+                                               prefetch_batches=prefetch_batches,
+                                               shared_negatives=shared_negatives,
+                                               in_batch_negatives=in_batch_negatives,
+                                               hard_negative_cache_size=hard_negative_cache_size,
+                                               group_by_relation=group_by_relation)
+
+    def materialize_entity_embeddings(self, session, batch_size=1000):
+        """ Nothing to materialize, FCNModel transforms entities differently for each relation """
+        tf.logging.info("FCNModel transforms the entities in every evaluation, skip materializing them")
+
+    def _materialized_entities(self, ents, normalized=False, device='/cpu:0', name=None):
+        raise ValueError("FCNModel transforms entities differently for each relation, "
+                         "they can not be materialized once for the evaluation")
+
+    def _eval_translate_triple(self, heads, tails, rels, device):
+        """ The entities are transformed with the relation, so they are transformed again in every evaluation """
+        return self.translate_triple(heads=heads, tails=tails, rels=rels, device=device)
+
     def _transform_relation(self, rels, reuse=True, device='/cpu:0', name=None):
         """
 
@@ -121,31 +171,30 @@ class FCNModel(ContentModel):
         :return:
         """
         with tf.name_scope(name, 'transform_relation',
-                           [rels, self.word_embedding, self.vocab_table,
-                            self.relation_title, self.relation_title_len]):
+                           [rels, self.word_embedding,
+                            self.relation_title, self.relation_title_offsets]):
             tf.logging.debug("[%s] rels shape %s" % (sys._getframe().f_code.co_name,
                                                      rels.get_shape()))
 
             # Here we assume that input relation is always [?, 1] or [?]
             rels = tf.reshape(rels, [-1], name='flatten_rels')
-            orig_rels_shape = tf.shape(rels, name='orig_rels_shape')
 
-            rel_embedding, rel_title_len = entity_content_embedding_lookup(entities=rels,
-                                                                           content=self.relation_title,
-                                                                           content_len=self.relation_title_len,
-                                                                           vocab_table=self.vocab_table,
-                                                                           word_embedding=self.word_embedding,
-                                                                           str_pad=self.PAD,
-                                                                           name='rel_embedding_lookup')
+            # A batch only has a few distinct relations, so each one is only looked up and averaged once
+            def _transform_unique_rels(unique_rels):
+                rel_embedding, rel_title_len = ragged_entity_content_embedding_lookup(entities=unique_rels,
+                                                                                      content=self.relation_title,
+                                                                                      content_offsets=self.relation_title_offsets,
+                                                                                      word_embedding=self.word_embedding,
+                                                                                      pad_id=self.PAD_ID,
+                                                                                      name='rel_embedding_lookup')
+
+                with tf.device(device):
+                    return avg_content(rel_embedding, rel_title_len,
+                                       self.word_embedding[0, :],
+                                       name='avg_rel_embedding')
 
             with tf.device(device):
-                avg_rel_embedding = avg_content(rel_embedding, rel_title_len,
-                                                self.word_embedding[0, :],
-                                                name='avg_rel_embedding')
-                orig_rel_embedding_shape = tf.concat([orig_rels_shape, tf.shape(avg_rel_embedding)[1:]], axis=0,
-                                                     name='orig_rel_embedding_shape')
-                transformed_rels = tf.reshape(avg_rel_embedding, orig_rel_embedding_shape,
-                                              name='transformed_tail_embedding')
+                transformed_rels = transform_unique(rels, _transform_unique_rels, name='unique_rels')
                 tf.logging.debug("[%s] transformed_rels shape %s" % (sys._getframe().f_code.co_name,
                                                                      transformed_rels.get_shape()))
                 return tf.check_numerics(transformed_rels, 'transform_relation')
@@ -161,23 +210,21 @@ class FCNModel(ContentModel):
         :return:
         """
 
-        varlist = [ents, transformed_rels, self.word_embedding, self.vocab_table, self.entity_content,
-                   self.entity_content_len, self.entity_title, self.entity_title_len, self.PAD_const,
+        varlist = [ents, transformed_rels, self.word_embedding, self.entity_content,
+                   self.entity_content_offsets, self.entity_title, self.entity_title_offsets,
                    self.is_train]
 
         with tf.name_scope(name, 'transform_entity', varlist):
-            (ent_content, ent_content_len), (ent_title, ent_title_len) = description_and_title_lookup(ents,
-                                                                                                      self.entity_content,
-                                                                                                      self.entity_content_len,
-                                                                                                      self.entity_title,
-                                                                                                      self.entity_title_len,
-                                                                                                      self.vocab_table,
-                                                                                                      self.word_embedding,
-                                                                                                      self.PAD_const)
-
-            pad_word_embedding = tf.check_numerics(
-                self.word_embedding[tf.cast(self.vocab_table.lookup(self.PAD_const), tf.int32), :],
-                'pad_word_embedding')
+            (ent_content, ent_content_len), (ent_title, ent_title_len) = ragged_description_and_title_lookup(
+                ents,
+                self.entity_content,
+                self.entity_content_offsets,
+                self.entity_title,
+                self.entity_title_offsets,
+                self.word_embedding,
+                self.PAD_ID)
+
+            pad_word_embedding = tf.check_numerics(self.word_embedding[self.PAD_ID, :], 'pad_word_embedding')
 
             with tf.device(device):
                 masked_ent_content = tf.check_numerics(
@@ -201,7 +248,34 @@ class FCNModel(ContentModel):
 
                 return extracted_ent_content, avg_title
 
-    def _transform_head_entity(self, heads, transformed_rels, reuse=True, device='/cpu:0', name=None):
+    def __transform_unique_entity(self, ents, rels, reuse=True, device='/cpu:0', name=None):
+        """ Same as __transform_entity but each (relation, entity) pair is only transformed once
+
+        :param ents: [batch_size or 1, n_entities]
+        :param rels: relation ids of each row in ents, [batch_size] or [batch_size, 1]
+        :param reuse:
+        :param device:
+        :param name:
+        :return: [batch_size, n_entities, word_dim] transformed content and title
+        """
+        with tf.name_scope(name, 'transform_unique_entity', [ents, rels]):
+            # The content mask depends on the relation, so pairs are coded as rel * n_entity + entity
+            rels = tf.cast(tf.reshape(rels, [-1, 1]), tf.int64)
+            pair_codes = rels * self.n_entity + tf.cast(ents, tf.int64)
+
+            def _transform_unique_pairs(unique_codes):
+                unique_rels = tf.cast(unique_codes // self.n_entity, tf.int32)
+                unique_ents = tf.expand_dims(tf.cast(unique_codes % self.n_entity, tf.int32), axis=1)
+                # [n_unique, 1, word_dim]
+                content, title = self.__transform_entity(unique_ents,
+                                                         self._transform_relation(unique_rels, reuse=True,
+                                                                                  device=device),
+                                                         reuse, device)
+                return tf.squeeze(content, axis=1), tf.squeeze(title, axis=1)
+
+            return transform_unique(pair_codes, _transform_unique_pairs, name='unique_pairs')
+
+    def _transform_head_entity(self, heads, transformed_rels, reuse=True, device='/cpu:0', name=None, rels=None):
         """
         This is used to extract entity description and titles.
         :param heads: [?, ?] <- due to evaluation, sometimes heads will be (1, ?) but transformed_rels will still be (batch, word_dim)
@@ -210,27 +284,26 @@ class FCNModel(ContentModel):
         :param reuse:
         :param device:
         :param name:
+        :param rels: relation ids of transformed_rels, if given each (relation, head) pair is transformed once
         :return:
         """
+        if rels is not None:
+            return self.__transform_unique_entity(heads, rels, reuse, device, name='head_entity')
         return self.__transform_entity(heads, transformed_rels, reuse, device, name='head_entity')
 
-    def _transform_tail_entity(self, tails, transformed_rels, reuse=True, device='/cpu:0', name=None):
+    def _transform_tail_entity(self, tails, transformed_rels, reuse=True, device='/cpu:0', name=None, rels=None):
+        if rels is not None:
+            return self.__transform_unique_entity(tails, rels, reuse, device, name='tail_entity')
         return self.__transform_entity(tails, transformed_rels, reuse, device, name='tail_entity')
 
-    def manual_eval_ops_v2(self, device='/cpu:0'):
-        """ Manually evaluate one single partial triple with a given set of targets
+    def manual_eval_ops_v2(self, device='/cpu:0', cache_size_mb=1024):
+        """ Same as ContentModel.manual_eval_ops_v2, the tails are transformed with the relationship
+        in ph_head_rel so it has to be fed to pre_compute_tails as well.
 
-        This function will reduce the computation by reusing the targets of the same
-        relationships.
-
-        To use this method, first calculate the transformed tails of all the targets
-        and put them into a pipeline, then for each head, rel pair we fetch these precomputed
-        target representations and do the calculation to get the similarity score.
-
-        After we evaluated one type of relationship, one needs to manually clean up
-        the queue so it can be reused by next relationship.
+        The content and the title of each tail are cached side by side in one row.
 
         :param device:
+        :param cache_size_mb: memory budget of the pre-computed targets
         :return:
         """
 
@@ -245,19 +318,20 @@ class FCNModel(ContentModel):
                 # indices of true targets in the evaluation set
                 ph_test_target_idx = tf.placeholder(tf.int32, [None], name='ph_test_target_idx')
 
+                # first cache row of the targets (or of ph_eval_targets when pre-computing them)
+                ph_cache_start = tf.placeholder(tf.int32, (), name='ph_cache_start')
                 ph_target_size = tf.placeholder(tf.int32, (), name='ph_target_size')
 
+            target_cache, cache_index = self._create_target_cache('eval_v2_target_cache',
+                                                                  2 * self.word_embedding_size,
+                                                                  cache_size_mb, device=device)
+
+            with tf.device(device):
                 # First, convert string to indices
                 str_heads, str_rels = tf.unstack(ph_head_rel, axis=1)
                 heads = self.entity_table.lookup(str_heads)
                 rels = self.relation_table.lookup(str_rels)
 
-                # A temporary queue for precomputed tails
-                pre_computed_tail_queue = tf.FIFOQueue(1000000, dtypes=[tf.float32, tf.float32],
-                                                       shapes=[[self.word_embedding_size], [self.word_embedding_size]],
-                                                       # This may needs to be change later
-                                                       name='tail_queue')
-
                 # Convert string targets to numerical ids
                 eval_tails = self.entity_table.lookup(ph_eval_targets)
                 # computed tails [1, ?, word_dim]
@@ -266,17 +340,15 @@ class FCNModel(ContentModel):
                                                                 self._transform_tail_entity(eval_tails, computed_rels,
                                                                                             reuse=True, device=device)]
 
-                # put pre-computed tails into target queue
                 # Call this to pre-compute tails for a certain relationship
-                pre_compute_tails = pre_computed_tail_queue.enqueue_many([computed_content_tails, computed_title_tails])
+                pre_compute_tails = tf.scatter_update(target_cache,
+                                                      ph_cache_start + tf.range(tf.shape(computed_content_tails)[0]),
+                                                      tf.concat([computed_content_tails, computed_title_tails], axis=1))
 
-                # get pre-computed tails from target queue
-                dequeue_op = pre_computed_tail_queue.dequeue_many(ph_target_size)
-                tail_content_embeds, tail_title_embeds = [tf.expand_dims(x, axis=0) for x in dequeue_op]
-                # tf.logging.info("tail_embeds shape %s" % tail_embeds.get_shape())
-                # Put tails back into the queue (this will run after tails are dequeued)
-                with tf.control_dependencies(dequeue_op):
-                    re_enqueue = pre_computed_tail_queue.enqueue_many(dequeue_op)
+                # a slice along the first dimension does not copy the cached tails
+                tail_content_embeds, tail_title_embeds = [
+                    tf.expand_dims(x, axis=0) for x in
+                    tf.split(tf.slice(target_cache, [ph_cache_start, 0], [ph_target_size, -1]), 2, axis=1)]
 
                 # Calculate heads and tails
                 computed_content_heads, computd_title_heads = self._transform_head_entity(heads, computed_rels,
@@ -292,15 +364,135 @@ class FCNModel(ContentModel):
 
                 tf.logging.info("eval pred_scores %s" % pred_scores.get_shape())
 
-                ranks, rr = self.eval_helper(pred_scores, ph_test_target_idx, ph_true_target_idx)
+                ranks, rr, metrics = self.eval_helper(pred_scores, ph_test_target_idx, ph_true_target_idx)
 
-                rand_ranks, rand_rr = self.eval_helper(
+                rand_ranks, rand_rr, _ = self.eval_helper(
                     tf.random_uniform(tf.shape(pred_scores), minval=-1, maxval=1, dtype=tf.float32),
                     ph_test_target_idx, ph_true_target_idx)
 
-                return ph_head_rel, ph_eval_targets, ph_target_size, pre_computed_tail_queue.size(), \
+                return ph_head_rel, ph_eval_targets, ph_cache_start, ph_target_size, cache_index, \
                        ph_true_target_idx, ph_test_target_idx, \
-                       pre_compute_tails, re_enqueue, dequeue_op, ranks, rr, rand_ranks, rand_rr, pred_scores
+                       pre_compute_tails, ranks, rr, rand_ranks, rand_rr, pred_scores, metrics
+
+    def _predict_shared(self, head_content, head_title, tail_content, tail_title, device='/cpu:0', reuse=True,
+                        name=None):
+        """ Same as _predict but every head is scored with all tails
+
+        :param head_content: [n_heads, word_dim]
+        :param head_title: [n_heads, word_dim]
+        :param tail_content: [n_tails, word_dim]
+        :param tail_title: [n_tails, word_dim]
+        :return: [n_heads, n_tails]
+        """
+        with tf.name_scope(name, 'predict_shared',
+                           [head_content, head_title, tail_content, tail_title, self.predict_weight]):
+            with tf.variable_scope(self.pred_scope, reuse=reuse):
+                with tf.device(device):
+                    head_content, head_title, tail_content, tail_title = [normalized_embedding(x) for x in
+                                                                          [head_content, head_title, tail_content,
+                                                                           tail_title]]
+
+                    def predict_helper(a, b):
+                        return tf.matmul(a, b, transpose_b=True)
+
+                    sim_scores = tf.stack([predict_helper(head_content, tail_content),
+                                           predict_helper(head_content, tail_title),
+                                           predict_helper(head_title, tail_content),
+                                           predict_helper(head_title, tail_title)], axis=0)
+
+                    return tf.check_numerics(
+                        tf.reduce_sum(sim_scores * self.predict_weight, axis=0, name='orig_pred_score'),
+                        '__predict_shared')
+
+    def batched_eval_ops(self, device='/cpu:0', cache_size_mb=1024):
+        """ Same as ContentModel.batched_eval_ops, the tails are transformed with ph_rel when
+        they are pre-computed so ph_rel has to be fed to pre_compute_tails as well.
+
+        :param device:
+        :param cache_size_mb: memory budget of the pre-computed targets
+        :return:
+        """
+
+        with tf.name_scope("batched_evaluation"):
+            with tf.device(device):
+                # heads to evaluate and their relationship
+                ph_heads = tf.placeholder(tf.string, [None], name='ph_heads')
+                ph_rel = tf.placeholder(tf.string, (), name='ph_rel')
+                # tail targets to evaluate, this can be just part of the total targets
+                ph_eval_targets = tf.placeholder(tf.string, [1, None], name='ph_eval_targets')
+                # indices of true tail targets of each head in the overall target list
+                ph_true_target_idx = tf.placeholder(tf.int32, [None], name='ph_true_target_idx')
+                ph_true_target_offsets = tf.placeholder(tf.int64, [None], name='ph_true_target_offsets')
+                # indices of true targets of each head in the evaluation set
+                ph_test_target_idx = tf.placeholder(tf.int32, [None], name='ph_test_target_idx')
+                ph_test_target_offsets = tf.placeholder(tf.int64, [None], name='ph_test_target_offsets')
+
+                # first cache row of the targets (or of ph_eval_targets when pre-computing them)
+                ph_cache_start = tf.placeholder(tf.int32, (), name='ph_cache_start')
+                ph_target_size = tf.placeholder(tf.int32, (), name='ph_target_size')
+
+            # content and title of each tail side by side
+            target_cache, cache_index = self._create_target_cache('batched_eval_target_cache',
+                                                                  2 * self.word_embedding_size,
+                                                                  cache_size_mb, device=device)
+
+            with tf.device(device):
+                # [1]
+                rels = self.relation_table.lookup(tf.expand_dims(ph_rel, axis=0))
+                computed_rels = self._transform_relation(rels, reuse=True, device=device)
+
+                # computed tails [?, word_dim]
+                eval_tails = self.entity_table.lookup(ph_eval_targets)
+                computed_content_tails, computed_title_tails = [tf.squeeze(x, axis=0) for x in
+                                                                self._transform_tail_entity(eval_tails, computed_rels,
+                                                                                            reuse=True, device=device,
+                                                                                            rels=rels)]
+                self.eval_computed_tails = tf.concat([computed_content_tails, computed_title_tails], axis=1)
+                pre_compute_tails = tf.scatter_update(target_cache,
+                                                      ph_cache_start + tf.range(tf.shape(self.eval_computed_tails)[0]),
+                                                      self.eval_computed_tails)
+
+                # tails computed before, e.g. found in EntityEmbeddingCache
+                self.ph_eval_tail_embeds = tf.placeholder(tf.float32, [None, 2 * self.word_embedding_size],
+                                                          name='ph_eval_tail_embeds')
+                self.eval_write_tails = tf.scatter_update(target_cache,
+                                                          ph_cache_start + tf.range(
+                                                              tf.shape(self.ph_eval_tail_embeds)[0]),
+                                                          self.ph_eval_tail_embeds)
+
+                # a slice along the first dimension does not copy the cached tails
+                tail_content_embeds, tail_title_embeds = tf.split(
+                    tf.slice(target_cache, [ph_cache_start, 0], [ph_target_size, -1]), 2, axis=1)
+
+                # All heads share the relationship, [1, n_heads]
+                heads = tf.expand_dims(self.entity_table.lookup(ph_heads), axis=0)
+                computed_content_heads, computed_title_heads = [tf.squeeze(x, axis=0) for x in
+                                                                self._transform_head_entity(heads, computed_rels,
+                                                                                            reuse=True, device=device,
+                                                                                            rels=rels)]
+
+                # [n_heads, n_targets]
+                pred_scores = self._predict_shared(computed_content_heads,
+                                                   computed_title_heads,
+                                                   tail_content_embeds,
+                                                   tail_title_embeds,
+                                                   device=device,
+                                                   reuse=True)
+
+                tf.logging.info("batched eval pred_scores %s" % pred_scores.get_shape())
+
+                ranks, rr, metrics = self.batched_eval_helper(pred_scores,
+                                                     ph_test_target_idx, ph_test_target_offsets,
+                                                     ph_true_target_idx, ph_true_target_offsets)
+
+                rand_ranks, rand_rr, _ = self.batched_eval_helper(
+                    tf.random_uniform(tf.shape(pred_scores), minval=-1, maxval=1, dtype=tf.float32),
+                    ph_test_target_idx, ph_test_target_offsets,
+                    ph_true_target_idx, ph_true_target_offsets)
+
+                return ph_heads, ph_rel, ph_eval_targets, ph_cache_start, ph_target_size, cache_index, \
+                       ph_true_target_idx, ph_true_target_offsets, ph_test_target_idx, ph_test_target_offsets, \
+                       pre_compute_tails, ranks, rr, rand_ranks, rand_rr, pred_scores, metrics
 
 
 def main(_):
@@ -309,6 +501,8 @@ def main(_):
     tf.logging.set_verbosity(tf.logging.INFO)
     CHECKPOINT_DIR = sys.argv[1]
     dataset_dir = sys.argv[2]
+    # compiled by tools/compile_dataset.py
+    bundle_dir = os.path.join(dataset_dir, 'dataset.bundle')
 
     is_train = len(sys.argv) == 4 and sys.argv[3] != 'eval'
 
@@ -336,6 +530,8 @@ def main(_):
 
                      train_file=os.path.join(dataset_dir, 'train.txt'),
 
+                     dataset_bundle=bundle_dir if os.path.exists(bundle_dir) else None,
+
                      num_epoch=10,
                      word_oov=100,
                      word_embedding_size=200,
@@ -349,11 +545,19 @@ def main(_):
                                                        devices=['/gpu:0', '/gpu:1', '/gpu:2'])
     else:
         tf.logging.info("Evaluate mode")
-        ph_head_rel, ph_eval_targets, ph_target_size, q_size, ph_true_target_idx, \
-        ph_test_target_idx, pre_compute_tails, re_enqueue, dequeue_op, ranks, rr, rand_ranks, rand_rr, _ = model.manual_eval_ops_v2(
-            '/gpu:3')
+        ph_heads, ph_rel, ph_eval_targets, ph_cache_start, ph_target_size, target_cache, \
+        ph_true_target_idx, ph_true_target_offsets, ph_test_target_idx, ph_test_target_offsets, \
+        pre_compute_tails, ranks, rr, rand_ranks, rand_rr, _, _ = model.batched_eval_ops('/gpu:3')
 
     EVAL_BATCH = 500
+    # Number of heads of the same relationship scored in one run
+    EVAL_HEAD_BATCH = 256
+    # Host cache of the transformed (target, relation) pairs of the restored checkpoint. Every pair
+    # is only needed once per run, set a directory to keep them for the next evaluation of the
+    # same checkpoint (e.g. on another evaluation file)
+    TAIL_CACHE_DIR = None
+    TAIL_CACHE_MB = 2048
+    TAIL_CACHE_SPILL_MB = 8192
     # ph_eval_triples, triple_enqueue_op, batch_data_op, batch_pred_score_op, metric_update_ops = model.auto_eval_ops(
     #     batch_size=EVAL_BATCH,
     #     n_splits=EVAL_SPLITS,
@@ -457,19 +661,23 @@ def main(_):
             print(sess.run(model.is_train))
             # ph_head_rel, ph_eval_targets, ph_true_target_idx, ph_test_target_idx, ranks, rr
 
-            # First load evaluation data
-            # {rel : {head : [tails]}}
-            evaluation_data = load_manual_evaluation_file_by_rel(os.path.join(dataset_dir, 'test.txt'),
-                                                                 os.path.join(dataset_dir, 'avoid_entities.txt'))
-            tf.logging.info("Number of relationships in the evaluation file %d" % len(evaluation_data))
-            relation_specific_targets = load_relation_specific_targets(
-                os.path.join(dataset_dir, 'train.heads.idx'),
-                os.path.join(dataset_dir, 'relations.txt'))
-            filtered_targets = load_filtered_targets(os.path.join(dataset_dir, 'eval.tails.idx'),
-                                                     os.path.join(dataset_dir, 'eval.tails.values.closed'))
-
+            # First load evaluation data, candidate targets of each relation and
+            # the positions of test/true targets of each (head, rel) in the candidates
+            evaluation_index = EvaluationIndex(dataset_dir)
+            tf.logging.info("Number of relationships in the evaluation file %d" % len(evaluation_index))
+
+            tail_cache = None
+            if TAIL_CACHE_DIR is not None:
+                tail_width = 2 * model.word_embedding_size
+                # cached tails are only valid for the restored variables
+                tail_cache = EntityEmbeddingCache((TAIL_CACHE_MB << 20) // (4 * tail_width), tail_width,
+                                                  sess.run(model.global_step),
+                                                  spill_dir=TAIL_CACHE_DIR,
+                                                  spill_rows=(TAIL_CACHE_SPILL_MB << 20) // (4 * tail_width))
+
+            hits_at = [1, 3, 10]
             fieldnames = ['relationship', 'mean_rank', 'mrr', 'mrr_per_triple', 'rand_mean_rank', 'rand_mrr',
-                          'rand_mrr_per_triple', 'miss', 'triples', 'targets']
+                          'rand_mrr_per_triple', 'miss', 'triples', 'targets'] + ['hits@%d' % k for k in hits_at]
             csvfile = open(os.path.join(CHECKPOINT_DIR, 'eval.%d.csv' % sess.run(model.global_step)), 'w', newline='')
             csv_writer = csv.DictWriter(csvfile, fieldnames)
             csv_writer.writeheader()
@@ -487,24 +695,46 @@ def main(_):
             # New evaluation method - evaluate by relationship
             missed = 0
             trips = 0
-            for c, rel_str in enumerate(evaluation_data.keys()):
-
-                if rel_str not in relation_specific_targets:
-                    tf.logging.warning("Relation %s does not have any valid targets!" % rel_str)
-                    continue
+            for c in range(len(evaluation_index)):
+                rel_str = evaluation_index.relation_names[evaluation_index.relations[c]]
                 # First pre-compute the target embeddings
-                eval_targets_set = relation_specific_targets[rel_str]
-                eval_targets = list(eval_targets_set)
+                eval_targets = evaluation_index.entity_names[evaluation_index.candidate_targets(c)]
 
                 tf.logging.debug("\nRelation %s : %d" % (rel_str, len(eval_targets)))
-                start = 0
-                while start < len(eval_targets):
-                    end = min(start + EVAL_BATCH, len(eval_targets))
-                    sess.run(pre_compute_tails, feed_dict={ph_head_rel: [[rel_str, rel_str]],
-                                                           ph_eval_targets: [eval_targets[start:end]]})
-                    start = end
-
-                assert sess.run(q_size) == len(eval_targets)
+                cache_start, cached = target_cache.lookup(rel_str, len(eval_targets))
+                if not cached:
+                    candidates = evaluation_index.candidate_targets(c)
+                    if tail_cache is None:
+                        tail_embeds, misses = None, np.arange(len(candidates))
+                    else:
+                        tail_embeds, misses = tail_cache.get(candidates, evaluation_index.relations[c])
+
+                    if len(misses) == len(candidates):
+                        # Nothing cached on the host, transform the tails right into the target cache
+                        # and only fetch them if they have to be kept for the next run
+                        for start in range(0, len(eval_targets), EVAL_BATCH):
+                            feed_dict = {ph_rel: rel_str,
+                                         ph_cache_start: cache_start + start,
+                                         ph_eval_targets: [eval_targets[start:start + EVAL_BATCH].tolist()]}
+                            if tail_cache is None:
+                                sess.run(pre_compute_tails.op, feed_dict=feed_dict)
+                            else:
+                                _, tail_embeds[start:start + EVAL_BATCH] = sess.run(
+                                    [pre_compute_tails.op, model.eval_computed_tails], feed_dict=feed_dict)
+                    else:
+                        # Only transform the (target, relation) pairs that are not cached on the host
+                        for start in range(0, len(misses), EVAL_BATCH):
+                            batch = misses[start:start + EVAL_BATCH]
+                            tail_embeds[batch] = sess.run(model.eval_computed_tails,
+                                                          feed_dict={ph_rel: rel_str,
+                                                                     ph_eval_targets: [eval_targets[batch].tolist()]})
+                        for start in range(0, len(eval_targets), EVAL_BATCH):
+                            sess.run(model.eval_write_tails,
+                                     feed_dict={ph_cache_start: cache_start + start,
+                                                model.ph_eval_tail_embeds: tail_embeds[start:start + EVAL_BATCH]})
+
+                    if tail_cache is not None and len(misses):
+                        tail_cache.put(candidates[misses], evaluation_index.relations[c], tail_embeds[misses])
 
                 # Performance of a single relationship
                 rel_ranks = list()
@@ -515,62 +745,60 @@ def main(_):
                 rel_random_multi_rr = list()
                 rel_miss = 0
                 rel_trips = 0
-                for head_str, eval_true_targets_set in evaluation_data[rel_str].items():
-                    head_rel = [[head_str, rel_str]]
-                    head_rel_str = "\t".join([head_str, rel_str])
-
-                    # Find true targets (in train/valid/test) of the given head relation
-                    # in the evaluation set and skip all others
-                    true_targets = set(filtered_targets[head_rel_str]).intersection(eval_targets_set)
-
-                    # find true evaluation targets in the test set that are in this set
-                    eval_true_targets = set.intersection(eval_targets_set, eval_true_targets_set)
-
+                # test_target_idx: true evaluation targets in the test set that are in the candidates
+                # true_target_idx: true targets (in train/valid/test) of the given head relation in the candidates
+                for heads, test_target_idx, test_target_offsets, true_target_idx, true_target_offsets, misses in \
+                        evaluation_index.query_batches(c, EVAL_HEAD_BATCH):
                     # how many true targets we missed/filtered out
-                    rel_miss += len(eval_true_targets_set) - len(eval_true_targets)
-                    missed += len(eval_true_targets_set) - len(eval_true_targets)
-
-                    test_target_idx = sorted([eval_targets.index(x) for x in eval_true_targets])
-                    true_target_idx = sorted([eval_targets.index(x) for x in true_targets])
-
-                    assert len(true_target_idx) >= len(test_target_idx)
-
-                    _ranks, _rr, _rand_ranks, _rand_rr, _ = sess.run([ranks, rr, rand_ranks, rand_rr, re_enqueue],
-                                                                     feed_dict={ph_head_rel: head_rel,
-                                                                                ph_target_size: len(eval_targets_set),
-                                                                                ph_true_target_idx: true_target_idx,
-                                                                                ph_test_target_idx: test_target_idx})
-
-                    assert sess.run(q_size) == len(eval_targets)
-
-                    if len(_ranks):
-                        rel_ranks.extend([float(x) for x in _ranks])
-                        all_ranks.extend([float(x) for x in _ranks])
-                        all_rr.append(_rr)
-                        rel_rr.append(_rr)
-                        all_multi_rr.extend([np.max([1.0 / float(x) for x in _ranks])] * len(_ranks))
-                        rel_multi_rr.extend([np.max([1.0 / float(x) for x in _ranks])] * len(_ranks))
-
-                        random_ranks.extend([float(x) for x in _rand_ranks])
-                        rel_random_ranks.extend([float(x) for x in _rand_ranks])
-                        random_rr.append(_rand_rr)
-                        rel_random_rr.append(_rand_rr)
-                        random_multi_rr.extend([np.max([1.0 / float(x) for x in _rand_ranks])] * len(_rand_ranks))
-                        rel_random_multi_rr.extend([np.max([1.0 / float(x) for x in _rand_ranks])] * len(_rand_ranks))
-                        rel_trips += len(_ranks)
-                        trips += len(_ranks)
+                    rel_miss += int(np.sum(misses))
+                    missed += int(np.sum(misses))
+                    if not len(eval_targets):
+                        # the relation has no candidates, every test target is missed
+                        continue
+
+                    assert np.all(np.diff(true_target_offsets) >= np.diff(test_target_offsets))
+
+                    _ranks, _rr, _rand_ranks, _rand_rr = sess.run([ranks, rr, rand_ranks, rand_rr],
+                                                                  feed_dict={ph_heads: evaluation_index.entity_names[heads].tolist(),
+                                                                             ph_rel: rel_str,
+                                                                             ph_cache_start: cache_start,
+                                                                             ph_target_size: len(eval_targets),
+                                                                             ph_true_target_idx: true_target_idx,
+                                                                             ph_true_target_offsets: true_target_offsets,
+                                                                             ph_test_target_idx: test_target_idx,
+                                                                             ph_test_target_offsets: test_target_offsets})
+
+                    # ranks of the i-th head are _ranks[test_target_offsets[i]:test_target_offsets[i + 1]]
+                    for i in range(len(heads)):
+                        head_ranks = _ranks[test_target_offsets[i]:test_target_offsets[i + 1]]
+                        head_rand_ranks = _rand_ranks[test_target_offsets[i]:test_target_offsets[i + 1]]
+                        if not len(head_ranks):
+                            continue
+                        rel_ranks.extend([float(x) for x in head_ranks])
+                        all_ranks.extend([float(x) for x in head_ranks])
+                        all_rr.append(_rr[i])
+                        rel_rr.append(_rr[i])
+                        all_multi_rr.extend([np.max([1.0 / float(x) for x in head_ranks])] * len(head_ranks))
+                        rel_multi_rr.extend([np.max([1.0 / float(x) for x in head_ranks])] * len(head_ranks))
+
+                        random_ranks.extend([float(x) for x in head_rand_ranks])
+                        rel_random_ranks.extend([float(x) for x in head_rand_ranks])
+                        random_rr.append(_rand_rr[i])
+                        rel_random_rr.append(_rand_rr[i])
+                        random_multi_rr.extend([np.max([1.0 / float(x) for x in head_rand_ranks])] * len(head_rand_ranks))
+                        rel_random_multi_rr.extend(
+                            [np.max([1.0 / float(x) for x in head_rand_ranks])] * len(head_rand_ranks))
+                        rel_trips += len(head_ranks)
+                        trips += len(head_ranks)
                     print("%d/%d %d "
                           "MR %.4f (%.4f) "
                           "MRR(per head,rel) %.4f (%.4f) "
                           "MRR(per tail) %.4f (%.4f) missed %d" % (
-                              c + 1, len(evaluation_data), len(all_ranks),
+                              c + 1, len(evaluation_index), len(all_ranks),
                               np.mean(all_ranks), np.mean(random_ranks),
                               np.mean(all_rr), np.mean(random_rr),
                               np.mean(all_multi_rr), np.mean(random_multi_rr),
                               missed), end='\r')
-                    # clean up precomputed targets
-                sess.run(dequeue_op, feed_dict={ph_target_size: len(eval_targets_set)})
-                assert sess.run(q_size) == 0
 
                 csv_writer.writerow({'relationship': rel_str,
                                      'mean_rank': np.mean(rel_ranks),
@@ -581,7 +809,8 @@ def main(_):
                                      'rand_mrr_per_triple': np.mean(rel_random_multi_rr),
                                      'miss': rel_miss,
                                      'triples': rel_trips,
-                                     'targets': len(eval_targets_set)})
+                                     'targets': len(eval_targets),
+                                     **{'hits@%d' % k: np.mean(np.asarray(rel_ranks) <= k) for k in hits_at}})
 
             print("\n%d "
                   "MR %.4f (%.4f) "
@@ -592,6 +821,9 @@ def main(_):
                       np.mean(all_rr), np.mean(random_rr),
                       np.mean(all_multi_rr), np.mean(random_multi_rr),
                       missed))
+            if tail_cache is not None:
+                tail_cache.save()
+                tf.logging.info("Tail cache hits %d misses %d" % (tail_cache.hits, tail_cache.misses))
 
             csv_writer.writerow({'relationship': 'OVERALL',
                                  'mean_rank': np.mean(all_ranks),
@@ -602,7 +834,8 @@ def main(_):
                                  'rand_mrr_per_triple': np.mean(random_multi_rr),
                                  'miss': missed,
                                  'triples': trips,
-                                 'targets': -1})
+                                 'targets': -1,
+                                 **{'hits@%d' % k: np.mean(np.asarray(all_ranks) <= k) for k in hits_at}})
 
             csvfile.close()
             exit(0)
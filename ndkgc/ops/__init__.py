@@ -1,4 +1,6 @@
 from ndkgc.ops.corruption import *
 from ndkgc.ops.content import *
+from ndkgc.ops.dataset import shuffled_indices, timed_input_step
 from ndkgc.ops.lookup import *
-from ndkgc.ops.multigpu import avg_grads
\ No newline at end of file
+from ndkgc.ops.multigpu import avg_grads
+from ndkgc.ops.ranking import filtered_ranks, rank_metrics
\ No newline at end of file
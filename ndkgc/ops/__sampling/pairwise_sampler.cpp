@@ -87,6 +87,103 @@ namespace {
     }
   };
 
+  Status BatchNegativeSamplingShapeFn(InferenceContext *c) {
+    int32 num_sampled;
+    TF_RETURN_IF_ERROR(c->GetAttr("num_sampled", &num_sampled));
+    // one row per target offset except the last one
+    DimensionHandle batch_size;
+    TF_RETURN_IF_ERROR(c->Subtract(c->Dim(c->input(1), 0), 1, &batch_size));
+    c->set_output(0, c->Matrix(batch_size, num_sampled));
+    return Status::OK();
+  }
+
+  class BatchNegativeSamplingOp : public OpKernel {
+  private:
+    int _num_sampled;
+    int _max_range;
+  public:
+    explicit BatchNegativeSamplingOp(OpKernelConstruction *context) : OpKernel(context) {
+        OP_REQUIRES_OK(context, context->GetAttr("num_sampled", &_num_sampled));
+        OP_REQUIRES_OK(context, context->GetAttr("max_range", &_max_range));
+    }
+    void Compute(OpKernelContext *context) override {
+        const Tensor &input_targets = context->input(0);
+        OP_REQUIRES(context, TensorShapeUtils::IsVector(input_targets.shape()),
+                    errors::InvalidArgument("targets must be a vector"));
+        const Tensor &input_target_offsets = context->input(1);
+        OP_REQUIRES(context, TensorShapeUtils::IsVector(input_target_offsets.shape()) &&
+                             input_target_offsets.dim_size(0) > 0,
+                    errors::InvalidArgument("target_offsets must be a non-empty vector"));
+        const Tensor &input_candidates = context->input(2);
+        OP_REQUIRES(context, TensorShapeUtils::IsVector(input_candidates.shape()),
+                    errors::InvalidArgument("candidates must be a vector"));
+
+        const int32 *targets = input_targets.vec<int32>().data();
+        const int64 *target_offsets = input_target_offsets.vec<int64>().data();
+        const int32 *candidates = input_candidates.vec<int32>().data();
+        // sample from [0, max_range] if max_range is set, otherwise sample from the candidates
+        const int64 num_candidates = _max_range >= 0 ? static_cast<int64>(_max_range) + 1
+                                                     : input_candidates.dim_size(0);
+        const int64 batch_size = input_target_offsets.dim_size(0) - 1;
+        OP_REQUIRES(context, target_offsets[batch_size] <= input_targets.dim_size(0),
+                    errors::InvalidArgument("target_offsets is out of the range of targets"));
+
+        Tensor *output_false_targets = nullptr;
+        TensorShape output_shape;
+        output_shape.AddDim(batch_size);
+        output_shape.AddDim(_num_sampled);
+        OP_REQUIRES_OK(context, context->allocate_output(0, output_shape, &output_false_targets));
+        int32 *false_targets = output_false_targets->matrix<int32>().data();
+
+        std::random_device rd;
+        std::mt19937 gen(rd());
+        std::uniform_int_distribution<int64> distribution(0, num_candidates - 1);
+
+        std::unordered_set<int32> avoids;
+        std::unordered_set<int32> valid_candidates;
+        for (int64 i = 0; i < batch_size; ++i) {
+          const int64 start = target_offsets[i];
+          const int64 end = target_offsets[i + 1];
+          OP_REQUIRES(context, start <= end, errors::InvalidArgument("target_offsets must be non-decreasing"));
+          // reuse the set so the buckets are only allocated once per batch
+          avoids.clear();
+          avoids.insert(targets + start, targets + end);
+          // the rejection sampling below only ends if there are num_sampled distinct candidates that
+          // are not targets of this row, candidates may repeat and targets may not be candidates
+          int64 num_valid = num_candidates;
+          if (_max_range >= 0) {
+            for (const int32 target : avoids) {
+              if (target >= 0 && target <= _max_range) {
+                --num_valid;
+              }
+            }
+          } else {
+            // the scan stops as soon as there are enough, so only a few candidates are read
+            valid_candidates.clear();
+            for (int64 j = 0; j < num_candidates && valid_candidates.size() < static_cast<size_t>(_num_sampled); ++j) {
+              if (avoids.count(candidates[j]) == 0) {
+                valid_candidates.insert(candidates[j]);
+              }
+            }
+            num_valid = static_cast<int64>(valid_candidates.size());
+          }
+          OP_REQUIRES(context, num_valid >= _num_sampled,
+                      errors::InvalidArgument(
+                          "There is not enough candidates to sample for row ", i, ". ", num_valid,
+                          " distinct candidates are not targets but num_sampled is ", _num_sampled));
+          int num_sampled = 0;
+          while (num_sampled < _num_sampled) {
+            const int64 idx = distribution(gen);
+            const int32 sampled = _max_range >= 0 ? static_cast<int32>(idx) : candidates[idx];
+            if (gtl::InsertIfNotPresent(&avoids, sampled)) {
+              false_targets[i * _num_sampled + num_sampled] = sampled;
+              ++num_sampled;
+            }
+          }
+        }
+    }
+  };
+
   class SingleNegativeSamplingOp : public OpKernel {
   private:
       int _max_range;
@@ -245,6 +342,25 @@ REGISTER_OP("MultipleNegativeSampling")
 Sample `num_sampled` negative example in range[0, max_range] that does not overlaps with targets.
 )doc");
 
+REGISTER_KERNEL_BUILDER(Name("BatchNegativeSampling").Device(DEVICE_CPU), BatchNegativeSamplingOp);
+REGISTER_OP("BatchNegativeSampling")
+    .Input("targets: int32")
+    .Input("target_offsets: int64")
+    .Input("candidates: int32")
+    .Attr("num_sampled: int")
+    .Attr("max_range: int = -1")
+    .Output("false_targets: int32")
+    .SetShapeFn(BatchNegativeSamplingShapeFn)
+    .Doc(R"doc(
+Sample `num_sampled` negative examples for each row of a batch in one call.
+
+  The targets to avoid are in CSR format, targets of row i are
+targets[target_offsets[i]:target_offsets[i + 1]]. Negative examples are sampled from
+range[0, max_range] if `max_range` is not negative, otherwise from `candidates`.
+
+`false_targets` is a [batch_size, num_sampled] matrix of negative examples
+)doc");
+
 REGISTER_KERNEL_BUILDER(Name("PairwiseSampling").Device(DEVICE_CPU), PairwiseSamplingOp);
 REGISTER_OP("PairwiseSampling")
     .Input("known_entities: int32")
@@ -2,6 +2,8 @@ import tensorflow as tf
 import tensorflow.contrib.lookup as lookup
 from tensorflow.contrib.layers import xavier_initializer
 
+from ndkgc.ops.lookup import ragged_lookup
+
 
 def get_content_matrix(variable_scope, size, reuse=True, device='/cpu:0'):
     """ Return content matrix
@@ -108,6 +110,59 @@ def entity_content_embedding_lookup(entities, content, content_len, vocab_table,
             return ent_embedding, content_len
 
 
+def ragged_content_lookup(content, content_offsets, id, name=None):
+    """ Lookup a single entity's pre-tokenized content from a CSR content store.
+
+    :param content: A 1-D int32 word id vector of all entities
+    :param content_offsets: A 1-D [n_entity + 1] offset vector
+    :param id: A scalar
+    :param name:
+    :return: Extract ids, 1-d vector
+    """
+    with tf.name_scope(name, 'ragged_content_lookup', [content, content_offsets, id]):
+        start = content_offsets[id]
+        return content[start:content_offsets[id + 1]]
+
+
+def multiple_ragged_content_lookup(content, content_offsets, ids, pad_id=0, name=None):
+    """
+
+    :param content: A 1-D int32 word id vector of all entities
+    :param content_offsets: A 1-D [n_entity + 1] offset vector
+    :param ids:
+    :param pad_id:
+    :param name:
+    :return: 2-D [batch_size, max_length_in_batch] content id matrix,
+             1-D [batch_size] content len vector
+    """
+    with tf.name_scope(name, 'multiple_ragged_content_lookup', [content, content_offsets, ids]):
+        return ragged_lookup(content, content_offsets, ids, default_value=pad_id, name='dense_content')
+
+
+def ragged_entity_content_embedding_lookup(entities, content, content_offsets, word_embedding, pad_id=0, name=None):
+    """ Same as entity_content_embedding_lookup but the content is stored as word ids
+    in a CSR layout, so there is no string processing.
+
+    :param entities: Must be a 1-D entity vector
+    :param content: A 1-D int32 word id vector of all entities
+    :param content_offsets: A 1-D [n_entity + 1] offset vector
+    :param word_embedding:
+    :param pad_id: word id of the padding word
+    :param name:
+    :return:
+    """
+    with tf.device('/cpu:0'):
+        with tf.name_scope(name, 'ragged_entity_content_lookup',
+                           [entities, content, content_offsets, word_embedding]):
+            ent_content_ids, content_len = ragged_lookup(content, content_offsets, entities,
+                                                         default_value=pad_id,
+                                                         name='ent_content_ids')
+            ent_embedding = tf.check_numerics(tf.nn.embedding_lookup(word_embedding, ent_content_ids),
+                                              'ragged_entity_content_embedding_lookup')
+
+            return ent_embedding, content_len
+
+
 def avg_content(content_embedding, content_len, padding_embedding, name=None):
     """ Content embedding without padding embeddings
 
@@ -207,6 +262,54 @@ def description_and_title_lookup(entities, content, content_len,
         return (content_embedding, content_true_len), (title_embedding, title_true_len)
 
 
+def ragged_description_and_title_lookup(entities, content, content_offsets,
+                                        title, title_offsets, word_embedding, pad_id=0, name=None):
+    """ Same as description_and_title_lookup but read from CSR word id stores.
+
+    :param entities:
+    :param content:
+    :param content_offsets:
+    :param title:
+    :param title_offsets:
+    :param word_embedding:
+    :param pad_id:
+    :param name:
+    :return: see description_and_title_lookup
+    """
+    varlist = [entities, content, content_offsets, title, title_offsets, word_embedding]
+    with tf.name_scope(name, 'ragged_desc_title_lookup', varlist):
+        flatten_entities = tf.reshape(entities, [-1], 'flatten_entities')
+
+        content_embedding, content_true_len = ragged_entity_content_embedding_lookup(flatten_entities,
+                                                                                     content,
+                                                                                     content_offsets,
+                                                                                     word_embedding,
+                                                                                     pad_id,
+                                                                                     name='desc')
+
+        title_embedding, title_true_len = ragged_entity_content_embedding_lookup(flatten_entities,
+                                                                                 title,
+                                                                                 title_offsets,
+                                                                                 word_embedding,
+                                                                                 pad_id,
+                                                                                 name='title')
+
+        content_embedding, title_embedding = [tf.reshape(x,
+                                                         tf.concat([tf.shape(entities),
+                                                                    tf.shape(x)[1:]], axis=0),
+                                                         y) for x, y in
+                                              zip([content_embedding, title_embedding],
+                                                  ['content_word_embedding',
+                                                   'title_word_embedding'])]
+
+        content_true_len, title_true_len = [tf.reshape(x, tf.shape(entities), y) for x, y in
+                                            zip([content_true_len, title_true_len],
+                                                ['content_sequence_len',
+                                                 'title_sequence_len'])]
+
+        return (content_embedding, content_true_len), (title_embedding, title_true_len)
+
+
 def mask_content_embedding(entity_embeddings, relation_embeddings, prev_window_size=5, name=None):
     """ Calculate the similarity
 
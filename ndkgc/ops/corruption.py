@@ -3,43 +3,54 @@ import sys
 import tensorflow as tf
 import tensorflow.contrib.lookup as lookup
 
-from ndkgc.ops.sampling import single_negative_sampling, multiple_negative_sampling
+from ndkgc.ops.lookup import ragged_lookup
+from ndkgc.ops.sampling import single_negative_sampling, batch_negative_sampling
 
 __corrupt_head = ['h', 'head']
 __corrupt_tail = ['t', 'tail']
 
 
+def _true_triple_targets(key_first, key_second, triple_index, name=None):
+    """ Get the values of a single key from a sorted triple index
+
+    :param key_first: scalar
+    :param key_second: scalar
+    :param triple_index: (target index table, values, offsets), see index_triples
+    :param name:
+    :return: 1-D values
+    """
+    table, values, offsets = triple_index
+    return get_target_entities(tf.reshape(key_first, [1]), tf.reshape(key_second, [1]),
+                               table, values, offsets, name=name).values
+
+
 def _corrupt_single_entity_helper(triple: tf.Tensor,
-                                  all_triples: tf.Tensor,
+                                  triple_index,
                                   corrupt_type: str, max_range: int,
                                   debug_corrupted_counter=None,
                                   name=None):
     """ Corrupt the entity by __sampling from [0, max_range] and not in the true target set.
 
     :param triple:
-    :param all_triples:
+    :param triple_index: (target index table, values, offsets) of the true heads of each
+        (relation, tail) for head corruption or the true tails of each (relation, head) for tail corruption
     :param corrupt_type:
     :param max_range:
     :param name:
     :return: corrupted 1-d [h,r,t] triple
     """
-    with tf.name_scope(name, "corrupt_an_entity", [triple, all_triples]):
-        with tf.control_dependencies([debug_corrupted_counter.assign_add(1)]):
+    with tf.name_scope(name, "corrupt_an_entity", [triple]):
+        counter_deps = [] if debug_corrupted_counter is None else [debug_corrupted_counter.assign_add(1)]
+        with tf.control_dependencies(counter_deps):
             h, r, t = tf.unstack(triple, name='unstack_triple', axis=0)
 
-            # do relation match first to reduce future search space
-            rel_mask = tf.equal(all_triples[:, 1], r, name='rel_mask')
-            rel_matched_triples = tf.boolean_mask(all_triples, rel_mask, name='rel_matched_triples')
-
             if corrupt_type.lower() in __corrupt_head:
                 # corrupt on head, so find all [?, r, t] pairs and get all positive head
-                tail_mask = tf.equal(rel_matched_triples[:, 2], t)
-                true_head_targets = tf.boolean_mask(rel_matched_triples[:, 0], tail_mask, name='true_head_targets')
+                true_head_targets = _true_triple_targets(r, t, triple_index, name='true_head_targets')
                 corrupted_head = tf.reshape(single_negative_sampling(true_head_targets, max_range), ())
                 return tf.stack([corrupted_head, r, t], name='head_corrupted_triple', axis=0)
             elif corrupt_type.lower() in __corrupt_tail:
-                head_mask = tf.equal(rel_matched_triples[:, 0], h)
-                true_tail_targets = tf.boolean_mask(rel_matched_triples[:, 1], head_mask, name='true_tail_targets')
+                true_tail_targets = _true_triple_targets(r, h, triple_index, name='true_tail_targets')
                 corrupted_tail = tf.reshape(single_negative_sampling(true_tail_targets, max_range), ())
                 return tf.stack([h, r, corrupted_tail], name='tail_corrupted_triple', axis=0)
             else:
@@ -47,143 +58,322 @@ def _corrupt_single_entity_helper(triple: tf.Tensor,
 
 
 def corrupt_single_relationship(triple: tf.Tensor,
-                                all_triples: tf.Tensor,
+                                relation_index,
                                 max_range: int,
                                 name=None):
     """ Corrupt the relationship by __sampling from [0, max_range]
 
     :param triple:
-    :param all_triples:
+    :param relation_index: (target index table, values, offsets) of the true relations of each (head, tail)
     :param max_range:
     :param name:
     :return: corrupted 1-d [h,r,t] triple
     """
-    with tf.name_scope(name, 'corrupt_single_relation', [triple, all_triples]):
+    with tf.name_scope(name, 'corrupt_single_relation', [triple]):
         h, r, t = tf.unstack(triple, name='unstack_triple')
 
-        head_mask = tf.equal(all_triples[:, 0], h, name='head_mask')
-        head_matched_triples = tf.boolean_mask(all_triples[:, 1:], head_mask, name='head_matched_triples')
-
-        tail_mask = tf.equal(head_matched_triples[:, 1], t, name='tail_mask')
-        true_rels = tf.boolean_mask(head_matched_triples[:, 0], tail_mask)
+        true_rels = _true_triple_targets(h, t, relation_index, name='true_rels')
 
         corrupted_rel = tf.reshape(single_negative_sampling(true_rels, max_range), ())
 
         return tf.stack([h, corrupted_rel, t], name='rel_corrupted_triple')
 
 
+def target_index_key(entity, relation, name=None):
+    """ int64 key of (entity, relation) pairs in a target index, the entity id is in the
+    high 32 bits and the relation id is in the low 32 bits.
+    """
+    with tf.name_scope(name, 'target_index_key', [entity, relation]):
+        return tf.add(tf.cast(entity, tf.int64) * (1 << 32), tf.cast(relation, tf.int64), name='ent_rel_key')
+
+
+def get_target_index_table(keys, name=None):
+    """ Create an int64 (entity, relation) key -> row id hash table of a CSR target array,
+    row i of the target array belongs to keys[i].
+
+    The keys are usually a variable loaded after the tables are initialized, so the table
+    is filled by running the returned insert op after loading the keys. The table is derived
+    from the keys and is not saved in checkpoints, restoring a checkpoint must not replace it
+    with a stale copy.
+
+    :param keys: 1-D int64 keys, see target_index_key
+    :param name:
+    :return: table, insert op
+    """
+    with tf.name_scope(name, 'target_index_table', [keys]):
+        table = lookup.MutableHashTable(key_dtype=tf.int64, value_dtype=tf.int64, default_value=-1,
+                                        checkpoint=False, name='target_index_table')
+        insert_op = table.insert(keys, tf.range(tf.size(keys, out_type=tf.int64), dtype=tf.int64))
+        return table, insert_op
+
+
+def _padded_target_entities(entity, relation, targets_lookup_table, targets, target_offsets):
+    """ Look up the targets of (entity, relation) pairs as a padded [len(entity), max_len] matrix
+    and the number of targets of each pair, pairs that are not in the index have no targets.
+    """
+    target_rows = targets_lookup_table.lookup(target_index_key(entity, relation))
+    found = tf.greater_equal(target_rows, 0, name='found_keys')
+
+    padded_targets, target_lens = ragged_lookup(targets, target_offsets, tf.maximum(target_rows, 0))
+    target_lens = tf.where(found, target_lens, tf.zeros_like(target_lens), name='target_lens')
+    max_len = tf.reduce_max(tf.concat([target_lens, tf.zeros([1], dtype=tf.int32)], axis=0))
+    return padded_targets[:, :max_len], target_lens
+
+
 def get_target_entities(entity: tf.Tensor, relation: tf.Tensor,
-                        targets_lookup_table: lookup.HashTable,
-                        entity_table: lookup.HashTable,
+                        targets_lookup_table: lookup.MutableHashTable,
                         targets: tf.Tensor,
+                        target_offsets: tf.Tensor,
                         name=None):
-    """ Change this to return a SparseTensor
-
-    :param entity: entity must be a 1-D vector with one element?
-    :param relation:
-    :param targets_lookup_table:
-    :param entity_table:
-    :param targets:
-    :param ignore_invalid_indices
+    """ Get the target entities of each (entity, relation) pair from a CSR target array
+
+    :param entity: 1-D entity ids
+    :param relation: 1-D relation ids
+    :param targets_lookup_table: target index table, see get_target_index_table
+    :param targets: 1-D int32 target entity ids of all keys
+    :param target_offsets: 1-D int64 [n_keys + 1] offsets, the targets of key i
+        are targets[target_offsets[i]:target_offsets[i + 1]]
     :param name:
-    :return:
+    :return: A SparseTensor of target entity ids, pairs that are not in the index do not have any target
     """
-    with tf.name_scope(name, 'get_target_entities', [entity, relation, targets_lookup_table, targets]):
-        lookup_key = tf.add(entity, tf.add('\t', relation), name='ent_rel_lookup_key')
-        tf.logging.debug("lookup key shape %s" % lookup_key.get_shape())
-        # Explicitly convert the idx to a scalar and extract the targets
-        # [?]
-        target_entities_lookup_id = targets_lookup_table.lookup(lookup_key)
-        # CHECK IF WE HAVE -1 HERE, if so the error will be have a -2 that is out of the range
-        target_entities_lookup_id = tf.where(tf.equal(target_entities_lookup_id, -1),
-                                             target_entities_lookup_id - 1,
-                                             target_entities_lookup_id)
-        # sparseTensor
-        str_targets = tf.string_split(tf.nn.embedding_lookup(targets, target_entities_lookup_id), delimiter=' ')
-
-        int_target_vals = tf.cond(tf.equal(tf.shape(str_targets.values)[0], 0),
-                                  lambda: tf.constant([], dtype=tf.int32, name='empty_target_entities'),
-                                  lambda: tf.cast(entity_table.lookup(str_targets.values), tf.int32,
-                                                  name='target_entities'))
-
-        int_targets = tf.SparseTensor(str_targets.indices, int_target_vals, str_targets.dense_shape)
-        return int_targets
-
-
-def corrupt_single_entity_w_multiple_targets(triple: tf.Tensor,
-                                             target_tail_table: lookup.HashTable,
-                                             target_head_table: lookup.HashTable,
-                                             target_tails: tf.Tensor,
-                                             target_heads: tf.Tensor,
-                                             avoid_entities: tf.Tensor,
-                                             entity_table: lookup.HashTable,
-                                             relation_table: lookup.HashTable,
-                                             max_entity_id,
-                                             num_true: 1,
-                                             num_false: 5,
-                                             head_corrupt_prob=0.5,
-                                             name=None):
+    with tf.name_scope(name, 'get_target_entities', [entity, relation, targets, target_offsets]):
+        padded_targets, target_lens = _padded_target_entities(entity, relation, targets_lookup_table,
+                                                              targets, target_offsets)
+        max_len = tf.shape(padded_targets)[1]
+        mask = tf.sequence_mask(target_lens, max_len, name='target_mask')
+        return tf.SparseTensor(tf.where(mask),
+                               tf.boolean_mask(padded_targets, mask, name='target_entities'),
+                               tf.cast(tf.shape(padded_targets), tf.int64))
+
+
+def _corrupt_batch_true_targets(triples, target_tail_table, target_head_table,
+                                target_tails, target_tail_offsets, target_heads, target_head_offsets,
+                                num_true, head_corrupt_prob, name=None):
+    """ Select the corruption side of each triple in the batch and sample its true targets
+
+    :return:
+        corrupt_head: [batch_size] bool
+        ent: [batch_size] the tail if corrupt_head otherwise the head
+        rel: [batch_size]
+        sampled_true: [batch_size, num_true] true targets sampled with replacement
+        padded_targets: [batch_size, ?] all true targets of each row
+        target_mask: [batch_size, ?] bool, True for the valid elements in padded_targets
     """
-    Input triple is a string triple, and the output elements are all numerical ids
-    :param triple:
+    with tf.name_scope(name, 'corrupt_batch_true_targets', [triples, target_tails, target_tail_offsets,
+                                                            target_heads, target_head_offsets]):
+        heads, rels, tails = tf.unstack(triples, axis=1)
+        batch_size = tf.shape(triples)[0]
+        corrupt_head = tf.less(tf.random_uniform([batch_size]), head_corrupt_prob, name='corrupt_cond')
+        ent = tf.where(corrupt_head, tails, heads, name='ent')
+
+        # Look up the targets in both directions and only keep the corrupted one of each triple
+        padded_heads, head_lens = _padded_target_entities(tails, rels, target_head_table,
+                                                          target_heads, target_head_offsets)
+        padded_tails, tail_lens = _padded_target_entities(heads, rels, target_tail_table,
+                                                          target_tails, target_tail_offsets)
+        head_lens = tf.where(corrupt_head, head_lens, tf.zeros_like(head_lens))
+        tail_lens = tf.where(corrupt_head, tf.zeros_like(tail_lens), tail_lens)
+        # [batch_size, max_head_len + max_tail_len], the targets of each row are at the front of one side
+        padded_targets = tf.concat([padded_heads, padded_tails], axis=1, name='padded_true_targets')
+        target_mask = tf.concat([tf.sequence_mask(head_lens, tf.shape(padded_heads)[1]),
+                                 tf.sequence_mask(tail_lens, tf.shape(padded_tails)[1])], axis=1)
+        target_lens = head_lens + tail_lens
+        target_starts = tf.where(corrupt_head, tf.zeros_like(head_lens),
+                                 tf.fill([batch_size], tf.shape(padded_heads)[1]), name='true_target_starts')
+
+        # Then select num_true positive targets of each row with replacement
+        selected_true_idx = tf.cast(tf.random_uniform([batch_size, num_true]) *
+                                    tf.cast(tf.expand_dims(target_lens, axis=1), tf.float32), tf.int32)
+        selected_true_idx = tf.minimum(selected_true_idx, tf.expand_dims(target_lens, axis=1) - 1)
+        sampled_true = tf.gather_nd(padded_targets,
+                                    tf.stack([tf.tile(tf.expand_dims(tf.range(batch_size), axis=1), [1, num_true]),
+                                              tf.expand_dims(target_starts, axis=1) + selected_true_idx], axis=2),
+                                    name='sampled_true_targets')
+
+        return corrupt_head, ent, rels, sampled_true, padded_targets, target_mask
+
+
+def corrupt_batch_w_multiple_targets(triples: tf.Tensor,
+                                     target_tail_table: lookup.MutableHashTable,
+                                     target_head_table: lookup.MutableHashTable,
+                                     target_tails: tf.Tensor,
+                                     target_tail_offsets: tf.Tensor,
+                                     target_heads: tf.Tensor,
+                                     target_head_offsets: tf.Tensor,
+                                     closed_entities: tf.Tensor,
+                                     num_true: 1,
+                                     num_false: 5,
+                                     head_corrupt_prob=0.5,
+                                     name=None):
+    """ Corrupt the head or the tail of each triple with prob `head_corrupt_prob` and sample true and
+    negative targets of the corrupted side, all triples in the batch are corrupted at once without
+    per-triple conditions.
+
+    :param triples: int [batch_size, 3] (head, relation, tail) triples
     :param target_tail_table:
     :param target_head_table:
     :param target_tails:
+    :param target_tail_offsets:
     :param target_heads:
-    :param avoid_entities:
-    :param entity_table:
-    :param relation_table:
-    :param max_entity_id:
+    :param target_head_offsets:
+    :param closed_entities: 1-D entities seen during training, negative targets are only sampled from these
     :param num_true:
     :param num_false:
     :param head_corrupt_prob:
     :param name:
     :return:
+        corrupt_head: [batch_size] bool
+        ent: [batch_size] the tail if corrupt_head otherwise the head
+        rel: [batch_size]
+        sampled_true: [batch_size, num_true] true targets sampled with replacement
+        sampled_false: [batch_size, num_false] negative targets sampled without replacement
+    """
+    with tf.name_scope(name, 'corrupt_batch_w_multiple_targets', [triples, target_tails, target_tail_offsets,
+                                                                  target_heads, target_head_offsets,
+                                                                  closed_entities]):
+        corrupt_head, ent, rels, sampled_true, padded_targets, target_mask = _corrupt_batch_true_targets(
+            triples, target_tail_table, target_head_table,
+            target_tails, target_tail_offsets, target_heads, target_head_offsets,
+            num_true, head_corrupt_prob)
+
+        # Now sample num_false negative targets of each row from the closed entities in a single call,
+        # the true targets are passed in CSR format
+        target_offsets = tf.concat([tf.zeros([1], dtype=tf.int64),
+                                    tf.cumsum(tf.reduce_sum(tf.cast(target_mask, tf.int64), axis=1))], axis=0,
+                                   name='true_target_offsets')
+        sampled_false = batch_negative_sampling(targets=tf.boolean_mask(padded_targets, target_mask),
+                                                target_offsets=target_offsets,
+                                                candidates=tf.reshape(closed_entities, [-1]),
+                                                num_sampled=num_false)
+
+        return corrupt_head, ent, rels, sampled_true, sampled_false
+
+
+def corrupt_batch_w_shared_negatives(triples: tf.Tensor,
+                                     target_tail_table: lookup.MutableHashTable,
+                                     target_head_table: lookup.MutableHashTable,
+                                     target_tails: tf.Tensor,
+                                     target_tail_offsets: tf.Tensor,
+                                     target_heads: tf.Tensor,
+                                     target_head_offsets: tf.Tensor,
+                                     closed_entities: tf.Tensor,
+                                     num_true: 1,
+                                     num_shared: 100,
+                                     in_batch=True,
+                                     head_corrupt_prob=0.5,
+                                     name=None):
+    """ Same as corrupt_batch_w_multiple_targets but all triples in the batch share one pool of
+    negative targets, so each negative only needs to be transformed once per batch.
+
+    The pool is num_shared entities sampled from the closed entities without replacement, followed by
+    the sampled true targets of all triples in the batch if in_batch is True. A pool entity that is a true
+    target of a triple is not a negative of that triple, this is given by negative_mask.
+
+    :param triples: int [batch_size, 3] (head, relation, tail) triples
+    :param closed_entities: 1-D entities seen during training
+    :param num_true:
+    :param num_shared: number of sampled negatives in the pool
+    :param in_batch: if True, also use the true targets of the other triples as negatives
+    :param head_corrupt_prob:
+    :param name:
+    :return:
+        corrupt_head: [batch_size] bool
+        ent: [batch_size] the tail if corrupt_head otherwise the head
+        rel: [batch_size]
+        sampled_true: [batch_size, num_true] true targets sampled with replacement
+        negatives: [num_shared (+ batch_size * num_true)] shared negative targets
+        negative_mask: [batch_size, num_shared (+ batch_size * num_true)] bool, False if the
+            negative is a true target of the triple
     """
-    with tf.name_scope(name, 'corrupt_single_entity_w_multiple_targets', [triple, target_tail_table, target_head_table,
-                                                                          target_tails, target_heads]):
-        corrupt_rand = tf.random_uniform((), name='corrupt_rand')
-        corrupt_head = tf.less(corrupt_rand, head_corrupt_prob, name='corrupt_cond')
-
-        head, rel, tail = tf.unstack(triple, axis=-1)
-        # First get the targets based on the selection result
-        # Here we only use the values of a sparse tensor because the corruption is on a single triple
-        true_targets = tf.cond(corrupt_head,
-                               lambda: get_target_entities(tail, rel, target_head_table,
-                                                           entity_table, target_heads,
-                                                           name='get_target_heads').values,
-                               lambda: get_target_entities(head, rel, target_tail_table,
-                                                           entity_table, target_tails,
-                                                           name='get_target_tails').values,
-                               name='true_targets')
-
-        # Then select num_true positive targets from true_targets
-        selected_true_idx = tf.random_uniform([num_true], minval=0,
-                                              maxval=tf.shape(true_targets)[0], dtype=tf.int32)
-
-        tf.logging.debug("[%s] selected true idx %s" % (sys._getframe().f_code.co_name,
-                                                        selected_true_idx.get_shape()))
-        sampled_true = tf.nn.embedding_lookup(true_targets, selected_true_idx, name='sampled_true_targets')
-
-        # Now sample num_false negative targets that does not overlap with true_targets and avoid_entities
-        avoid_entities = tf.cond(tf.equal(tf.rank(avoid_entities), 0),
-                                 lambda: tf.expand_dims(avoid_entities, axis=0),
-                                 lambda: tf.reshape(avoid_entities, [-1]))
-
-        skip_targets = tf.concat([true_targets, avoid_entities], axis=-1)
-        sampled_false = multiple_negative_sampling(targets=skip_targets,
-                                                   max_range=max_entity_id,
-                                                   num_sampled=num_false)
-
-        return tf.cond(corrupt_head,
-                       lambda: (corrupt_head, entity_table.lookup(tail),
-                                relation_table.lookup(rel), sampled_true, sampled_false),
-                       lambda: (corrupt_head, entity_table.lookup(head),
-                                relation_table.lookup(rel), sampled_true, sampled_false),
-                       name='corrupted_single_triple_w_multiple_targets')
-
-
-def corrupt_single_entity(triple: tf.Tensor, all_triples: tf.Tensor,
+    with tf.name_scope(name, 'corrupt_batch_w_shared_negatives', [triples, target_tails, target_tail_offsets,
+                                                                  target_heads, target_head_offsets,
+                                                                  closed_entities]):
+        corrupt_head, ent, rels, sampled_true, padded_targets, target_mask = _corrupt_batch_true_targets(
+            triples, target_tail_table, target_head_table,
+            target_tails, target_tail_offsets, target_heads, target_head_offsets,
+            num_true, head_corrupt_prob)
+
+        # One row without targets to avoid, only the drawn positions of the closed entities are read
+        negatives = tf.reshape(batch_negative_sampling(targets=tf.zeros([0], dtype=tf.int32),
+                                                       target_offsets=tf.zeros([2], dtype=tf.int64),
+                                                       candidates=tf.reshape(closed_entities, [-1]),
+                                                       num_sampled=num_shared), [num_shared])
+        if in_batch:
+            negatives = tf.concat([negatives, tf.reshape(sampled_true, [-1])], axis=0)
+        negatives = tf.identity(negatives, name='shared_negatives')
+
+        # A (row, negative) pair is invalid if the negative is a true target of the row,
+        # both are coded as row << 32 | entity and the valid ones are those not in the true targets
+        batch_size = tf.shape(triples)[0]
+        n_negatives = tf.shape(negatives)[0]
+        row_codes = tf.expand_dims(tf.cast(tf.range(batch_size), tf.int64) * (1 << 32), axis=1)
+        pair_codes = tf.reshape(row_codes + tf.expand_dims(tf.cast(negatives, tf.int64), axis=0), [-1])
+        true_codes = tf.boolean_mask(row_codes + tf.cast(padded_targets, tf.int64), target_mask)
+        _, valid_pairs = tf.setdiff1d(pair_codes, true_codes)
+        negative_mask = tf.reshape(tf.scatter_nd(tf.expand_dims(valid_pairs, axis=1),
+                                                 tf.ones_like(valid_pairs, dtype=tf.bool),
+                                                 tf.expand_dims(batch_size * n_negatives, axis=0)),
+                                   [batch_size, n_negatives], name='negative_mask')
+
+        return corrupt_head, ent, rels, sampled_true, negatives, negative_mask
+
+
+def mix_hard_negatives(corrupt_head, ent, rel, false_targets,
+                       target_tail_table, target_head_table,
+                       hard_tails, hard_heads, num_hard, name=None):
+    """ Replace the first num_hard negative targets of each triple by hard negatives sampled without replacement
+    from the hard negative caches, negatives of triples without cached hard negatives are kept.
+
+    Hard negatives that are already one of the other false_targets are dropped, the free slots are filled
+    with the replaced negatives that are not a kept hard negative, so the negatives of a triple stay distinct.
+
+    :param corrupt_head: [batch_size] bool
+    :param ent: [batch_size] the tail if corrupt_head otherwise the head
+    :param rel: [batch_size]
+    :param false_targets: [batch_size, num_false] sampled negative targets
+    :param target_tail_table: target index table of the true tails
+    :param target_head_table: target index table of the true heads
+    :param hard_tails: [n_tail_keys, cache_size] hard negative tails of each row in target_tail_table,
+        -1 if not cached
+    :param hard_heads: [n_head_keys, cache_size] hard negative heads of each row in target_head_table
+    :param num_hard: not larger than num_false and cache_size
+    :param name:
+    :return: [batch_size, num_false]
+    """
+    with tf.name_scope(name, 'mix_hard_negatives', [corrupt_head, ent, rel, false_targets, hard_tails, hard_heads]):
+        key = target_index_key(ent, rel)
+        rows = tf.where(corrupt_head, target_head_table.lookup(key), target_tail_table.lookup(key))
+        batch_size = tf.shape(false_targets)[0]
+
+        # Random columns of the cache without replacement
+        _, cols = tf.nn.top_k(tf.random_uniform(tf.stack([batch_size, tf.shape(hard_tails)[1]])), k=num_hard)
+        idx = tf.stack([tf.tile(tf.expand_dims(tf.cast(tf.maximum(rows, 0), tf.int32), axis=1), [1, num_hard]),
+                        cols], axis=2)
+        hard = tf.where(tf.tile(tf.expand_dims(corrupt_head, axis=1), [1, num_hard]),
+                        tf.gather_nd(hard_heads, idx), tf.gather_nd(hard_tails, idx), name='hard_negatives')
+        valid = tf.logical_and(tf.greater_equal(hard, 0), tf.expand_dims(tf.greater_equal(rows, 0), axis=1))
+
+        # Keep the hard negatives that are not in the uniform negatives, then the replaced negatives
+        # that are not kept hard negatives. There are at least num_hard of them because the replaced
+        # negatives are distinct.
+        replaced, uniform = false_targets[:, :num_hard], false_targets[:, num_hard:]
+        keep_hard = tf.logical_and(valid, tf.logical_not(tf.reduce_any(
+            tf.equal(tf.expand_dims(hard, axis=2), tf.expand_dims(uniform, axis=1)), axis=2)))
+        keep_replaced = tf.logical_not(tf.reduce_any(tf.logical_and(
+            tf.equal(tf.expand_dims(replaced, axis=2), tf.expand_dims(hard, axis=1)),
+            tf.expand_dims(keep_hard, axis=1)), axis=2))
+        candidates = tf.concat([hard, replaced], axis=1)
+        keep = tf.concat([keep_hard, keep_replaced], axis=1)
+        # The first num_hard kept candidates of each row
+        _, cols = tf.nn.top_k(tf.cast(keep, tf.int32) * tf.range(2 * num_hard, 0, -1), k=num_hard)
+        mixed = tf.gather_nd(candidates, tf.stack([tf.tile(tf.expand_dims(tf.range(batch_size), axis=1),
+                                                           [1, num_hard]), cols], axis=2))
+
+        return tf.concat([mixed, uniform], axis=1, name='mixed_false_targets')
+
+
+def corrupt_single_entity(triple: tf.Tensor,
+                          head_index, tail_index,
                           max_entity_id: int,
                           head_corrupt_prob=0.5,
                           debug_head_corrupted=None,
@@ -192,47 +382,47 @@ def corrupt_single_entity(triple: tf.Tensor, all_triples: tf.Tensor,
     """ Randomly corrupt head or tail with prob `head_corrupt_prob`
 
     :param triple:
-    :param all_triples:
+    :param head_index: (target index table, values, offsets) of the true heads of each (relation, tail)
+    :param tail_index: (target index table, values, offsets) of the true tails of each (relation, head)
     :param max_entity_id:
     :param head_corrupt_prob:
     :param name:
     :return: corrupted 1-d [h,r,t] triple
     """
-    with tf.name_scope(name, "corrupt_single_entity", [triple, all_triples]):
+    with tf.name_scope(name, "corrupt_single_entity", [triple]):
         # if rand_val < 0.5, do head corruption, otherwise do tail corruption
         rand_val = tf.random_uniform(())
         corruption_cond = tf.less(rand_val, head_corrupt_prob, name='corruption_selector')
         entity_corrupted_triple = tf.cond(corruption_cond,
-                                          lambda: _corrupt_single_entity_helper(triple, all_triples, 'h', max_entity_id,
+                                          lambda: _corrupt_single_entity_helper(triple, head_index, 'h', max_entity_id,
                                                                                 debug_head_corrupted, 'corrupt_head'),
-                                          lambda: _corrupt_single_entity_helper(triple, all_triples, 't',
+                                          lambda: _corrupt_single_entity_helper(triple, tail_index, 't',
                                                                                 max_entity_id,
                                                                                 debug_tail_corrupted, 'corrupt_tail'))
         return entity_corrupted_triple
 
 
-def get_true_targets(entity, relation, targets_lookup_table, entity_table, targets, name=None):
+def get_true_targets(entity, relation, targets_lookup_table, targets, target_offsets, name=None):
     """
 
-    :param entity:
-    :param relation:
-    :param targets_lookup_table:
-    :param entity_table:
-    :param targets:
+    :param entity: 1-D entity ids
+    :param relation: 1-D relation ids
+    :param targets_lookup_table: target index table, see get_target_index_table
+    :param targets: 1-D int32 target entity ids of all keys
+    :param target_offsets: 1-D int64 [n_keys + 1] offsets of targets
     :param name:
     :return:
         A dense padded target matrix where the padded values are 0.
         A target_mask that has the same size of the target matrix with -1e10
             score if the [i,j] is not a padded score
     """
-    with tf.name_scope(name, 'true_targets', [entity, relation, targets_lookup_table,
-                                              entity_table, targets]):
+    with tf.name_scope(name, 'true_targets', [entity, relation, targets, target_offsets]):
         # Get a sparse tensor of target entities for each <entity, relation> pair
         targets = get_target_entities(entity=entity,
                                       relation=relation,
                                       targets_lookup_table=targets_lookup_table,
-                                      entity_table=entity_table,
-                                      targets=targets)
+                                      targets=targets,
+                                      target_offsets=target_offsets)
 
         targets_mask = tf.SparseTensor(targets.indices,
                                        tf.cast(tf.minimum(0, targets.values), tf.float32) * 1e10,
@@ -241,22 +431,3 @@ def get_true_targets(entity, relation, targets_lookup_table, entity_table, targe
         targets_dense = tf.sparse_tensor_to_dense(targets, default_value=0, name='true_targets_w_padding')
 
         return targets_dense, targets_mask
-
-
-def get_true_tails(ent_rel_str, targets_lookup_table, targets, name=None):
-    """
-    Given ent \t rel pair return a list of string targets
-    :param ent_rel_str:
-    :param targets_lookup_table:
-    :param name:
-    :return:
-    """
-    with tf.name_scope(name, 'get_true_tails', [ent_rel_str, targets_lookup_table, targets]):
-        target_entities_lookup_id = targets_lookup_table.lookup(ent_rel_str)
-        # CHECK IF WE HAVE -1 HERE, if so the error will be have a -2 that is out of the range
-        target_entities_lookup_id = tf.where(tf.equal(target_entities_lookup_id, -1),
-                                             target_entities_lookup_id - 1,
-                                             target_entities_lookup_id)
-        # sparseTensor
-        str_targets = tf.string_split(tf.nn.embedding_lookup(targets, target_entities_lookup_id), delimiter=' ')
-        return str_targets.values
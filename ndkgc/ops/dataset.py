@@ -0,0 +1,55 @@
+import time
+
+import tensorflow as tf
+
+
+def shuffled_indices(n, num_epochs, batch_size=None, name=None):
+    """ A dataset of row indices in [0, n) with a new full permutation in every epoch.
+
+    :param n: number of rows
+    :param num_epochs: the dataset ends with OutOfRangeError after num_epochs permutations
+    :param batch_size: if given, each element is a [batch_size] int32 vector and the last
+        n % batch_size rows of each permutation are dropped, otherwise each element is a scalar
+    :param name:
+    :return: tf.data.Dataset
+    """
+    with tf.name_scope(name, 'shuffled_indices'):
+        def _epoch(_):
+            permutation = tf.random_shuffle(tf.range(n, dtype=tf.int32))
+            if batch_size is None:
+                return tf.data.Dataset.from_tensor_slices(permutation)
+            n_batches = n // batch_size
+            return tf.data.Dataset.from_tensor_slices(tf.reshape(permutation[:n_batches * batch_size],
+                                                                 [n_batches, batch_size]))
+
+        return tf.data.Dataset.range(num_epochs).flat_map(_epoch)
+
+
+def timed_input_step(session, fetches, inputs, bottleneck_ratio=0.1):
+    """ Run a training step with the input batch fetched in a separate run, so the time spent
+    waiting for the input pipeline can be told apart from the time spent in the model.
+
+    The fetched batch is fed back to `inputs` so no batch is skipped. Use this every few hundred
+    steps only, the feed copies the batch back to the devices.
+
+    :param session:
+    :param fetches: fetches of the training step
+    :param inputs: list of tensors the training step reads from the input pipeline
+    :param bottleneck_ratio: warn if the input wait is larger than this fraction of the step time
+    :return: results of fetches, input wait in seconds, model time in seconds
+    """
+    start = time.time()
+    values = session.run(inputs)
+    fetched = time.time()
+    results = session.run(fetches, feed_dict=dict(zip(inputs, values)))
+    done = time.time()
+
+    input_wait = fetched - start
+    model_time = done - fetched
+    if input_wait > bottleneck_ratio * (input_wait + model_time):
+        tf.logging.warning("Input pipeline is the bottleneck: waited %.3fs for a batch, "
+                           "the model step took %.3fs. Consider a larger num_parallel_calls." %
+                           (input_wait, model_time))
+    else:
+        tf.logging.debug("Input wait %.3fs, model step %.3fs" % (input_wait, model_time))
+    return results, input_wait, model_time
@@ -24,3 +24,97 @@ def normalized_embedding(embedding, name=None):
         norm_embed = embedding / norm
 
         return tf.check_numerics(norm_embed, 'normalized_embedding')
+
+
+def ragged_lookup(values, offsets, rows, default_value=0, name=None):
+    """ Gather variable length rows from a CSR array, row i is values[offsets[i]:offsets[i+1]]
+
+    :param values: 1-D values of all rows
+    :param offsets: 1-D [n_rows + 1] row offsets
+    :param rows: 1-D row ids to gather
+    :param default_value: padding value
+    :param name:
+    :return: 2-D [len(rows), max_row_length_in_rows] padded matrix,
+             1-D [len(rows)] int32 row lengths
+    """
+    with tf.name_scope(name, 'ragged_lookup', [values, offsets, rows]):
+        rows = tf.cast(rows, offsets.dtype)
+        starts = tf.gather(offsets, rows, name='row_starts')
+        lens = tf.gather(offsets, rows + 1, name='row_ends') - starts
+        # append a 0 so the max length of an empty batch is 0
+        max_len = tf.reduce_max(tf.concat([lens, tf.zeros([1], dtype=lens.dtype)], axis=0))
+
+        positions = tf.expand_dims(tf.range(max_len, dtype=offsets.dtype), axis=0)
+        mask = tf.less(positions, tf.expand_dims(lens, axis=1), name='row_mask')
+        # padded positions point to the first element and will be replaced later
+        idx = tf.where(mask, tf.expand_dims(starts, axis=1) + positions, tf.zeros_like(mask, dtype=offsets.dtype))
+        gathered = tf.gather(values, idx)
+        padded = tf.where(mask, gathered, tf.ones_like(gathered) * default_value, name='padded_rows')
+
+        return padded, tf.cast(lens, tf.int32)
+
+
+def transform_unique(ids, transform, name=None):
+    """ Apply `transform` to the unique ids only and gather the results back for every id,
+    the gradients of repeated ids are accumulated by the gather.
+
+    :param ids: ids of any shape
+    :param transform: function from 1-D [n_unique] ids to a [n_unique, ...] tensor or a tuple of such tensors
+    :param name:
+    :return: [ids.shape, ...] for each output of `transform`
+    """
+    with tf.name_scope(name, 'transform_unique', [ids]):
+        unique_ids, unique_idx = tf.unique(tf.reshape(ids, [-1]), name='unique_ids')
+        transformed = transform(unique_ids)
+
+        def _gather_back(x):
+            return tf.reshape(tf.gather(x, unique_idx),
+                              tf.concat([tf.shape(ids), tf.shape(x)[1:]], axis=0))
+
+        if isinstance(transformed, tuple):
+            return tuple(_gather_back(x) for x in transformed)
+        return _gather_back(transformed)
+
+
+def bucketed_transform(ids, lengths, boundaries, transform, name=None):
+    """ Apply `transform` to 1-D ids in buckets of their lengths and stitch the results back,
+    so the padding of each bucket only goes to the longest row in that bucket.
+
+    Bucket i holds the ids with boundaries[i - 1] < length <= boundaries[i], the last bucket
+    holds the ids longer than boundaries[-1].
+
+    :param ids: 1-D ids
+    :param lengths: 1-D lengths of ids
+    :param boundaries: sorted list of length boundaries
+    :param transform: function from 1-D ids to a [len(ids), ...] tensor or a tuple of such tensors,
+        it must not depend on the padded length of the ids
+    :param name:
+    :return: same as transform(ids)
+    """
+    with tf.name_scope(name, 'bucketed_transform', [ids, lengths]):
+        n_buckets = len(boundaries) + 1
+        buckets = tf.reduce_sum(tf.cast(tf.greater(tf.expand_dims(lengths, axis=1),
+                                                   tf.constant(boundaries, dtype=lengths.dtype)), tf.int32),
+                                axis=1, name='buckets')
+        positions = tf.dynamic_partition(tf.range(tf.shape(ids)[0]), buckets, n_buckets)
+        transformed = [transform(x) for x in tf.dynamic_partition(ids, buckets, n_buckets)]
+
+        if isinstance(transformed[0], tuple):
+            return tuple(tf.dynamic_stitch(positions, list(x)) for x in zip(*transformed))
+        return tf.dynamic_stitch(positions, transformed)
+
+
+def ragged_row_ids(offsets, name=None):
+    """ Row id of every value of a CSR array, row i is values[offsets[i]:offsets[i+1]]
+
+    :param offsets: 1-D [n_rows + 1] row offsets
+    :param name:
+    :return: 1-D [offsets[-1] - offsets[0]] row ids, same dtype as offsets
+    """
+    with tf.name_scope(name, 'ragged_row_ids', [offsets]):
+        n_values = offsets[-1] - offsets[0]
+        # mark where each row after the first one starts and count the marks before each value,
+        # empty rows start at the same position and are all counted
+        row_starts = tf.unsorted_segment_sum(tf.ones_like(offsets[1:-1]), offsets[1:-1] - offsets[0],
+                                             n_values + 1, name='row_starts')
+        return tf.cumsum(row_starts)[:n_values]
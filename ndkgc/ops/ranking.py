@@ -0,0 +1,84 @@
+import tensorflow as tf
+
+from ndkgc.ops.lookup import ragged_lookup, ragged_row_ids
+
+
+def count_greater(sorted_values, values, rows, name=None):
+    """ Number of elements greater than each value in its row of sorted_values, by binary search
+
+    :param sorted_values: [n_rows, n] each row is sorted in descending order
+    :param values: 1-D values to search
+    :param rows: 1-D int32 row of each value
+    :param name:
+    :return: 1-D int32 counts
+    """
+    with tf.name_scope(name, 'count_greater', [sorted_values, values, rows]):
+        n = tf.shape(sorted_values)[1]
+        # the count is in [lo, hi], elements before lo are greater and elements from hi on are not
+        lo = tf.zeros_like(rows)
+        hi = tf.fill(tf.shape(rows), n)
+
+        def _search(lo, hi):
+            mid = (lo + hi) // 2
+            # mid is n only if lo == hi, the value read there is not used
+            mid_values = tf.gather_nd(sorted_values, tf.stack([rows, tf.minimum(mid, n - 1)], axis=1))
+            go_right = tf.logical_and(tf.less(lo, hi), tf.greater(mid_values, values))
+            go_left = tf.logical_and(tf.less(lo, hi), tf.logical_not(go_right))
+            return tf.where(go_right, mid + 1, lo), tf.where(go_left, mid, hi)
+
+        lo, _ = tf.while_loop(lambda lo, hi: tf.reduce_any(tf.less(lo, hi)), _search, [lo, hi],
+                              back_prop=False, name='binary_search')
+        return lo
+
+
+def filtered_ranks(scores, test_target_idx, test_target_offsets, true_target_idx, true_target_offsets, name=None):
+    """ Filtered rank of each test target, 1 + the number of targets scored higher that are not true targets
+
+    Each row of scores is sorted once and the test targets are searched in it, the true targets
+    are picked by index and searched the same way, so no [test targets, targets] matrix or dense
+    mask is built. This takes O((n_targets + n_test_targets) log n_targets) for each row.
+
+    :param scores: [n_rows, n_targets]
+    :param test_target_idx: CSR test targets of each row, test targets have to be true targets as well
+    :param test_target_offsets: [n_rows + 1]
+    :param true_target_idx: CSR true targets of each row
+    :param true_target_offsets: [n_rows + 1]
+    :param name:
+    :return: int32 ranks in the same CSR layout as test_target_idx
+    """
+    with tf.name_scope(name, 'filtered_ranks', [scores, test_target_idx, test_target_offsets,
+                                                true_target_idx, true_target_offsets]):
+        n_rows = tf.shape(scores)[0]
+        test_rows = tf.cast(ragged_row_ids(test_target_offsets), tf.int32)
+        true_rows = tf.cast(ragged_row_ids(true_target_offsets), tf.int32)
+
+        test_scores = tf.gather_nd(scores, tf.stack([test_rows, test_target_idx], axis=1))
+        true_scores = tf.gather_nd(scores, tf.stack([true_rows, true_target_idx], axis=1))
+
+        sorted_scores, _ = tf.nn.top_k(scores, k=tf.shape(scores)[1], name='sorted_scores')
+        # [n_rows, max_true_targets], padded with -inf which is never greater
+        padded_true_scores, _ = ragged_lookup(true_scores, true_target_offsets, tf.range(n_rows),
+                                              default_value=float('-inf'))
+        sorted_true_scores, _ = tf.nn.top_k(padded_true_scores, k=tf.shape(padded_true_scores)[1],
+                                            name='sorted_true_scores')
+
+        return count_greater(sorted_scores, test_scores, test_rows, name='greater') - count_greater(
+            sorted_true_scores, test_scores, test_rows, name='filtered_greater') + 1
+
+
+def rank_metrics(ranks, hits_at=(1, 3, 10), name=None):
+    """ Mean rank, mean reciprocal rank and Hits@k of the given ranks
+
+    :param ranks: 1-D ranks
+    :param hits_at: k of the Hits@k
+    :param name:
+    :return: dict of 'mr', 'mrr' and 'hits@k' for each k
+    """
+    with tf.name_scope(name, 'rank_metrics', [ranks]):
+        ranks = tf.cast(ranks, tf.float32)
+        metrics = {'mr': tf.reduce_mean(ranks, name='mr'),
+                   'mrr': tf.reduce_mean(1.0 / ranks, name='mrr')}
+        for k in hits_at:
+            metrics['hits@%d' % k] = tf.reduce_mean(tf.cast(tf.less_equal(ranks, k), tf.float32),
+                                                    name='hits_at_%d' % k)
+        return metrics
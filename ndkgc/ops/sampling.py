@@ -1,8 +1,111 @@
+import numpy as np
 import tensorflow as tf
 import os
 
 __so_dir = os.path.dirname(os.path.abspath(__file__))
-__lib = tf.load_op_library(os.path.join(__so_dir, './__sampling/libsampling.so'))
+# Build with `cmake . && make` in ndkgc/ops/__sampling
+__so_path = os.path.join(__so_dir, './__sampling/libsampling.so')
 
-single_negative_sampling = __lib.single_negative_sampling
-multiple_negative_sampling = __lib.multiple_negative_sampling
\ No newline at end of file
+
+def _check_enough_candidates(avoids, n_rows, candidates, n_candidates, num_sampled, max_range):
+    """ The sampling only ends if each row has num_sampled distinct candidates that are not its targets,
+    candidates may have duplicates and targets that are not candidates do not count
+    """
+    avoid_rows, avoid_values = avoids >> 32, avoids & ((1 << 32) - 1)
+    if max_range >= 0:
+        is_candidate = avoid_values <= max_range
+        n_distinct = n_candidates
+    else:
+        distinct_candidates = np.unique(candidates)
+        is_candidate = np.isin(avoid_values, distinct_candidates)
+        n_distinct = distinct_candidates.shape[0]
+    n_valid = n_distinct - np.bincount(avoid_rows[is_candidate], minlength=n_rows)
+    if n_rows > 0 and n_valid.min() < num_sampled:
+        raise ValueError("There is not enough candidates to sample for row %d. %d distinct candidates are "
+                         "not targets but num_sampled is %d" % (n_valid.argmin(), n_valid.min(), num_sampled))
+
+
+def sample_negatives(targets, target_offsets, candidates, num_sampled, max_range=-1):
+    """ Sample `num_sampled` negative examples for each row without replacement, vectorized over the batch.
+
+    Same as the BatchNegativeSampling op: targets of row i are targets[target_offsets[i]:target_offsets[i + 1]]
+    and are never sampled for that row. Negative examples are sampled from [0, max_range] if max_range is
+    not negative, otherwise from `candidates`.
+
+    :return: int32 [batch_size, num_sampled]
+    """
+    targets = np.asarray(targets, dtype=np.int64)
+    target_offsets = np.asarray(target_offsets, dtype=np.int64)
+    n_candidates = max_range + 1 if max_range >= 0 else len(candidates)
+    n_rows = len(target_offsets) - 1
+    lens = np.diff(target_offsets)
+
+    # (row, value) pairs are coded as row << 32 | value
+    rows = np.repeat(np.arange(n_rows, dtype=np.int64), lens)
+    avoids = np.unique(rows * (1 << 32) + targets[target_offsets[0]:target_offsets[-1]])
+    target_codes = avoids
+    if n_candidates == 0:
+        _check_enough_candidates(target_codes, n_rows, candidates, n_candidates, num_sampled, max_range)
+
+    false_targets = np.empty([n_rows, num_sampled], dtype=np.int32)
+    n_filled = np.zeros([n_rows], dtype=np.int64)
+    pending = np.arange(n_rows)
+    first_round = True
+    while pending.shape[0] > 0:
+        # Draw twice as many as needed, rows that still miss some examples are drawn again
+        draws = np.random.randint(0, n_candidates, size=[pending.shape[0], 2 * num_sampled])
+        values = draws if max_range >= 0 else np.asarray(candidates)[draws]
+        codes = pending[:, None].astype(np.int64) * (1 << 32) + values
+
+        # keep the first occurrence of each value that is not avoided
+        keep = np.zeros(codes.size, dtype=np.bool_)
+        keep[np.unique(codes, return_index=True)[1]] = True
+        keep = keep.reshape(codes.shape)
+        pos = np.minimum(np.searchsorted(avoids, codes), max(avoids.shape[0] - 1, 0))
+        if avoids.shape[0] > 0:
+            keep &= avoids[pos] != codes
+
+        rank = np.cumsum(keep, axis=1) - 1
+        take = keep & (rank < (num_sampled - n_filled[pending])[:, None])
+        r, c = np.nonzero(take)
+        false_targets[pending[r], n_filled[pending[r]] + rank[r, c]] = values[r, c]
+        n_filled[pending] += take.sum(axis=1)
+        avoids = np.union1d(avoids, codes[take])
+        pending = pending[n_filled[pending] < num_sampled]
+        if pending.shape[0] > 0 and first_round:
+            # Only check the candidates if a round was not enough, this reads all of them
+            _check_enough_candidates(target_codes, n_rows, candidates, n_candidates, num_sampled, max_range)
+        first_round = False
+    return false_targets
+
+
+if os.path.exists(__so_path):
+    __lib = tf.load_op_library(__so_path)
+
+    single_negative_sampling = __lib.single_negative_sampling
+    multiple_negative_sampling = __lib.multiple_negative_sampling
+    batch_negative_sampling = __lib.batch_negative_sampling
+else:
+    # Same ops implemented with numpy, these run in the python interpreter so build
+    # libsampling.so for training on large datasets
+    tf.logging.warning("%s is not built, use the numpy negative sampling ops" % __so_path)
+
+
+    def batch_negative_sampling(targets, target_offsets, candidates, num_sampled, max_range=-1, name=None):
+        with tf.name_scope(name, 'batch_negative_sampling', [targets, target_offsets, candidates]):
+            false_targets = tf.py_func(lambda t, o, c: sample_negatives(t, o, c, num_sampled, max_range),
+                                       [targets, target_offsets, candidates], tf.int32, stateful=True,
+                                       name='sample_negatives')
+            false_targets.set_shape([None, num_sampled])
+            return false_targets
+
+
+    def multiple_negative_sampling(targets, max_range, num_sampled, name=None):
+        with tf.name_scope(name, 'multiple_negative_sampling', [targets]):
+            offsets = tf.stack([tf.zeros([], dtype=tf.int64), tf.size(targets, out_type=tf.int64)])
+            return tf.reshape(batch_negative_sampling(targets, offsets, tf.zeros([0], dtype=tf.int32),
+                                                      num_sampled, max_range=max_range), [num_sampled])
+
+
+    def single_negative_sampling(targets, max_range, name=None):
+        return multiple_negative_sampling(targets, max_range, 1, name=name or 'single_negative_sampling')
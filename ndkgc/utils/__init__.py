@@ -1,14 +1,19 @@
+import array
+import itertools
+import os
+import zlib
+
 import numpy as np
 
 import tensorflow as tf
 
+from ndkgc.utils.embedding import load_embedding_rows
+from ndkgc.utils.manifest import get_manifest
+
 
 def count_line(file_path):
-    counter = 0
-    with open(file_path, 'r', encoding='utf8') as f:
-        for _ in f:
-            counter += 1
-    return counter
+    """ Line counts are cached in the manifest of the file's directory """
+    return get_manifest(os.path.dirname(file_path)).count_line(file_path)
 
 
 def valid_vocab_file(file_path):
@@ -54,42 +59,149 @@ def load_triples(file_path, entities=None, relations=None):
     return triples
 
 
+def iter_triple_chunks(file_path, entities, relations, chunk_size=1 << 20):
+    """ Stream a head \t tail \t relation file as int32 [chunk_size, 3] (head, relation, tail) arrays,
+    the last chunk may be smaller.
+
+    :param file_path:
+    :param entities: entity name to id
+    :param relations: relation name to id
+    :param chunk_size: number of triples per chunk
+    :return: a generator of int32 arrays
+    """
+    with open(file_path, 'r', encoding='utf8') as f:
+        while True:
+            lines = list(itertools.islice(f, chunk_size))
+            if not lines:
+                break
+            chunk = np.empty([len(lines), 3], dtype=np.int32)
+            for i, line in enumerate(lines):
+                src, dst, rel = line.strip().split('\t')
+                chunk[i, 0] = entities[src]
+                chunk[i, 1] = relations[rel]
+                chunk[i, 2] = entities[dst]
+            yield chunk
+
+
+def load_triple_array(file_path, entities, relations, chunk_size=1 << 20):
+    """ Load all triples into a contiguous int32 [N, 3] (head, relation, tail) array,
+    same as np.asarray(load_triples(file_path, entities, relations)) but the file is
+    parsed in chunks so the memory does not grow with Python objects.
+    """
+    triples = np.empty([count_line(file_path), 3], dtype=np.int32)
+    n = 0
+    for chunk in iter_triple_chunks(file_path, entities, relations, chunk_size):
+        triples[n:n + chunk.shape[0]] = chunk
+        n += chunk.shape[0]
+    tf.logging.info("Loaded %d triples from %s" % (n, file_path))
+    return triples[:n]
+
+
+def index_triples(triples, key_cols, value_col):
+    """ Sort int [N, 3] triples by two key columns and group the value column by key, e.g.
+    key_cols=(1, 0), value_col=2 gives the tails of each (relation, head) pair.
+
+    :return: int64 [K] sorted unique keys (key_cols[0] << 32 | key_cols[1]),
+             int32 values and int64 [K + 1] offsets, the values of key i are
+             values[offsets[i]:offsets[i + 1]]
+    """
+    keys = triples[:, key_cols[0]].astype(np.int64) * (1 << 32) + triples[:, key_cols[1]]
+    order = np.lexsort([triples[:, value_col], keys])
+    keys = keys[order]
+    unique_keys, starts = np.unique(keys, return_index=True)
+    offsets = np.append(starts, keys.shape[0]).astype(np.int64)
+    return unique_keys, triples[order, value_col].astype(np.int32), offsets
+
+
 def load_pretrained_embedding(pretrained_file_path, vocab, word_embedding_size, oov):
-    current_embedding = np.random.uniform(-1, 1, [len(vocab) + oov, word_embedding_size])
+    current_embedding = np.random.uniform(-1, 1, [len(vocab) + oov, word_embedding_size]).astype(np.float32)
     current_embedding[0, :] = 0.
-    with open(pretrained_file_path, 'r', encoding='utf8') as f:
-        for line in f:
-            elems = line.strip().split('\t')
-            word = elems[0]
-            if word in vocab:
-                embed = elems[1:]
-                current_embedding[vocab[word]] = embed
+    ids, rows = load_embedding_rows(pretrained_file_path, vocab, word_embedding_size, sep='\t')
+    current_embedding[ids] = rows
     return current_embedding
 
 
-def load_content(content_file_path, entities, max_content_len=256):
+def iter_content(content_file_path, entities, max_content_len=256):
+    """ Iterate over (id, words) of a entity \t number of words \t content file, content of
+    entities that are not in `entities` are skipped.
+
+    :param content_file_path:
+    :param entities: entity (or relation) name to id
+    :param max_content_len: content longer than this will be truncated, None if the
+        content is already truncated during pre-processing
+    :return: a generator of (id, list of words)
+    """
     # TODO: Correctness: the max_content_len is used for limiting the memory consumption, and therefore
     # in this case we may have words that are in the vocab but we never trained on them.
-    # TODO: Performance: Move the reindexing to pre-processing due to the high cost
-    # for example we could use a separate C++ program to do the validation
-    d = dict()
-    l = dict()
     with open(content_file_path, 'r', encoding='utf8') as f:
         for line in f:
-            ent, desc_len, desc = line.strip().split('\t')
-            desc_len = int(desc_len)
+            ent, _, desc = line.strip().split('\t')
             if ent in entities:
-                if desc_len > max_content_len:
-                    desc = " ".join(desc.split()[:max_content_len])
-                d[entities[ent]] = desc
-                l[entities[ent]] = min(max_content_len, desc_len)
-    content = list()
-    content_len = list()
-    for i in range(len(d)):
-        content.append(d[i])
-        content_len.append(l[i])
-    tf.logging.info("Load %d content data from %s" % (len(d), content_file_path))
-    return content, content_len
+                words = desc.split()
+                if max_content_len is not None and len(words) > max_content_len:
+                    words = words[:max_content_len]
+                yield entities[ent], words
+
+
+def compact_rows(n_rows, rows, typecode='i'):
+    """ Build a CSR array from (row id, values) pairs in a single pass, values are appended
+    to one contiguous buffer and rows that appear more than once keep the last values.
+
+    :param n_rows:
+    :param rows: iterable of (row id, sequence of values)
+    :param typecode: array typecode of the values, 'i' for int32 and 'B' for bytes
+    :return: values, int64 offsets
+    """
+    buf = array.array(typecode)
+    starts = np.zeros([n_rows], dtype=np.int64)
+    lens = np.zeros([n_rows], dtype=np.int64)
+    for row, values in rows:
+        starts[row] = len(buf)
+        buf.extend(values)
+        lens[row] = len(buf) - starts[row]
+    offsets = np.zeros([n_rows + 1], dtype=np.int64)
+    np.cumsum(lens, out=offsets[1:])
+    stream = np.frombuffer(buf, dtype=np.dtype(typecode))
+    if offsets[-1] == len(buf) and np.array_equal(starts, offsets[:-1]):
+        # Every row appears once and in order, the buffer is already in CSR layout
+        return stream, offsets
+    idx = np.repeat(starts - offsets[:-1], lens) + np.arange(offsets[-1])
+    return stream[idx], offsets
+
+
+def oov_bucket(word, n_vocab, oov):
+    """ Id of a word that is not in the vocab, these words are hashed into `oov` buckets
+    after the vocab. Returns -1 if there is no oov bucket.
+    """
+    if oov == 0:
+        return -1
+    return n_vocab + zlib.crc32(word.encode('utf8')) % oov
+
+
+def load_content_ids(content_file_path, entities, vocab, oov, max_content_len=256):
+    """ Load content as word ids in a CSR layout, the content of entity i is
+    values[offsets[i]:offsets[i + 1]]. Entities without content have an empty row.
+
+    Word ids are the line number in the vocab file, same as the lookup table built by
+    get_lookup_table. Unknown words are hashed into `oov` buckets and dropped if oov is 0.
+
+    :param content_file_path:
+    :param entities: entity (or relation) name to id
+    :param vocab: word to id
+    :param oov: number of oov buckets
+    :param max_content_len: None if the content is already truncated during pre-processing
+    :return: int32 values, int64 offsets
+    """
+    n_vocab = len(vocab)
+
+    def _ids():
+        for i, words in iter_content(content_file_path, entities, max_content_len):
+            ids = [vocab[w] if w in vocab else oov_bucket(w, n_vocab, oov) for w in words]
+            yield i, [x for x in ids if x >= 0]
+
+    values, offsets = compact_rows(len(entities), _ids())
+    tf.logging.info("Load %d content ids from %s" % (len(entities), content_file_path))
+    return values, offsets
 
 
 def load_vocab_file(vocab_file_path):
@@ -101,15 +213,11 @@ def load_vocab_file(vocab_file_path):
     return vocab
 
 
-def load_vocab_embedding(embedding_path, vocab_dict, oov):
-    word_embedding = np.random.uniform(-np.sqrt(6) / 200, np.sqrt(6) / 200, size=[len(vocab_dict) + oov, 200])
-    with open(embedding_path, 'r', encoding='utf8') as f:
-        for line in f:
-            elems = line.strip().split()
-            ent_name = elems[0]
-            vals = [float(x) for x in elems[1:]]
-            if ent_name in vocab_dict:
-                word_embedding[vocab_dict[ent_name]] = vals
+def load_vocab_embedding(embedding_path, vocab_dict, oov, word_embedding_size=200):
+    word_embedding = np.random.uniform(-np.sqrt(6) / word_embedding_size, np.sqrt(6) / word_embedding_size,
+                                       size=[len(vocab_dict) + oov, word_embedding_size]).astype(np.float32)
+    ids, rows = load_embedding_rows(embedding_path, vocab_dict, word_embedding_size)
+    word_embedding[ids] = rows
 
     return word_embedding
 
@@ -0,0 +1,279 @@
+import json
+import os
+
+import numpy as np
+
+import tensorflow as tf
+
+from ndkgc.utils import compact_rows, iter_content, load_list, oov_bucket
+from ndkgc.utils.manifest import get_manifest, save_manifests
+
+BUNDLE_VERSION = 2
+
+# Standard file layout of a dataset directory, see main() in content_model.py
+DATASET_FILES = {
+    'entity_file': 'entities.txt',
+    'relation_file': 'relations.txt',
+    'vocab_file': 'vocab.txt',
+    'content_file': 'descriptions.txt',
+    'entity_title_file': 'entity_names.txt',
+    'relation_title_file': 'relation_names.txt',
+    'avoid_entity_file': 'avoid_entities.txt',
+    'train_file': 'train.txt',
+    'training_target_tail_file': 'train.tails.values',
+    'training_target_tail_key_file': 'train.tails.idx',
+    'training_target_head_file': 'train.heads.values',
+    'training_target_head_key_file': 'train.heads.idx',
+    'evaluation_open_target_tail_file': 'eval.tails.values.open',
+    'evaluation_closed_target_tail_file': 'eval.tails.values.closed',
+    'evaluation_target_tail_key_file': 'eval.tails.idx',
+    'evaluation_open_target_head_file': 'eval.heads.values.open',
+    'evaluation_closed_target_head_file': 'eval.heads.values.closed',
+    'evaluation_target_head_key_file': 'eval.heads.idx',
+}
+
+
+def _strings_to_array(strings):
+    """ Encode a list of strings (no new line inside) into a single utf8 byte array """
+    return np.frombuffer("\n".join(strings).encode('utf8'), dtype=np.uint8)
+
+
+def _array_to_strings(arr, size):
+    if size == 0:
+        return list()
+    return arr.tobytes().decode('utf8').split("\n")
+
+
+def _rows_to_csr(rows, dtype=np.int32):
+    """ Convert a list of integer lists to (values, offsets) where row i is values[offsets[i]:offsets[i+1]] """
+    offsets = np.zeros([len(rows) + 1], dtype=np.int64)
+    np.cumsum([len(r) for r in rows], out=offsets[1:])
+    values = np.fromiter((x for r in rows for x in r), dtype=dtype, count=int(offsets[-1]))
+    return values, offsets
+
+
+def _source_signature(path):
+    return get_manifest(os.path.dirname(path)).checksum(path)
+
+
+def _source_signatures(paths):
+    """ Signatures of a dict of source files, the manifest is written once for all of them """
+    signatures = dict((k, _source_signature(p)) for k, p in paths.items())
+    save_manifests()
+    return signatures
+
+
+class _WordIndex(object):
+    """ Map words to vocab ids, words that are not in the vocab get an
+    id >= n_vocab so the original string can always be recovered from the bundle.
+    """
+
+    def __init__(self, vocab):
+        self.vocab = vocab
+        self.oov_words = dict()
+
+    def __call__(self, word):
+        idx = self.vocab.get(word)
+        if idx is None:
+            idx = self.oov_words.get(word)
+            if idx is None:
+                idx = len(self.vocab) + len(self.oov_words)
+                self.oov_words[word] = idx
+        return idx
+
+
+def _compile_content(content_file_path, keys, word_index, max_content_len):
+    values, offsets = compact_rows(len(keys), ((i, [word_index(w) for w in words]) for i, words in
+                                               iter_content(content_file_path, keys, max_content_len)))
+    tf.logging.info("Compiled %d content data from %s" % (len(keys), content_file_path))
+    return values, offsets
+
+
+def compile_targets(key_file_path, value_file_paths, entities, relations):
+    """ Target files are line aligned with the key file, the keys keep the order of the
+    key file so row i of each target array belongs to key i.
+
+    :param key_file_path: e.g. train.heads.idx
+    :param value_file_paths: target files aligned with the key file, e.g. train.heads.values
+    :param entities: entity name to id
+    :param relations: relation name to id
+    :return: int32 [n_keys, 2] (entity, relation) keys and a (values, offsets) pair for each value file
+    """
+    keys = list()
+    with open(key_file_path, 'r', encoding='utf8') as f:
+        for line in f:
+            ent, rel = line.strip().split('\t')
+            keys.append([entities[ent], relations[rel]])
+    keys = np.asarray(keys, dtype=np.int32).reshape([-1, 2])
+
+    targets = list()
+    for value_file_path in value_file_paths:
+        rows = list()
+        with open(value_file_path, 'r', encoding='utf8') as f:
+            for line in f:
+                rows.append([entities[x] for x in line.split()])
+        if len(rows) != keys.shape[0]:
+            raise ValueError("%s has %d lines but the key file %s has %d" % (value_file_path, len(rows),
+                                                                              key_file_path, keys.shape[0]))
+        targets.append(_rows_to_csr(rows))
+    tf.logging.info("Compiled %d target keys from %s" % (keys.shape[0], key_file_path))
+    return keys, targets
+
+
+def compile_dataset(dataset_dir, bundle_dir=None, max_content_len=256):
+    """ Parse all text files of a dataset once and write them into a memory-mappable bundle.
+
+    The bundle is a directory of .npy files plus a meta.json, entities, relations and words
+    are all replaced by their numerical ids. Variable length data (content, targets) are stored
+    in CSR format, i.e. row i is values[offsets[i]:offsets[i+1]].
+
+    :param dataset_dir: dataset directory with the standard layout in DATASET_FILES
+    :param bundle_dir: output directory, default to dataset_dir/dataset.bundle
+    :param max_content_len: content longer than this will be truncated
+    :return: bundle_dir
+    """
+    if bundle_dir is None:
+        bundle_dir = os.path.join(dataset_dir, 'dataset.bundle')
+    os.makedirs(bundle_dir, exist_ok=True)
+
+    paths = dict((k, os.path.join(dataset_dir, v)) for k, v in DATASET_FILES.items())
+
+    entities = load_list(paths['entity_file'])
+    relations = load_list(paths['relation_file'])
+    vocab = load_list(paths['vocab_file'])
+    word_index = _WordIndex(vocab)
+
+    arrays = dict()
+    arrays['entities'] = _strings_to_array(list(entities.keys()))
+    arrays['relations'] = _strings_to_array(list(relations.keys()))
+    arrays['vocab'] = _strings_to_array(list(vocab.keys()))
+
+    n_triples = 0
+    triples = list()
+    with open(paths['train_file'], 'r', encoding='utf8') as f:
+        for line in f:
+            head, tail, rel = line.strip().split('\t')
+            triples.append((entities[head], relations[rel], entities[tail]))
+            n_triples += 1
+    arrays['train_triples'] = np.asarray(triples, dtype=np.int32).reshape([n_triples, 3])
+    del triples
+
+    avoid_entities = np.asarray([entities[x] for x in load_list(paths['avoid_entity_file'])], dtype=np.int32)
+    arrays['avoid_entities'] = avoid_entities
+    arrays['closed_entities'] = np.setdiff1d(np.arange(len(entities), dtype=np.int32), avoid_entities)
+
+    for name, key in [('entity_content', 'content_file'), ('entity_title', 'entity_title_file')]:
+        arrays[name + '.values'], arrays[name + '.offsets'] = _compile_content(paths[key], entities,
+                                                                                word_index, max_content_len)
+    arrays['relation_title.values'], arrays['relation_title.offsets'] = _compile_content(
+        paths['relation_title_file'], relations, word_index, max_content_len)
+    arrays['oov_words'] = _strings_to_array(list(word_index.oov_words.keys()))
+
+    for name, key_file, value_files in [
+        ('train_tails', 'training_target_tail_key_file', [('', 'training_target_tail_file')]),
+        ('train_heads', 'training_target_head_key_file', [('', 'training_target_head_file')]),
+        ('eval_tails', 'evaluation_target_tail_key_file', [('_open', 'evaluation_open_target_tail_file'),
+                                                           ('_closed', 'evaluation_closed_target_tail_file')]),
+        ('eval_heads', 'evaluation_target_head_key_file', [('_open', 'evaluation_open_target_head_file'),
+                                                           ('_closed', 'evaluation_closed_target_head_file')])]:
+        keys, targets = compile_targets(paths[key_file], [paths[x] for _, x in value_files], entities, relations)
+        arrays[name + '.keys'] = keys
+        for (suffix, _), (values, offsets) in zip(value_files, targets):
+            arrays[name + suffix + '.values'] = values
+            arrays[name + suffix + '.offsets'] = offsets
+
+    for name, arr in arrays.items():
+        np.save(os.path.join(bundle_dir, name + '.npy'), arr)
+
+    meta = {
+        'version': BUNDLE_VERSION,
+        'n_entity': len(entities),
+        'n_relation': len(relations),
+        'n_vocab': len(vocab),
+        'n_oov_words': len(word_index.oov_words),
+        'max_content_len': max_content_len,
+        'arrays': sorted(arrays.keys()),
+        'sources': _source_signatures(paths),
+    }
+    # Write meta last so a partially written bundle is never picked up
+    with open(os.path.join(bundle_dir, 'meta.json'), 'w', encoding='utf8') as f:
+        json.dump(meta, f, indent=2, sort_keys=True)
+
+    tf.logging.info("Compiled dataset %s into %s" % (dataset_dir, bundle_dir))
+    return bundle_dir
+
+
+class DatasetBundle(object):
+    """ Read-only view of a compiled dataset, all arrays are memory-mapped and nothing
+    is copied until the values are actually used.
+    """
+
+    def __init__(self, bundle_dir):
+        self.bundle_dir = bundle_dir
+        meta_path = os.path.join(bundle_dir, 'meta.json')
+        if not os.path.exists(meta_path):
+            raise ValueError("%s is not a compiled dataset, run tools/compile_dataset.py first" % bundle_dir)
+        with open(meta_path, 'r', encoding='utf8') as f:
+            self.meta = json.load(f)
+        if self.meta['version'] != BUNDLE_VERSION:
+            raise ValueError("Dataset bundle %s has version %d, expect %d" % (bundle_dir, self.meta['version'],
+                                                                              BUNDLE_VERSION))
+        self.n_entity = self.meta['n_entity']
+        self.n_relation = self.meta['n_relation']
+        self.n_vocab = self.meta['n_vocab']
+        self.__arrays = dict()
+
+    def __contains__(self, name):
+        return name in self.meta['arrays']
+
+    def __getitem__(self, name):
+        if name not in self.__arrays:
+            if name not in self:
+                raise KeyError("%s is not in dataset bundle %s" % (name, self.bundle_dir))
+            self.__arrays[name] = np.load(os.path.join(self.bundle_dir, name + '.npy'), mmap_mode='r')
+        return self.__arrays[name]
+
+    def csr(self, name):
+        """ Return (values, offsets) of a CSR array """
+        return self[name + '.values'], self[name + '.offsets']
+
+    def strings(self, name):
+        """ Decode a string table """
+        size = {'entities': self.n_entity, 'relations': self.n_relation,
+                'vocab': self.n_vocab, 'oov_words': self.meta['n_oov_words']}[name]
+        return _array_to_strings(self[name], size)
+
+    def is_stale(self, dataset_dir):
+        """ Check if any of the source files changed after the bundle was compiled """
+        paths = dict((k, os.path.join(dataset_dir, DATASET_FILES[k])) for k in self.meta['sources'])
+        if not all(os.path.exists(p) for p in paths.values()):
+            return True
+        return _source_signatures(paths) != self.meta['sources']
+
+    def content_ids(self, name, oov):
+        """ Return (values, offsets) of a content array where out of vocab words are
+        hashed into `oov` buckets, same as load_content_ids
+        """
+        values, offsets = self.csr(name)
+        if self.meta['n_oov_words'] == 0:
+            return values, offsets
+        oov_ids = np.asarray([oov_bucket(w, self.n_vocab, oov) for w in self.strings('oov_words')], dtype=np.int32)
+        ids = np.where(values < self.n_vocab, values, oov_ids[np.maximum(values - self.n_vocab, 0)])
+        if oov > 0:
+            return ids, offsets
+        # drop oov words if there is no oov bucket
+        keep = ids >= 0
+        n_rows = len(offsets) - 1
+        rows = np.repeat(np.arange(n_rows), np.diff(offsets))
+        kept_offsets = np.zeros([n_rows + 1], dtype=np.int64)
+        np.cumsum(np.bincount(rows[keep], minlength=n_rows), out=kept_offsets[1:])
+        return ids[keep], kept_offsets
+
+
+def load_dataset_bundle(bundle_dir, dataset_dir=None):
+    bundle = DatasetBundle(bundle_dir)
+    if dataset_dir is not None and bundle.is_stale(dataset_dir):
+        tf.logging.warning("Dataset bundle %s is older than the files in %s, "
+                           "re-run tools/compile_dataset.py" % (bundle_dir, dataset_dir))
+    tf.logging.info("Loaded dataset bundle %s" % bundle_dir)
+    return bundle
@@ -0,0 +1,320 @@
+import json
+import os
+
+import numpy as np
+
+import tensorflow as tf
+
+from ndkgc.utils import iter_content, load_list
+from ndkgc.utils.bundle import DATASET_FILES, DatasetBundle, _WordIndex, _source_signatures, _strings_to_array
+from ndkgc.utils.preprocess import SPLIT_FILES, group_targets, load_splits
+
+# Files in a delta directory that are appended to the dataset as they are
+CONTENT_FILES = ['content_file', 'entity_title_file', 'relation_title_file']
+
+
+class TargetDelta(object):
+    """ New targets of a target index grouped by (entity, relation) key, keys are in the
+    order of their first appearance in the delta triples.
+    """
+
+    def __init__(self, triples, key_cols, value_col, n_entity, n_relation):
+        keys, values, offsets = group_targets(triples[:, key_cols], triples[:, value_col], n_entity, n_relation)
+        self.keys = [tuple(x) for x in keys.tolist()]
+        self.values = [values[offsets[i]:offsets[i + 1]].tolist() for i in range(len(self.keys))]
+
+
+def _merge_row(rows, new_targets, moved, is_open):
+    """ Merge new targets into the target rows of a single key.
+
+    rows is [targets] for training targets and [open targets, closed targets] for evaluation
+    targets. Entities in `moved` are seen in the training data for the first time and are
+    moved from the open row to the end of the closed row. New targets are appended to the
+    end of the matching row if they are not already there.
+    """
+    rows = [list(x) for x in rows]
+    if len(rows) == 2 and moved:
+        moved_targets = [x for x in rows[0] if x in moved]
+        if moved_targets:
+            rows = [[x for x in rows[0] if x not in moved], rows[1] + moved_targets]
+    seen = set(x for row in rows for x in row)
+    for x in new_targets:
+        if x not in seen:
+            rows[0 if len(rows) == 1 or is_open[x] else 1].append(x)
+            seen.add(x)
+    return rows
+
+
+def _append_lines(file_path, lines):
+    """ Append lines to a file, make sure the existing content ends with a new line """
+    needs_new_line = False
+    if os.path.exists(file_path) and os.path.getsize(file_path) > 0:
+        with open(file_path, 'rb') as f:
+            f.seek(-1, os.SEEK_END)
+            needs_new_line = f.read(1) != b'\n'
+    with open(file_path, 'a', encoding='utf8') as f:
+        if needs_new_line:
+            f.write("\n")
+        for line in lines:
+            f.write(line + "\n")
+
+
+def _read_lines(file_path):
+    if not os.path.exists(file_path):
+        return list()
+    with open(file_path, 'r', encoding='utf8') as f:
+        return [x for x in (line.strip() for line in f) if x]
+
+
+def _update_target_files(dataset_dir, idx_file, value_files, delta, entities, relations,
+                         entity_names, relation_names, moved, is_open):
+    """ Stream the existing idx and value files into new files, only the lines of keys in the
+    delta (or lines with moved entities) are parsed, new keys are appended at the end.
+    The other lines are copied as they are, but every file is still rewritten.
+    """
+    paths = [os.path.join(dataset_dir, x) for x in [idx_file] + value_files]
+    new_targets = dict(zip(delta.keys, delta.values))
+
+    def _format(rows):
+        return [" ".join(entity_names[x] for x in row) for row in rows]
+
+    files = [open(p, 'r', encoding='utf8') for p in paths]
+    out_files = [open(p + '.tmp', 'w', encoding='utf8') for p in paths]
+    try:
+        for lines in zip(*files):
+            key_line = lines[0].strip()
+            ent, rel = key_line.split('\t')
+            key = (entities[ent], relations[rel])
+            targets = new_targets.pop(key, None)
+            value_lines = [x.strip() for x in lines[1:]]
+            if targets is None and not (len(value_lines) == 2 and moved and value_lines[0]):
+                for f, line in zip(out_files, [key_line] + value_lines):
+                    f.write(line + "\n")
+                continue
+            rows = _merge_row([[entities[x] for x in line.split()] for line in value_lines],
+                              targets or [], moved, is_open)
+            for f, line in zip(out_files, [key_line] + _format(rows)):
+                f.write(line + "\n")
+
+        for key, targets in zip(delta.keys, delta.values):
+            if key not in new_targets:
+                continue
+            rows = _merge_row([[]] * len(value_files), targets, moved, is_open)
+            for f, line in zip(out_files, [entity_names[key[0]] + '\t' + relation_names[key[1]]] + _format(rows)):
+                f.write(line + "\n")
+    finally:
+        for f in files + out_files:
+            f.close()
+    for p in paths:
+        os.replace(p + '.tmp', p)
+
+
+def _replace_csr_rows(values, offsets, rows, new_rows):
+    """ Replace rows of a CSR array and append new rows at the end, unchanged rows are copied in blocks
+
+    :param values:
+    :param offsets:
+    :param rows: dict of row id to the new values of that row
+    :param new_rows: list of values of appended rows
+    :return: values, offsets
+    """
+    lens = np.diff(offsets)
+    pieces = list()
+    prev = 0
+    for i in sorted(rows):
+        pieces.append(values[offsets[prev]:offsets[i]])
+        pieces.append(np.asarray(rows[i], dtype=values.dtype))
+        lens[i] = len(rows[i])
+        prev = i + 1
+    pieces.append(values[offsets[prev]:offsets[-1]])
+    pieces.extend(np.asarray(x, dtype=values.dtype) for x in new_rows)
+    lens = np.concatenate([lens, np.asarray([len(x) for x in new_rows], dtype=lens.dtype)])
+    new_offsets = np.zeros([len(lens) + 1], dtype=np.int64)
+    np.cumsum(lens, out=new_offsets[1:])
+    return np.concatenate(pieces), new_offsets
+
+
+def _update_target_arrays(keys, targets, delta, moved, is_open):
+    """ Same as _update_target_files on the CSR target arrays of a compiled dataset """
+    key_index = dict((tuple(x), i) for i, x in enumerate(keys.tolist()))
+    updated = dict()
+    if len(targets) == 2 and moved:
+        open_values, open_offsets = targets[0]
+        rows = np.repeat(np.arange(len(open_offsets) - 1), np.diff(open_offsets))
+        moved_rows = np.unique(rows[np.isin(open_values, np.asarray(list(moved), dtype=open_values.dtype))])
+        updated.update((int(i), list()) for i in moved_rows)
+    appended_keys = list()
+    appended = list()
+    for key, new_targets in zip(delta.keys, delta.values):
+        i = key_index.get(key)
+        if i is None:
+            appended_keys.append(key)
+            appended.append(_merge_row([[]] * len(targets), new_targets, moved, is_open))
+        else:
+            updated[i] = new_targets
+    merged = dict((i, _merge_row([v[o[i]:o[i + 1]].tolist() for v, o in targets], new_targets, moved, is_open))
+                  for i, new_targets in updated.items())
+
+    new_keys = np.concatenate([keys, np.asarray(appended_keys, dtype=keys.dtype).reshape([-1, 2])])
+    new_targets = [_replace_csr_rows(v, o, dict((i, rows[j]) for i, rows in merged.items()), [x[j] for x in appended])
+                   for j, (v, o) in enumerate(targets)]
+    return new_keys, new_targets
+
+
+def _update_content_arrays(values, offsets, n_rows, content_file_path, keys, word_index, max_content_len):
+    """ Replace the content of entities in a delta content file and append empty rows for new entities """
+    rows = dict()
+    if os.path.exists(content_file_path):
+        for i, words in iter_content(content_file_path, keys, max_content_len):
+            rows[i] = [word_index(w) for w in words]
+    n_old_rows = len(offsets) - 1
+    new_rows = [rows.pop(i, []) for i in range(n_old_rows, n_rows)]
+    return _replace_csr_rows(values, offsets, rows, new_rows)
+
+
+def update_dataset(dataset_dir, delta_dir, bundle_dir=None, n_workers=None):
+    """ Merge new entities, relations, content and triples into an existing dataset.
+
+    delta_dir has the same layout as a dataset directory and every file is optional:
+    entities.txt and relations.txt list new names, descriptions.txt, entity_names.txt and
+    relation_names.txt add or replace content, and train.txt, valid.txt and test.txt
+    contain new triples. Existing ids never change, new entities and relations get ids
+    after the existing ones.
+
+    The split and content files are appended, avoid_entities.txt and the target files are
+    merged without regrouping the existing triples. If the dataset has an up to date
+    compiled bundle, its arrays are merged the same way and written to new files.
+
+    Only the parsing and grouping scale with the delta. The target files are streamed into
+    new copies and every bundle array is rewritten, unchanged rows are copied in blocks
+    without being parsed, so the I/O of an update is still proportional to the dataset size.
+
+    The vocab is not updated because it decides the word embedding size, new words are
+    treated as out of vocab words.
+
+    :param dataset_dir:
+    :param delta_dir:
+    :param bundle_dir: default to dataset_dir/dataset.bundle
+    :param n_workers:
+    :return:
+    """
+    paths = dict((k, os.path.join(dataset_dir, v)) for k, v in DATASET_FILES.items())
+    delta_paths = dict((k, os.path.join(delta_dir, v)) for k, v in DATASET_FILES.items())
+    if bundle_dir is None:
+        bundle_dir = os.path.join(dataset_dir, 'dataset.bundle')
+
+    bundle = None
+    if os.path.exists(os.path.join(bundle_dir, 'meta.json')):
+        bundle = DatasetBundle(bundle_dir)
+        if bundle.is_stale(dataset_dir):
+            tf.logging.warning("Dataset bundle %s is stale and will not be updated, "
+                               "re-run tools/compile_dataset.py" % bundle_dir)
+            bundle = None
+
+    entities = load_list(paths['entity_file'])
+    relations = load_list(paths['relation_file'])
+    n_old_entity = len(entities)
+    new_entities = [x for x in _read_lines(delta_paths['entity_file']) if x not in entities]
+    new_relations = [x for x in _read_lines(delta_paths['relation_file']) if x not in relations]
+    for x in new_entities:
+        entities[x] = len(entities)
+    for x in new_relations:
+        relations[x] = len(relations)
+    entity_names = np.asarray(list(entities.keys()), dtype=object)
+    relation_names = np.asarray(list(relations.keys()), dtype=object)
+
+    parsed = load_splits(delta_dir, entities, relations, n_workers)
+    for split, (_, n_skipped) in parsed.items():
+        if n_skipped > 0:
+            raise ValueError("%d triples in %s of %s have unknown entities or relations" % (n_skipped, split,
+                                                                                          delta_dir))
+    splits = dict((k, v) for k, (v, _) in parsed.items())
+    train = splits.get('train.txt', np.zeros([0, 3], dtype=np.int32))
+    all_triples = np.concatenate([splits[x] for x in SPLIT_FILES if x in splits] + [np.zeros([0, 3], dtype=np.int32)])
+
+    # Entities seen in the new training triples are not open anymore
+    avoid_entities = [entities[x] for x in load_list(paths['avoid_entity_file'])]
+    is_open = np.zeros([len(entities)], dtype=np.bool_)
+    is_open[avoid_entities] = True
+    is_open[n_old_entity:] = True
+    is_open[train[:, 0]] = False
+    is_open[train[:, 2]] = False
+    moved = set(x for x in avoid_entities if not is_open[x])
+    avoid_entities = [x for x in avoid_entities if is_open[x]] + \
+                     [x for x in range(n_old_entity, len(entities)) if is_open[x]]
+
+    deltas = dict()
+    for prefix, triples in [('train', train), ('eval', all_triples)]:
+        for direction, key_cols, value_col in [('tails', [0, 1], 2), ('heads', [2, 1], 0)]:
+            deltas[(prefix, direction)] = TargetDelta(triples, key_cols, value_col, len(entities), len(relations))
+
+    # Update the compiled bundle first, it reads the current files for the content
+    if bundle is not None:
+        arrays = dict()
+        arrays['entities'] = _strings_to_array(entity_names.tolist())
+        arrays['relations'] = _strings_to_array(relation_names.tolist())
+        arrays['train_triples'] = np.concatenate([bundle['train_triples'], train])
+        arrays['avoid_entities'] = np.asarray(avoid_entities, dtype=np.int32)
+        arrays['closed_entities'] = np.flatnonzero(~is_open).astype(np.int32)
+
+        vocab = dict((w, i) for i, w in enumerate(bundle.strings('vocab')))
+        word_index = _WordIndex(vocab)
+        for w in bundle.strings('oov_words'):
+            word_index(w)
+        for name, key, keys in [('entity_content', 'content_file', entities),
+                                ('entity_title', 'entity_title_file', entities),
+                                ('relation_title', 'relation_title_file', relations)]:
+            values, offsets = bundle.csr(name)
+            arrays[name + '.values'], arrays[name + '.offsets'] = _update_content_arrays(
+                values, offsets, len(keys), delta_paths[key], keys, word_index, bundle.meta['max_content_len'])
+        arrays['oov_words'] = _strings_to_array(list(word_index.oov_words.keys()))
+
+        for prefix, name, suffixes in [('train', 'train', ['']), ('eval', 'eval', ['_open', '_closed'])]:
+            for direction in ['tails', 'heads']:
+                array_name = '%s_%s' % (name, direction)
+                keys, targets = _update_target_arrays(bundle[array_name + '.keys'],
+                                                      [bundle.csr(array_name + x) for x in suffixes],
+                                                      deltas[(prefix, direction)], moved, is_open)
+                arrays[array_name + '.keys'] = keys
+                for suffix, (values, offsets) in zip(suffixes, targets):
+                    arrays[array_name + suffix + '.values'] = values
+                    arrays[array_name + suffix + '.offsets'] = offsets
+
+    # Update the text files
+    _append_lines(paths['entity_file'], new_entities)
+    _append_lines(paths['relation_file'], new_relations)
+    for key in CONTENT_FILES:
+        _append_lines(paths[key], _read_lines(delta_paths[key]))
+    for split, triples in splits.items():
+        _append_lines(os.path.join(dataset_dir, split),
+                      (entity_names[h] + '\t' + entity_names[t] + '\t' + relation_names[r] for h, r, t in triples))
+    with open(paths['avoid_entity_file'], 'w', encoding='utf8') as f:
+        for x in avoid_entities:
+            f.write(entity_names[x] + "\n")
+    for prefix, value_suffixes in [('train', ['']), ('eval', ['.open', '.closed'])]:
+        for direction in ['tails', 'heads']:
+            _update_target_files(dataset_dir, '%s.%s.idx' % (prefix, direction),
+                                 ['%s.%s.values%s' % (prefix, direction, x) for x in value_suffixes],
+                                 deltas[(prefix, direction)], entities, relations,
+                                 entity_names, relation_names, moved, is_open)
+    tf.logging.info("Added %d entities, %d relations and %d triples to %s, %d entities are not open anymore" % (
+        len(new_entities), len(new_relations), all_triples.shape[0], dataset_dir, len(moved)))
+
+    if bundle is not None:
+        # Release the memory-mapped arrays before overwriting them
+        del bundle
+        with open(os.path.join(bundle_dir, 'meta.json'), 'r', encoding='utf8') as f:
+            meta = json.load(f)
+        os.remove(os.path.join(bundle_dir, 'meta.json'))
+        for name, arr in arrays.items():
+            # Write to a new file so arrays that are still memory-mapped are not truncated
+            path = os.path.join(bundle_dir, name + '.npy')
+            np.save(path + '.tmp.npy', arr)
+            os.replace(path + '.tmp.npy', path)
+        meta['n_entity'] = len(entities)
+        meta['n_relation'] = len(relations)
+        meta['n_oov_words'] = len(word_index.oov_words)
+        meta['sources'] = _source_signatures(paths)
+        with open(os.path.join(bundle_dir, 'meta.json'), 'w', encoding='utf8') as f:
+            json.dump(meta, f, indent=2, sort_keys=True)
+        tf.logging.info("Updated dataset bundle %s" % bundle_dir)
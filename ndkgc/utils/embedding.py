@@ -0,0 +1,94 @@
+import hashlib
+import os
+
+import numpy as np
+
+import tensorflow as tf
+
+# Number of bytes read from the embedding file per chunk
+CHUNK_SIZE = 64 * 1024 * 1024
+
+
+def _vocab_hash(vocab):
+    h = hashlib.sha1()
+    for word, idx in sorted(vocab.items(), key=lambda x: x[1]):
+        h.update(("%d\t%s\n" % (idx, word)).encode('utf8'))
+    return h.hexdigest()
+
+
+def _file_hash(file_path):
+    """ Pre-trained embedding files are several GB, so identify them by path, size and
+    modification time instead of hashing the content.
+    """
+    st = os.stat(file_path)
+    return hashlib.sha1(("%s\t%d\t%d" % (os.path.abspath(file_path), st.st_size,
+                                          st.st_mtime_ns)).encode('utf8')).hexdigest()
+
+
+def _parse_embedding_file(embedding_path, vocab, word_embedding_size, sep):
+    """ Parse the embedding file chunk by chunk and only keep rows of words in the vocab.
+
+    :return: int64 [K] vocab ids, float32 [K, word_embedding_size] embedding rows
+    """
+    ids = list()
+    rows = list()
+    with open(embedding_path, 'r', encoding='utf8') as f:
+        while True:
+            lines = f.readlines(CHUNK_SIZE)
+            if not lines:
+                break
+            chunk_ids = list()
+            chunk_vals = list()
+            for line in lines:
+                elems = line.strip().split(sep, 1)
+                idx = vocab.get(elems[0])
+                if idx is not None and len(elems) == 2:
+                    chunk_ids.append(idx)
+                    chunk_vals.append(elems[1])
+            if not chunk_ids:
+                continue
+            vals = np.fromstring(" ".join(chunk_vals), dtype=np.float32, sep=' ')
+            if vals.shape[0] != len(chunk_ids) * word_embedding_size:
+                raise ValueError("Embeddings in %s do not have %d dimensions, found %s" % (
+                    embedding_path, word_embedding_size, len(chunk_vals[0].split())))
+            ids.append(np.asarray(chunk_ids, dtype=np.int64))
+            rows.append(vals.reshape([-1, word_embedding_size]))
+    if not ids:
+        return np.zeros([0], dtype=np.int64), np.zeros([0, word_embedding_size], dtype=np.float32)
+    return np.concatenate(ids), np.concatenate(rows)
+
+
+def load_embedding_rows(embedding_path, vocab, word_embedding_size, sep=None, cache_dir=None):
+    """ Load the pre-trained embedding of all words in `vocab`.
+
+    The filtered rows are cached as .npy files keyed by the vocab and the embedding file,
+    so later runs only memory-map the cache instead of parsing the text file.
+
+    :param embedding_path: word followed by the embedding values per line
+    :param vocab: word to id
+    :param word_embedding_size:
+    :param sep: separator between the word and the values, None for any white space
+    :param cache_dir: default to embedding_path + '.cache'
+    :return: int64 [K] vocab ids, float32 [K, word_embedding_size] embedding rows
+    """
+    if cache_dir is None:
+        cache_dir = embedding_path + '.cache'
+    key = hashlib.sha1(("%s\t%s\t%d\t%r" % (_vocab_hash(vocab), _file_hash(embedding_path),
+                                            word_embedding_size, sep)).encode('utf8')).hexdigest()
+    ids_path = os.path.join(cache_dir, key + '.ids.npy')
+    rows_path = os.path.join(cache_dir, key + '.rows.npy')
+
+    if os.path.exists(ids_path) and os.path.exists(rows_path):
+        tf.logging.info("Load cached embedding %s from %s" % (embedding_path, cache_dir))
+        return np.load(ids_path, mmap_mode='r'), np.load(rows_path, mmap_mode='r')
+
+    ids, rows = _parse_embedding_file(embedding_path, vocab, word_embedding_size, sep)
+    tf.logging.info("Load %d embeddings from %s" % (ids.shape[0], embedding_path))
+    try:
+        os.makedirs(cache_dir, exist_ok=True)
+        np.save(rows_path, rows)
+        # ids are written last, a cache without ids is never used
+        np.save(ids_path, ids)
+    except OSError as e:
+        tf.logging.warning("Unable to cache embedding in %s: %s" % (cache_dir, e))
+    return ids, rows
@@ -0,0 +1,356 @@
+import os
+from collections import OrderedDict
+
+import numpy as np
+
+import tensorflow as tf
+
+from ndkgc.utils import load_list, load_triple_array
+from ndkgc.utils.bundle import compile_targets
+from ndkgc.utils.preprocess import group_targets
+
+
+def _counts_to_offsets(counts):
+    offsets = np.zeros([len(counts) + 1], dtype=np.int64)
+    np.cumsum(counts, out=offsets[1:])
+    return offsets
+
+
+class TargetEmbeddingCache(object):
+    """ LRU bookkeeping of the pre-computed target embeddings kept in a [n_rows, ?] cache variable
+
+    Each key (usually a relation) owns a contiguous range of rows. When a new key does not fit,
+    the least recently used keys are evicted until there is a large enough free range. The cached
+    embeddings depend on the model, call clear() after the variables are changed.
+    """
+
+    def __init__(self, n_rows):
+        self.n_rows = n_rows
+        # key -> (start, size), the last one is the most recently used
+        self.__resident = OrderedDict()
+
+    def __len__(self):
+        return len(self.__resident)
+
+    def __free_start(self, size):
+        """ Start of the first free range of at least size rows, None if there is none """
+        end = 0
+        for start, length in sorted(self.__resident.values()):
+            if start - end >= size:
+                return end
+            end = start + length
+        return end if self.n_rows - end >= size else None
+
+    def lookup(self, key, size):
+        """ Find the rows of key and mark it as the most recently used, allocate them if it is not resident
+
+        :param key:
+        :param size: number of targets of key
+        :return: start row, True if the embeddings of key are already in the cache and
+                 False if the caller has to compute and write them to rows [start, start + size)
+        """
+        if size > self.n_rows:
+            raise ValueError("%d targets of %s do not fit into a cache of %d rows" % (size, key, self.n_rows))
+
+        if key in self.__resident:
+            start, length = self.__resident.pop(key)
+            self.__resident[key] = (start, length)
+            if length == size:
+                return start, True
+            self.__resident.pop(key)
+
+        start = self.__free_start(size)
+        while start is None:
+            evicted, _ = self.__resident.popitem(last=False)
+            tf.logging.debug("Evict the cached targets of %s" % evicted)
+            start = self.__free_start(size)
+        self.__resident[key] = (start, size)
+        return start, False
+
+    def clear(self):
+        self.__resident.clear()
+
+
+class _LRURows(object):
+    """ Rows of a [n_rows, width] array (or memmap) owned by int64 keys, the least recently used keys are evicted
+
+    The keys are kept sorted with their rows so a batch of keys is looked up with np.searchsorted,
+    the recency of each row is the tick of its last use (-1 if the row is free).
+    """
+
+    def __init__(self, storage, keys=None, rows=None, ticks=None):
+        self.storage = storage
+        self.keys = np.zeros([0], dtype=np.int64) if keys is None else keys
+        self.rows = np.zeros([0], dtype=np.int64) if rows is None else rows
+        self.ticks = np.full([storage.shape[0]], -1, dtype=np.int64) if ticks is None else ticks
+        self.clock = int(np.max(self.ticks)) + 1
+
+    def __len__(self):
+        return len(self.keys)
+
+    def lookup(self, keys):
+        """ :return: row of each key, -1 for the missing ones """
+        if not len(self.keys):
+            return np.full([len(keys)], -1, dtype=np.int64)
+        pos = np.minimum(np.searchsorted(self.keys, keys), len(self.keys) - 1)
+        rows = np.where(self.keys[pos] == keys, self.rows[pos], -1)
+        self.ticks[rows[rows >= 0]] = self.clock
+        self.clock += 1
+        return rows
+
+    def put(self, keys, values):
+        """ Write the values of distinct keys, the least recently used rows are taken over by the new keys """
+        keys, values = keys[-len(self.ticks):], values[-len(self.ticks):]
+        rows = self.lookup(keys)
+        found = rows >= 0
+        self.storage[rows[found]] = values[found]
+
+        n_new = len(keys) - int(np.sum(found))
+        if not n_new:
+            return
+        # free rows have tick -1 so they are taken first, rows of keys just written have the latest tick
+        victims = np.argpartition(self.ticks, n_new - 1)[:n_new]
+        evicted = np.isin(self.rows, victims[self.ticks[victims] >= 0])
+        self.storage[victims] = values[~found]
+        self.ticks[victims] = self.clock
+        self.clock += 1
+
+        keys = np.concatenate([self.keys[~evicted], keys[~found]])
+        rows = np.concatenate([self.rows[~evicted], victims])
+        order = np.argsort(keys, kind='mergesort')
+        self.keys, self.rows = keys[order], rows[order]
+
+    def clear(self):
+        self.keys = self.keys[:0]
+        self.rows = self.rows[:0]
+        self.ticks[:] = -1
+
+
+class EntityEmbeddingCache(object):
+    """ Bounded host cache of transformed entities keyed by (entity, relation, checkpoint)
+
+    This is for models whose entity transformation depends on the relation (FCNModel), so
+    each (entity, relation) pair only goes through the model once per checkpoint. A cache
+    belongs to a single checkpoint, the least recently used embeddings are evicted when it
+    is full.
+
+    Within one evaluation run every pair is only needed once, so the cache only pays off
+    when it outlives the run: if spill_dir is given, the embeddings are also written to
+    spill_dir/tails.<checkpoint>.npy (a memory-mapped file of spill_rows rows) and save()
+    stores its index next to it, the next cache of the same checkpoint opens both again.
+    Files of other checkpoints are left alone.
+    """
+
+    def __init__(self, n_rows, width, checkpoint, spill_dir=None, spill_rows=0, dtype=np.float32):
+        self.width = width
+        self.dtype = dtype
+        self.checkpoint = checkpoint
+        self.hits = 0
+        self.misses = 0
+        self.__memory = _LRURows(np.zeros([n_rows, width], dtype=dtype))
+        self.__spill = None
+        if spill_dir is not None and spill_rows > 0:
+            os.makedirs(spill_dir, exist_ok=True)
+            self.__spill_file = os.path.join(spill_dir, 'tails.%d.npy' % checkpoint)
+            self.__index_file = os.path.join(spill_dir, 'tails.%d.index.npz' % checkpoint)
+            self.__spill = self.__open_spill(spill_rows)
+
+    def __open_spill(self, spill_rows):
+        if os.path.exists(self.__spill_file) and os.path.exists(self.__index_file):
+            storage = np.lib.format.open_memmap(self.__spill_file, mode='r+')
+            if storage.shape == (spill_rows, self.width) and storage.dtype == self.dtype:
+                with np.load(self.__index_file) as index:
+                    spill = _LRURows(storage, index['keys'], index['rows'], index['ticks'])
+                # rows are rewritten from now on, a run that does not save() must not leave a stale index
+                os.remove(self.__index_file)
+                tf.logging.info("Open %d cached tails of checkpoint %d" % (len(spill), self.checkpoint))
+                return spill
+            del storage
+        return _LRURows(np.lib.format.open_memmap(self.__spill_file, mode='w+', dtype=self.dtype,
+                                                  shape=(spill_rows, self.width)))
+
+    def __len__(self):
+        return len(self.__spill) if self.__spill is not None else len(self.__memory)
+
+    @property
+    def persistent(self):
+        return self.__spill is not None
+
+    @staticmethod
+    def __keys(entities, relation):
+        return (np.asarray(entities, dtype=np.int64) << 32) | int(relation)
+
+    def get(self, entities, relation):
+        """ Look up the embeddings of entities with the given relation
+
+        :param entities: 1-D entity ids
+        :param relation: relation id
+        :return: [len(entities), width] embeddings, rows of the misses are 0,
+                 positions of the misses in entities
+        """
+        keys = self.__keys(entities, relation)
+        embeds = np.zeros([len(keys), self.width], dtype=self.dtype)
+        rows = self.__memory.lookup(keys)
+        hit = rows >= 0
+        embeds[hit] = self.__memory.storage[rows[hit]]
+        if self.__spill is not None:
+            missed = np.flatnonzero(~hit)
+            rows = self.__spill.lookup(keys[missed])
+            found = missed[rows >= 0]
+            embeds[found] = self.__spill.storage[rows[rows >= 0]]
+            self.__memory.put(keys[found], embeds[found])
+            hit[found] = True
+        misses = np.flatnonzero(~hit)
+        self.hits += len(keys) - len(misses)
+        self.misses += len(misses)
+        return embeds, misses
+
+    def put(self, entities, relation, embeds):
+        """ Cache the embeddings of distinct entities with the given relation, see get """
+        keys = self.__keys(entities, relation)
+        self.__memory.put(keys, embeds)
+        if self.__spill is not None:
+            self.__spill.put(keys, embeds)
+
+    def save(self):
+        """ Flush the spill file and store its index so that the next run can open it """
+        if self.__spill is None:
+            return
+        self.__spill.storage.flush()
+        tmp_file = self.__index_file[:-len('.npz')] + '.tmp.npz'
+        np.savez(tmp_file, keys=self.__spill.keys, rows=self.__spill.rows, ticks=self.__spill.ticks)
+        os.replace(tmp_file, self.__index_file)
+
+    def clear(self):
+        for tier in [self.__memory, self.__spill]:
+            if tier is not None:
+                tier.clear()
+
+
+class EvaluationIndex(object):
+    """ Integer index for the manual tail evaluation in main(), this replaces
+    load_manual_evaluation_file_by_rel, load_relation_specific_targets and load_filtered_targets.
+
+    For each evaluated relation r, the candidate targets are all entities seen as a tail of r
+    during training, stored in CSR format and sorted by entity id. For each (head, r) query the
+    test targets and the true (filtered) targets are stored as sorted positions in the candidate
+    list of r, so they can be fed to ph_test_target_idx / ph_true_target_idx directly.
+
+    Every relation of the evaluation file is kept, relations without training tails have no
+    candidates and all their test targets are counted as missed.
+    """
+
+    def __init__(self, dataset_dir, eval_file='test.txt'):
+        entities = load_list(os.path.join(dataset_dir, 'entities.txt'))
+        relations = load_list(os.path.join(dataset_dir, 'relations.txt'))
+        self.entity_names = np.asarray(list(entities.keys()), dtype=object)
+        self.relation_names = np.asarray(list(relations.keys()), dtype=object)
+        n_entity = len(entities)
+        n_relation = len(relations)
+
+        is_open = np.zeros([n_entity], dtype=np.bool_)
+        is_open[[entities[x] for x in load_list(os.path.join(dataset_dir, 'avoid_entities.txt'))]] = True
+
+        # Only evaluate open heads with closed tails
+        triples = load_triple_array(os.path.join(dataset_dir, eval_file), entities, relations)
+        triples = triples[is_open[triples[:, 0]] & ~is_open[triples[:, 2]]]
+        # (head, rel) keys in the order of first appearance and their sorted test tails
+        query_keys, test_values, test_offsets = group_targets(triples[:, :2], triples[:, 2], n_entity, n_relation)
+
+        # Candidates are tails of each relation in training, coded as rel * n_entity + tail and sorted
+        train_keys, _ = compile_targets(os.path.join(dataset_dir, 'train.heads.idx'), [], entities, relations)
+        candidate_codes = np.unique(train_keys[:, 1].astype(np.int64) * n_entity + train_keys[:, 0])
+        candidate_offsets = np.searchsorted(candidate_codes, np.arange(n_relation + 1, dtype=np.int64) * n_entity)
+
+        # Queries of relations without candidates are kept, all their test targets are missed
+        query_rels = query_keys[:, 1]
+        for r in np.unique(query_rels[np.diff(candidate_offsets)[query_rels] == 0]):
+            tf.logging.warning("Relation %s does not have any valid targets!" % self.relation_names[r])
+
+        # Group queries by relation, relations are in the order of first appearance
+        rels, first_seen = np.unique(query_rels, return_index=True)
+        rels = rels[np.argsort(first_seen, kind='mergesort')]
+        rel_rank = np.full([n_relation], len(rels), dtype=np.int64)
+        rel_rank[rels] = np.arange(len(rels))
+        query_order = np.argsort(rel_rank[query_rels], kind='mergesort')
+
+        def _positions(query_ids, rows, values, offsets):
+            """ Positions of each row's values in the candidates of the query relation,
+            values that are not candidates are dropped
+            """
+            lens = np.diff(offsets)[rows]
+            row_queries = np.repeat(np.arange(len(query_ids)), lens)
+            row_values = values[np.repeat(offsets[rows], lens) + np.arange(lens.sum()) -
+                                np.repeat(_counts_to_offsets(lens)[:-1], lens)]
+            row_rels = query_rels[query_ids][row_queries].astype(np.int64)
+            codes = row_rels * n_entity + row_values
+            pos = np.minimum(np.searchsorted(candidate_codes, codes), max(len(candidate_codes) - 1, 0))
+            found = candidate_codes[pos] == codes if len(candidate_codes) else np.zeros(codes.shape, dtype=np.bool_)
+            pos = pos[found] - candidate_offsets[row_rels[found]]
+            row_queries = row_queries[found]
+            order = np.lexsort([pos, row_queries])
+            return pos[order].astype(np.int32), _counts_to_offsets(np.bincount(row_queries, minlength=len(query_ids))), \
+                   np.bincount(row_queries, minlength=len(query_ids))
+
+        self.test_positions, self.test_offsets, n_found = _positions(query_order, query_order,
+                                                                     test_values, test_offsets)
+        self.misses = (np.diff(test_offsets)[query_order] - n_found).astype(np.int32)
+
+        # True targets are closed targets of (head, rel) in train/valid/test that are also candidates
+        eval_keys, [(closed_values, closed_offsets)] = compile_targets(
+            os.path.join(dataset_dir, 'eval.tails.idx'),
+            [os.path.join(dataset_dir, 'eval.tails.values.closed')], entities, relations)
+        eval_codes = eval_keys[:, 0].astype(np.int64) * n_relation + eval_keys[:, 1]
+        eval_order = np.argsort(eval_codes, kind='mergesort')
+        query_codes = query_keys[query_order, 0].astype(np.int64) * n_relation + query_keys[query_order, 1]
+        eval_pos = np.minimum(np.searchsorted(eval_codes[eval_order], query_codes), len(eval_codes) - 1)
+        eval_rows = eval_order[eval_pos]
+        # (head, rel) pairs that are not in the eval index do not have any true targets
+        closed_offsets = np.append(closed_offsets, closed_offsets[-1])
+        eval_rows = np.where(eval_codes[eval_rows] == query_codes, eval_rows, len(closed_offsets) - 2)
+        self.true_positions, self.true_offsets, _ = _positions(query_order, eval_rows, closed_values, closed_offsets)
+
+        self.candidates = (candidate_codes % n_entity).astype(np.int32)
+        self.candidate_offsets = candidate_offsets
+        self.relations = rels.astype(np.int32)
+        self.heads = query_keys[query_order, 0]
+        self.query_offsets = np.searchsorted(rel_rank[query_rels[query_order]], np.arange(len(rels) + 1))
+        tf.logging.info("Evaluation index: %d relations, %d queries, %d test targets" % (
+            len(self.relations), len(self.heads), len(self.test_positions)))
+
+    def __len__(self):
+        return len(self.relations)
+
+    def candidate_targets(self, i):
+        """ Sorted candidate target ids of the i-th evaluated relation """
+        r = self.relations[i]
+        return self.candidates[self.candidate_offsets[r]:self.candidate_offsets[r + 1]]
+
+    def queries(self, i):
+        """ Iterate over the queries of the i-th evaluated relation
+
+        :return: a generator of (head, test target positions, true target positions, number of missed targets)
+        """
+        for q in range(self.query_offsets[i], self.query_offsets[i + 1]):
+            yield self.heads[q], \
+                  self.test_positions[self.test_offsets[q]:self.test_offsets[q + 1]], \
+                  self.true_positions[self.true_offsets[q]:self.true_offsets[q + 1]], \
+                  self.misses[q]
+
+    def query_batches(self, i, batch_size):
+        """ Iterate over the queries of the i-th evaluated relation in batches of heads
+
+        Test and true target positions of the heads in a batch are in CSR format with offsets
+        starting at 0, they can be fed to the placeholders of batched_eval_ops directly.
+
+        :return: a generator of (heads, test target positions, test target offsets,
+                 true target positions, true target offsets, number of missed targets of each head)
+        """
+        for start in range(self.query_offsets[i], self.query_offsets[i + 1], batch_size):
+            end = min(start + batch_size, self.query_offsets[i + 1])
+            test_offsets = self.test_offsets[start:end + 1]
+            true_offsets = self.true_offsets[start:end + 1]
+            yield self.heads[start:end], \
+                  self.test_positions[test_offsets[0]:test_offsets[-1]], test_offsets - test_offsets[0], \
+                  self.true_positions[true_offsets[0]:true_offsets[-1]], true_offsets - true_offsets[0], \
+                  self.misses[start:end]
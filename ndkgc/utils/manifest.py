@@ -0,0 +1,116 @@
+import atexit
+import hashlib
+import json
+import os
+
+import tensorflow as tf
+
+MANIFEST_VERSION = 1
+MANIFEST_FILE = 'manifest.json'
+# Only directories with these files are dataset directories, files in other directories
+# (e.g. pretrained embeddings or checkpoints) are scanned without writing a manifest there
+DATASET_MARKERS = ('entities.txt', 'relations.txt')
+
+# Number of bytes read per block when scanning a file
+BLOCK_SIZE = 16 * 1024 * 1024
+
+
+def _scan_file(file_path):
+    """ Count lines and compute the sha1 of a file in a single pass """
+    n_lines = 0
+    last = b''
+    h = hashlib.sha1()
+    with open(file_path, 'rb') as f:
+        while True:
+            block = f.read(BLOCK_SIZE)
+            if not block:
+                break
+            h.update(block)
+            n_lines += block.count(b'\n')
+            last = block[-1:]
+    # Same as iterating over the lines, the last line may not end with a new line
+    if last and last != b'\n':
+        n_lines += 1
+    return n_lines, h.hexdigest()
+
+
+class DatasetManifest(object):
+    """ Size, modification time, line count and sha1 of the files in a dataset directory.
+
+    The manifest is stored as manifest.json in the dataset directory and a file is only
+    scanned again when its size or modification time changed. New entries are kept in
+    memory until save() is called, so a batch of scans writes the manifest once.
+    A manifest that is not persistent is never read from or written to disk.
+    """
+
+    def __init__(self, dataset_dir, persistent=True):
+        self.dataset_dir = dataset_dir
+        self.manifest_path = os.path.join(dataset_dir, MANIFEST_FILE)
+        self.persistent = persistent
+        self.files = dict()
+        self.dirty = False
+        if persistent and os.path.exists(self.manifest_path):
+            try:
+                with open(self.manifest_path, 'r', encoding='utf8') as f:
+                    manifest = json.load(f)
+                if manifest.get('version') == MANIFEST_VERSION:
+                    self.files = manifest['files']
+            except ValueError:
+                tf.logging.warning("Ignore corrupted dataset manifest %s" % self.manifest_path)
+
+    def entry(self, file_path):
+        """ Return the manifest entry of a file in the dataset directory, rescan it if it changed """
+        name = os.path.basename(file_path)
+        st = os.stat(file_path)
+        entry = self.files.get(name)
+        if entry is None or entry['size'] != st.st_size or entry['mtime_ns'] != st.st_mtime_ns:
+            n_lines, sha1 = _scan_file(file_path)
+            entry = {'size': st.st_size, 'mtime_ns': st.st_mtime_ns, 'lines': n_lines, 'sha1': sha1}
+            self.files[name] = entry
+            self.dirty = True
+        return entry
+
+    def count_line(self, file_path):
+        return self.entry(file_path)['lines']
+
+    def checksum(self, file_path):
+        return self.entry(file_path)['sha1']
+
+    def save(self):
+        if not self.persistent or not self.dirty:
+            return
+        tmp_path = self.manifest_path + '.tmp'
+        try:
+            with open(tmp_path, 'w', encoding='utf8') as f:
+                json.dump({'version': MANIFEST_VERSION, 'files': self.files}, f, indent=2, sort_keys=True)
+            os.replace(tmp_path, self.manifest_path)
+            self.dirty = False
+        except OSError as e:
+            # Read-only dataset directories still use the in-memory manifest
+            tf.logging.warning("Unable to write dataset manifest %s: %s" % (self.manifest_path, e))
+
+
+_manifests = dict()
+
+
+def is_dataset_dir(path):
+    return all(os.path.exists(os.path.join(path, x)) for x in DATASET_MARKERS)
+
+
+def get_manifest(dataset_dir):
+    """ Return the manifest of a directory, manifests are shared in a process and only
+    the manifests of dataset directories are persistent
+    """
+    dataset_dir = os.path.abspath(dataset_dir)
+    if dataset_dir not in _manifests:
+        _manifests[dataset_dir] = DatasetManifest(dataset_dir, persistent=is_dataset_dir(dataset_dir))
+    return _manifests[dataset_dir]
+
+
+def save_manifests():
+    """ Write the manifests with new entries, this also runs when the process exits """
+    for manifest in _manifests.values():
+        manifest.save()
+
+
+atexit.register(save_manifests)
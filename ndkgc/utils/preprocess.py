@@ -0,0 +1,269 @@
+import multiprocessing
+import os
+
+import numpy as np
+
+import tensorflow as tf
+
+from ndkgc.utils import load_list
+
+SPLIT_FILES = ['train.txt', 'valid.txt', 'test.txt']
+CONTENT_FILES = ['descriptions.txt', 'entity_names.txt', 'relation_names.txt']
+
+# Shared with the worker processes, set by _init_worker
+_worker_entities = None
+_worker_relations = None
+
+
+def _init_worker(entities, relations):
+    global _worker_entities, _worker_relations
+    _worker_entities = entities
+    _worker_relations = relations
+
+
+def _shard_file(file_path, n_shards):
+    """ Split a file into at most n_shards byte ranges, each range starts at the beginning of a line """
+    size = os.path.getsize(file_path)
+    bounds = [0]
+    with open(file_path, 'rb') as f:
+        for i in range(1, n_shards):
+            pos = size * i // n_shards
+            if pos <= bounds[-1]:
+                continue
+            f.seek(pos - 1)
+            f.readline()
+            if f.tell() >= size:
+                break
+            if f.tell() > bounds[-1]:
+                bounds.append(f.tell())
+    bounds.append(size)
+    return [(file_path, start, end) for start, end in zip(bounds[:-1], bounds[1:]) if end > start]
+
+
+def _parse_shard(shard):
+    """ Parse the head \t tail \t relation lines in a byte range into an int32 [N, 3]
+    (head, relation, tail) array, triples with unknown entities or relations are skipped.
+
+    :return: triples, number of skipped triples
+    """
+    file_path, start, end = shard
+    triples = list()
+    n_skipped = 0
+    with open(file_path, 'rb') as f:
+        f.seek(start)
+        for line in f.read(end - start).decode('utf8').splitlines():
+            if not line.strip():
+                continue
+            src, dst, rel_name = line.strip().split('\t')
+            head = _worker_entities.get(src)
+            tail = _worker_entities.get(dst)
+            rel = _worker_relations.get(rel_name)
+            if head is None or tail is None or rel is None:
+                n_skipped += 1
+                continue
+            triples.append((head, rel, tail))
+    return np.asarray(triples, dtype=np.int32).reshape([-1, 3]), n_skipped
+
+
+def group_targets(keys, values, n_entity, n_relation):
+    """ Group target entities by their (entity, relation) key.
+
+    Keys are in the order of their first appearance in `keys`, which is the same order as
+    iterating over a dict, and the targets of each key are unique and sorted.
+
+    :param keys: int [N, 2] (entity, relation)
+    :param values: int [N] target entities
+    :param n_entity:
+    :param n_relation:
+    :return: int32 [K, 2] keys, int32 values, int64 offsets
+    """
+    if keys.shape[0] == 0:
+        return np.zeros([0, 2], dtype=np.int32), np.zeros([0], dtype=np.int32), np.zeros([1], dtype=np.int64)
+    key_codes = keys[:, 0].astype(np.int64) * n_relation + keys[:, 1]
+    unique_keys, first_seen = np.unique(key_codes, return_index=True)
+
+    pair_codes = np.unique(key_codes * n_entity + values)
+    pair_keys = pair_codes // n_entity
+    counts = np.bincount(np.searchsorted(unique_keys, pair_keys), minlength=unique_keys.shape[0])
+    sorted_offsets = np.zeros([unique_keys.shape[0] + 1], dtype=np.int64)
+    np.cumsum(counts, out=sorted_offsets[1:])
+
+    # Reorder the groups by first appearance
+    order = np.argsort(first_seen, kind='mergesort')
+    offsets = np.zeros_like(sorted_offsets)
+    np.cumsum(counts[order], out=offsets[1:])
+    rows = np.repeat(order, counts[order])
+    positions = sorted_offsets[rows] + np.arange(offsets[-1]) - np.repeat(offsets[:-1], counts[order])
+    grouped_values = (pair_codes[positions] % n_entity).astype(np.int32)
+
+    grouped_keys = np.stack([unique_keys[order] // n_relation, unique_keys[order] % n_relation], axis=1)
+    return grouped_keys.astype(np.int32), grouped_values, offsets
+
+
+def split_targets(values, offsets, mask):
+    """ Split each row of a CSR array into (values where mask is False, values where mask is True) """
+    rows = np.repeat(np.arange(len(offsets) - 1), np.diff(offsets))
+    res = list()
+    for selected in [~mask[values], mask[values]]:
+        split_offsets = np.zeros_like(offsets)
+        np.cumsum(np.bincount(rows[selected], minlength=len(offsets) - 1), out=split_offsets[1:])
+        res.append((values[selected], split_offsets))
+    return res
+
+
+def _write_lines(file_path, lines):
+    with open(file_path, 'w', encoding='utf8') as f:
+        for line in lines:
+            f.write(line + "\n")
+
+
+def _write_targets(dataset_dir, idx_file, value_files, keys, targets, entities, relations):
+    _write_lines(os.path.join(dataset_dir, idx_file),
+                 (entities[e] + '\t' + relations[r] for e, r in keys))
+    for value_file, (values, offsets) in zip(value_files, targets):
+        _write_lines(os.path.join(dataset_dir, value_file),
+                     (" ".join(entities[values[offsets[i]:offsets[i + 1]]]) for i in range(len(offsets) - 1)))
+
+
+def load_splits(dataset_dir, entities, relations, n_workers=None):
+    """ Parse train/valid/test with a pool of worker processes, each file is read once
+    and sharded by byte ranges.
+
+    :return: dict of split file name to (int32 [N, 3] (head, relation, tail) triples, number of skipped triples)
+    """
+    n_workers = n_workers or multiprocessing.cpu_count()
+    shards = list()
+    for split in SPLIT_FILES:
+        p = os.path.join(dataset_dir, split)
+        if not os.path.exists(p):
+            tf.logging.info("skip %s" % p)
+            continue
+        shards.extend((split, s) for s in _shard_file(p, n_workers))
+
+    with multiprocessing.Pool(n_workers, initializer=_init_worker, initargs=(entities, relations)) as pool:
+        results = pool.map(_parse_shard, [s for _, s in shards])
+
+    splits = dict()
+    for split in SPLIT_FILES:
+        parsed = [r for (name, _), r in zip(shards, results) if name == split]
+        if not parsed:
+            continue
+        triples = np.concatenate([t for t, _ in parsed])
+        splits[split] = (triples, sum(n for _, n in parsed))
+        tf.logging.info("Loaded %d triples from %s" % (triples.shape[0], split))
+    return splits
+
+
+def write_dataset_targets(dataset_dir, splits, n_entity, n_relation, entity_names, relation_names):
+    """ Write avoid_entities.txt and all train.* / eval.* target files from integer triples
+
+    :param dataset_dir:
+    :param splits: dict of split file name to int32 [N, 3] (head, relation, tail) triples
+    :param n_entity:
+    :param n_relation:
+    :param entity_names: numpy object array of entity names
+    :param relation_names: numpy object array of relation names
+    :return:
+    """
+    train = splits['train.txt']
+    all_triples = np.concatenate([splits[x] for x in SPLIT_FILES if x in splits])
+
+    # entities that are not presented in train.txt
+    is_open = np.ones([n_entity], dtype=np.bool_)
+    is_open[train[:, 0]] = False
+    is_open[train[:, 2]] = False
+    _write_lines(os.path.join(dataset_dir, 'avoid_entities.txt'), entity_names[is_open])
+    tf.logging.info("%d entities are not seen during training." % np.count_nonzero(is_open))
+
+    for prefix, triples, value_suffixes in [('train', train, ['']),
+                                            ('eval', all_triples, ['.open', '.closed'])]:
+        for direction, key_cols, value_col in [('tails', [0, 1], 2), ('heads', [2, 1], 0)]:
+            keys, values, offsets = group_targets(triples[:, key_cols], triples[:, value_col], n_entity, n_relation)
+            if prefix == 'train':
+                targets = [(values, offsets)]
+            else:
+                closed_targets, open_targets = split_targets(values, offsets, is_open)
+                targets = [open_targets, closed_targets]
+            _write_targets(dataset_dir, '%s.%s.idx' % (prefix, direction),
+                           ['%s.%s.values%s' % (prefix, direction, x) for x in value_suffixes],
+                           keys, targets, entity_names, relation_names)
+            tf.logging.info("Generated %d %s %s targets" % (keys.shape[0], prefix, direction))
+    return is_open
+
+
+def truncated_content_file(content_file, max_content_len):
+    """ Name of the truncated copy of a content file, e.g. descriptions.256.txt """
+    base, ext = os.path.splitext(content_file)
+    return "%s.%d%s" % (base, max_content_len, ext)
+
+
+def truncate_content_files(dataset_dir, max_content_len, in_place=False):
+    """ Truncate descriptions and titles to max_content_len words once, so the loaders can be
+    called with max_content_len=None and never split and join the content again.
+
+    The truncated content is written next to the original files (see truncated_content_file),
+    pass those to the model instead. With in_place the original files are overwritten.
+
+    :return: list of the truncated file paths
+    """
+    paths = list()
+    for content_file in CONTENT_FILES:
+        p = os.path.join(dataset_dir, content_file)
+        out = p if in_place else os.path.join(dataset_dir, truncated_content_file(content_file, max_content_len))
+        n_truncated = 0
+        with open(p, 'r', encoding='utf8') as f, open(out + '.tmp', 'w', encoding='utf8') as fout:
+            for line in f:
+                ent, desc_len, desc = line.strip().split('\t')
+                # the desc_len column may be stale, count the words
+                words = desc.split()
+                if len(words) > max_content_len:
+                    desc = " ".join(words[:max_content_len])
+                    desc_len = str(max_content_len)
+                    n_truncated += 1
+                fout.write("\t".join([ent, desc_len, desc]) + "\n")
+        os.replace(out + '.tmp', out)
+        paths.append(out)
+        tf.logging.info("Truncated %d content in %s to %d words, written to %s" % (n_truncated, p, max_content_len,
+                                                                                 out))
+    return paths
+
+
+def preprocess_dataset(dataset_dir, n_workers=None, cleanup=False, max_content_len=None,
+                       truncate_in_place=False):
+    """ Generate avoid_entities.txt, train.{tails,heads}.{idx,values} and
+    eval.{tails,heads}.{idx,values.open,values.closed} in a single pass over the splits.
+
+    This replaces running generate_avoid_entities.py, generate_training_target_files.py
+    and generate_evaluation_target_files.py one after another.
+
+    :param dataset_dir:
+    :param n_workers: number of worker processes, default to the number of cpus
+    :param cleanup: drop triples with entities that are not in entities.txt and rewrite
+        the split files, same as cleanup_fb15k_triples.py
+    :param max_content_len: if set, truncate the content files, see truncate_content_files
+    :param truncate_in_place: overwrite the content files instead of writing truncated copies
+    :return: dict of split file name to int32 [N, 3] (head, relation, tail) triples
+    """
+    entities = load_list(os.path.join(dataset_dir, 'entities.txt'))
+    relations = load_list(os.path.join(dataset_dir, 'relations.txt'))
+    entity_names = np.asarray(list(entities.keys()), dtype=object)
+    relation_names = np.asarray(list(relations.keys()), dtype=object)
+
+    parsed = load_splits(dataset_dir, entities, relations, n_workers)
+    if 'train.txt' not in parsed:
+        raise ValueError("%s does not have a train.txt" % dataset_dir)
+    splits = dict()
+    for split, (triples, n_skipped) in parsed.items():
+        if n_skipped > 0:
+            if not cleanup:
+                raise ValueError("%d triples in %s have unknown entities or relations, "
+                                 "run with cleanup to remove them" % (n_skipped, split))
+            tf.logging.info("Removed %d triples from %s" % (n_skipped, split))
+            _write_lines(os.path.join(dataset_dir, split),
+                         (entity_names[h] + '\t' + entity_names[t] + '\t' + relation_names[r] for h, r, t in triples))
+        splits[split] = triples
+
+    write_dataset_targets(dataset_dir, splits, len(entities), len(relations), entity_names, relation_names)
+    if max_content_len is not None:
+        truncate_content_files(dataset_dir, max_content_len, in_place=truncate_in_place)
+    return splits
@@ -0,0 +1,21 @@
+#!/usr/bin/env python3
+
+import sys
+
+import tensorflow as tf
+
+from ndkgc.utils.bundle import compile_dataset
+
+""" Compile a dataset directory into a memory-mappable bundle so the models
+    do not need to parse the text files at every launch.
+
+    RUN THIS AFTER ALL TARGET FILES ARE GENERATED
+
+    ./compile_dataset.py DATASET_DIR [BUNDLE_DIR] [MAX_CONTENT_LEN]
+"""
+
+tf.logging.set_verbosity(tf.logging.INFO)
+
+compile_dataset(sys.argv[1],
+                sys.argv[2] if len(sys.argv) > 2 else None,
+                int(sys.argv[3]) if len(sys.argv) > 3 else 256)
@@ -0,0 +1,52 @@
+#!/usr/bin/env python3
+
+import sys
+
+import tensorflow as tf
+
+from ndkgc.utils.delta import update_dataset
+from ndkgc.utils.preprocess import preprocess_dataset
+
+""" Generate avoid_entities.txt and all training and evaluation target files
+    in a single pass over train.txt, valid.txt and test.txt.
+
+    This replaces generate_avoid_entities.py, generate_training_target_files.py and
+    generate_evaluation_target_files.py. With --cleanup triples with entities that are
+    not in entities.txt are removed from the split files like cleanup_fb15k_triples.py.
+
+    With --delta DELTA_DIR new entities, relations, content and triples in DELTA_DIR are
+    merged into the existing files and the compiled bundle instead, see update_dataset.
+
+    With --max-content-len N descriptions and titles are truncated to N words once here
+    instead of every time they are loaded. The truncated copies are written next to the
+    original files, e.g. descriptions.N.txt, with --truncate-in-place the originals are
+    overwritten instead.
+
+    ./preprocess_dataset.py DATASET_DIR [N_WORKERS] [--cleanup] [--delta DELTA_DIR] [--max-content-len N]
+                            [--truncate-in-place]
+"""
+
+tf.logging.set_verbosity(tf.logging.INFO)
+
+if __name__ == '__main__':
+    args = sys.argv[1:]
+    delta_dir = None
+    if '--delta' in args:
+        i = args.index('--delta')
+        delta_dir = args[i + 1]
+        del args[i:i + 2]
+    max_content_len = None
+    if '--max-content-len' in args:
+        i = args.index('--max-content-len')
+        max_content_len = int(args[i + 1])
+        del args[i:i + 2]
+    cleanup = '--cleanup' in args
+    truncate_in_place = '--truncate-in-place' in args
+    args = [x for x in args if x not in ('--cleanup', '--truncate-in-place')]
+    n_workers = int(args[1]) if len(args) > 1 else None
+
+    if delta_dir is not None:
+        update_dataset(args[0], delta_dir, n_workers=n_workers)
+    else:
+        preprocess_dataset(args[0], n_workers=n_workers, cleanup=cleanup, max_content_len=max_content_len,
+                           truncate_in_place=truncate_in_place)